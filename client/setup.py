@@ -12,7 +12,10 @@ setup_info = {
     "name": "walt-client",
     "version": "10.0",
     "install_requires": ["plumbum>=1.7.2", "walt-common==10.0", "walt-doc==10.0"],
-    "extras_require": {"g5k": ["walt-client-g5k==10.0"]},
+    "extras_require": {
+        "g5k": ["walt-client-g5k==10.0"],
+        "compression": ["zstandard>=0.22.0", "lz4>=4.3.2"],
+    },
     "author": "WalT developers",
     "author_email": "walt-contact@univ-grenoble-alpes.fr",
     "keywords": "WalT testbed",
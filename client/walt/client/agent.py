@@ -0,0 +1,487 @@
+"""
+WalT client agent.
+
+When environment variable WALT_CLIENT_AGENT is set (e.g. to 1), the walt
+command does not run the requested command itself: it forwards its
+arguments, environment, working directory and standard file descriptors
+to a per-user background process (the "agent") listening on a unix socket,
+and exits with the return code of the command.
+
+The agent has already imported the client modules, loaded the configuration
+and checked the server version, so each command only costs a fork().
+Commands run one after the other by a script also reuse the same
+server API session, as long as it was idle for less than
+SERVER_SOCKET_REUSE_TIMEOUT seconds (see walt.common.apilink).
+
+The agent is started automatically on first use (meanwhile, this first
+command runs as usual), and it exits after AGENT_IDLE_TIMEOUT seconds
+without commands, or when the client configuration file, the client code
+or the server version changes.
+
+Each walt client installation (python interpreter, location and version of
+the client code) has its own agent, so that a command is always run by the
+code it was launched from.
+
+Note: this module is imported by the walt command before all others,
+so its top-level imports must remain as light as possible.
+"""
+import os
+import pickle
+import signal
+import socket
+import struct
+import sys
+import zlib
+from array import array
+from time import time
+
+AGENT_ENV_VAR = "WALT_CLIENT_AGENT"
+AGENT_SOCKET_NAME = "walt-client-agent-%(install_id)s.sock"
+AGENT_IDLE_TIMEOUT = 15 * 60
+AGENT_CHECK_PERIOD = 60
+AGENT_LISTEN_BACKLOG = 64
+
+# the launcher sends a header (request size) along with its fds 0, 1 and 2,
+# then the pickled request; the agent replies with (kind, value) messages:
+# - (b"P", <pid>): the command is running in process <pid>
+# - (b"E", <retcode>): the command ended
+# - (b"R", 0): the agent is restarting (or it does not run the same client
+#   installation as the launcher), the command should run in-process
+REQUEST_HEADER = struct.Struct("!I")
+REPLY = struct.Struct("!ci")
+STD_FDS = (0, 1, 2)
+FORWARDED_SIGNALS = ("SIGINT", "SIGTERM", "SIGHUP", "SIGQUIT", "SIGWINCH")
+TERMINATING_SIGNALS = ("SIGINT", "SIGTERM", "SIGHUP", "SIGQUIT")
+
+
+def agent_enabled():
+    return os.environ.get(AGENT_ENV_VAR, "") not in ("", "0")
+
+
+def get_socket_dir():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is not None:
+        return runtime_dir
+    return f"/tmp/walt-client-{os.getuid()}"
+
+
+def get_install_id():
+    from walt.common.version import __version__
+
+    install = "\0".join((sys.executable, os.path.dirname(__file__), __version__))
+    return "%08x" % zlib.crc32(install.encode())
+
+
+def get_socket_path():
+    sock_name = AGENT_SOCKET_NAME % dict(install_id=get_install_id())
+    return f"{get_socket_dir()}/{sock_name}"
+
+
+def recv_exactly(sock, size):
+    buf = b""
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if len(chunk) == 0:
+            return None
+        buf += chunk
+    return buf
+
+
+def recv_reply(sock):
+    reply = recv_exactly(sock, REPLY.size)
+    if reply is None:
+        return None, None
+    return REPLY.unpack(reply)
+
+
+# -- launcher side --
+# ------------------
+def start_agent():
+    import subprocess
+
+    env = dict(os.environ)
+    del env[AGENT_ENV_VAR]
+    subprocess.Popen(
+        [sys.executable, "-m", "walt.client.agent"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        cwd="/",
+        env=env,
+    )
+
+
+def send_request(sock):
+    umask = os.umask(0)
+    os.umask(umask)
+    request = pickle.dumps(
+        dict(argv=sys.argv, env=dict(os.environ), cwd=os.getcwd(), umask=umask,
+             install_id=get_install_id())
+    )
+    sock.sendmsg(
+        [REQUEST_HEADER.pack(len(request))],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", STD_FDS))],
+    )
+    sock.sendall(request)
+
+
+class SignalForwarder:
+    def __init__(self, pid):
+        self.pid = pid
+        self.last_signal = None
+
+    def install(self):
+        for name in FORWARDED_SIGNALS:
+            signal.signal(getattr(signal, name), self.forward)
+        signal.signal(signal.SIGTSTP, self.suspend)
+
+    def forward(self, signum, frame):
+        self.last_signal = signum
+        os.kill(self.pid, signum)
+
+    def suspend(self, signum, frame):
+        # ctrl-z: stop the command, then stop ourselves, the usual way
+        os.kill(self.pid, signal.SIGSTOP)
+        signal.signal(signal.SIGTSTP, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTSTP)
+        # we get here when the shell resumes us
+        signal.signal(signal.SIGTSTP, self.suspend)
+        os.kill(self.pid, signal.SIGCONT)
+
+    def terminated_by_signal(self):
+        if self.last_signal is None:
+            return False
+        return signal.Signals(self.last_signal).name in TERMINATING_SIGNALS
+
+
+def run_with_agent():
+    """Run the command through the agent and exit with its return code.
+    If the agent is not available, start it and return (the caller should
+    then run the command in-process)."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_path())
+    except OSError:
+        sock.close()
+        start_agent()
+        return  # run in-process
+    try:
+        send_request(sock)
+        kind, pid = recv_reply(sock)
+    except OSError:
+        kind = None
+    if kind != b"P":
+        sock.close()
+        return  # run in-process
+    forwarder = SignalForwarder(pid)
+    forwarder.install()
+    kind, retcode = recv_reply(sock)
+    if kind != b"E":
+        if forwarder.terminated_by_signal():
+            # the command was killed by the signal we forwarded,
+            # let the shell know we were killed by it too
+            signal.signal(forwarder.last_signal, signal.SIG_DFL)
+            os.kill(os.getpid(), forwarder.last_signal)
+        os.write(2, b"Lost connection with the walt client agent.\n")
+        retcode = 1
+    os._exit(retcode)
+
+
+# -- agent side --
+# ---------------
+def reopen_std_streams():
+    # fds 0, 1 and 2 were replaced, so recreate the python objects
+    # on top of them the way the interpreter does at startup
+    # (i.e., line buffering depends on whether stdout is a tty)
+    for fd, name in enumerate(("stdin", "stdout", "stderr")):
+        prev = getattr(sys, name)
+        if fd == 0:
+            stream = open(fd, "r", encoding=prev.encoding, errors=prev.errors,
+                          closefd=False)
+        else:
+            line_buffering = fd == 2 or os.isatty(fd)
+            stream = open(fd, "w", buffering=1 if line_buffering else -1,
+                          encoding=prev.encoding, errors=prev.errors,
+                          closefd=False)
+        setattr(sys, name, stream)
+        setattr(sys, f"__{name}__", stream)
+
+
+def refresh_terminal_state(conn):
+    # a few objects were created when the agent started, with
+    # fds 0, 1, 2 redirected to /dev/null: update them
+    from walt.common.tools import BusyIndicator
+
+    conn.indicator = BusyIndicator("Server is working")
+    if "plumbum.colorlib.styles" in sys.modules:
+        from plumbum.colorlib.styles import ANSIStyle, get_color_repr
+
+        ANSIStyle.use_color = get_color_repr()
+
+
+def run_client_command(run):
+    # run the command and compute its return code the way
+    # the python interpreter does when the process exits
+    try:
+        run()
+        return 0
+    except SystemExit as e:
+        code = e.code
+    except BaseException:
+        sys.excepthook(*sys.exc_info())
+        return 1
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def recv_request(sock):
+    fds = array("i")
+    header, ancdata, flags, addr = sock.recvmsg(
+        REQUEST_HEADER.size, socket.CMSG_SPACE(len(STD_FDS) * fds.itemsize)
+    )
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[: len(data) - (len(data) % fds.itemsize)])
+    fds = list(fds)
+    if len(header) < REQUEST_HEADER.size:
+        header += recv_exactly(sock, REQUEST_HEADER.size - len(header)) or b""
+    request = None
+    if len(header) == REQUEST_HEADER.size and len(fds) == len(STD_FDS):
+        (size,) = REQUEST_HEADER.unpack(header)
+        request = recv_exactly(sock, size)
+    if request is None:
+        for fd in fds:
+            os.close(fd)
+        raise OSError("Invalid request")
+    return pickle.loads(request), fds
+
+
+def get_peer_uid(sock):
+    if not hasattr(socket, "SO_PEERCRED"):
+        # not linux; the socket directory is private anyway
+        return os.getuid()
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    pid, uid, gid = struct.unpack("3i", creds)
+    return uid
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ClientAgent:
+    def __init__(self, run):
+        from walt.client.config import get_config_file
+        from walt.client.link import InternalClientToServerLink
+        from walt.common import version
+
+        self.run = run
+        # ServerAPIConnection objects are reusable, so this gives us
+        # the session which the commands will get too
+        self.link = InternalClientToServerLink(None)
+        self.conn = self.link.conn
+        self.session_pipe = None
+        self.watched_files = {
+            path: get_mtime(path) for path in (get_config_file(), version.__file__)
+        }
+        self.version = version.__version__
+        self.install_id = get_install_id()
+        self.sock_path = get_socket_path()
+        self.sock_ino = None
+        self.listener = None
+        self.last_activity = None
+
+    def listen(self):
+        sock_dir = get_socket_dir()
+        os.makedirs(sock_dir, mode=0o700, exist_ok=True)
+        st = os.lstat(sock_dir)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise Exception(f"Unsafe permissions on {sock_dir}.")
+        # bind to a temporary path, then rename: in case two agents
+        # are started at the same time, the last one wins and the other
+        # one will exit when detecting it no longer owns the socket.
+        tmp_path = f"{self.sock_path}.{os.getpid()}"
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(tmp_path)
+        self.listener.listen(AGENT_LISTEN_BACKLOG)
+        self.sock_ino = os.stat(tmp_path).st_ino
+        os.rename(tmp_path, self.sock_path)
+
+    def owns_socket(self):
+        try:
+            return os.stat(self.sock_path).st_ino == self.sock_ino
+        except OSError:
+            return False
+
+    def is_stale(self):
+        for path, mtime in self.watched_files.items():
+            if get_mtime(path) != mtime:
+                return True
+        remote_version = self.conn.get_remote_version()
+        return self.conn.connected and str(remote_version) != str(self.version)
+
+    def drop_session(self):
+        if self.conn.connected:
+            self.conn.sock.close()
+            self.conn.sock = None
+            self.conn.connected = False
+
+    def refresh_session(self):
+        # if the server closed the session while it was idle, the socket
+        # is now readable: drop it
+        if self.conn.connected:
+            from select import select
+
+            r, w, e = select((self.conn.sock,), (), (), 0)
+            if len(r) > 0:
+                self.drop_session()
+        # (re)connect if needed, see ServerAPIConnection.connect()
+        try:
+            with self.link:
+                pass
+        except Exception:
+            # server unreachable: the command will report the issue
+            self.drop_session()
+
+    def release_session(self):
+        status = os.read(self.session_pipe, 1)
+        os.close(self.session_pipe)
+        self.session_pipe = None
+        if status == b"1":
+            self.conn.idle_start_time = time()
+        else:
+            # the command failed, maybe in the middle of an API call
+            self.drop_session()
+
+    def serve(self):
+        from select import select
+
+        self.listen()
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # auto-reap children
+        self.last_activity = time()
+        while True:
+            fds = [self.listener]
+            if self.session_pipe is not None:
+                fds.append(self.session_pipe)
+            r, w, e = select(fds, (), (), AGENT_CHECK_PERIOD)
+            # note: a command releases the session before replying
+            # to its launcher, so we always process this first
+            if self.session_pipe in r:
+                self.release_session()
+            if self.listener in r:
+                if not self.accept():
+                    break
+            elif time() - self.last_activity > AGENT_IDLE_TIMEOUT:
+                break
+            elif not self.owns_socket():
+                break
+        if self.owns_socket():
+            os.unlink(self.sock_path)
+
+    def accept(self):
+        sock, addr = self.listener.accept()
+        with sock:
+            try:
+                if get_peer_uid(sock) != os.getuid():
+                    return True
+                request, fds = recv_request(sock)
+            except Exception:
+                return True
+            try:
+                if request.get("install_id") != self.install_id:
+                    # launched from another client installation
+                    sock.sendall(REPLY.pack(b"R", 0))
+                    return True
+                self.last_activity = time()
+                use_session = self.session_pipe is None
+                if use_session:
+                    self.refresh_session()
+                if self.is_stale():
+                    sock.sendall(REPLY.pack(b"R", 0))
+                    return False
+                self.fork_command(sock, request, fds, use_session)
+                return True
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def fork_command(self, sock, request, fds, use_session):
+        pipe_w = None
+        if use_session:
+            pipe_r, pipe_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            retcode = 1
+            try:
+                retcode = self.run_command(sock, request, fds, pipe_w)
+            finally:
+                os._exit(retcode)
+        if use_session:
+            os.close(pipe_w)
+            self.session_pipe = pipe_r
+
+    def run_command(self, sock, request, fds, pipe_w):
+        # we are in the child process
+        self.listener.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd, std_fd in zip(fds, STD_FDS):
+            os.dup2(fd, std_fd)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.umask(request["umask"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = request["argv"]
+        reopen_std_streams()
+        if pipe_w is None:
+            # another command is using the session,
+            # this one will open its own
+            self.drop_session()
+        refresh_terminal_state(self.conn)
+        sock.sendall(REPLY.pack(b"P", os.getpid()))
+        retcode = run_client_command(self.run)
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except OSError:
+            pass
+        if pipe_w is not None:
+            clean = retcode == 0 and not self.conn.in_use
+            os.write(pipe_w, b"1" if clean else b"0")
+        sock.sendall(REPLY.pack(b"E", retcode))
+        return retcode
+
+
+def serve():
+    # import the client modules: this runs early startup hooks
+    # and speedup code too
+    import walt.client.client as client
+    from walt.client import plugins
+    from walt.client.link import ClientToServerLink
+
+    plugins.load_plugins_metadata()
+    for modname, objname in plugins.METADATA["categories"].values():
+        plugins.load_module(f"walt.client.{modname}")
+    # load the configuration and open the server session;
+    # in case of a version mismatch, is_stale() below returns True,
+    # and we let the walt command handle the client upgrade in-process.
+    with ClientToServerLink(do_checks=False):
+        pass
+    agent = ClientAgent(client.run)
+    if agent.is_stale():
+        return
+    agent.serve()
+
+
+if __name__ == "__main__":
+    serve()
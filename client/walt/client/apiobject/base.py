@@ -223,19 +223,30 @@ class APIObjectBase:
         if self.__context__ is not None:
             self.__context__.pop("info", None)  # discard
 
-    def __repr_context__(self):
+    def __info_context__(self, **context):
         from contextlib import contextmanager
 
         @contextmanager
         def cm():
             try:
-                self.__context__ = {}
+                self.__context__ = context
                 yield
             finally:
                 self.__context__ = None
 
         return cm()
 
+    def __repr_context__(self):
+        return self.__info_context__()
+
+    def __prefetch_context__(self):
+        # volatile attributes are not refreshed in this context:
+        # the caller refreshes them once for a whole set of items
+        return self.__info_context__(prefetched=True)
+
+    def __is_prefetched__(self):
+        return self.__context__ is not None and "prefetched" in self.__context__
+
     def __repr__(self, level=0):
         with self.__repr_context__():
             short_desc = self.__dynamic_doc__
@@ -265,7 +276,7 @@ class APIObjectBase:
         return info
 
     def __getattr__(self, attr):
-        if attr in self.__volatile_attrs__():
+        if attr in self.__volatile_attrs__() and not self.__is_prefetched__():
             self.__force_refresh__()
             self.__discard_context__()
         info = self.__buffered_get_info__()
@@ -544,16 +555,18 @@ class APISetOfItemsClassFactory:
                             " matching the given attributes")
 
             def filter(self, **kwargs):
-                new_set = item_set_factory.create(set())
-                for item in d.values():
-                    item_ok = True
-                    for k, v in kwargs.items():
-                        if getattr(item, k) != v:
-                            item_ok = False
-                            break
-                    if item_ok:
-                        new_set |= item
-                return new_set
+                items = list(d.values())
+                # if needed, refresh volatile attributes once for the whole
+                # set, then compute the info of each item only once
+                if len(items) > 0:
+                    if not set(kwargs).isdisjoint(items[0].__volatile_attrs__()):
+                        items[0].__force_refresh__()
+                names = set()
+                for item in items:
+                    with item.__prefetch_context__():
+                        if all(getattr(item, k) == v for k, v in kwargs.items()):
+                            names.add(item.name)
+                return item_set_factory.create(names)
 
             def __ior__(self, other):
                 if isinstance(other, item_base_cls):
@@ -587,10 +600,19 @@ class APISetOfItemsClassFactory:
 
 
 class APIItemInfoCache:
+    # subclasses must define the name of the field identifying items
+    # (several names may target the same item, e.g. image aliases)
+    id_field = None
+
     def __init__(self, show_aliases=False):
         self.listeners_refs = set()
         self.populated = False
         self.show_aliases = show_aliases
+        # rows of the server listing, and their revision:
+        # when refreshing, the server just sends the changes
+        # since this revision (see do_get_changes())
+        self.rows = None
+        self.revision = None
 
     def server_link(self):
         from walt.client.apitools import silent_server_link
@@ -606,6 +628,49 @@ class APIItemInfoCache:
         with self.server_link() as server:
             self.do_refresh(server)
 
+    def do_refresh(self, server):
+        from collections import defaultdict
+
+        changes = self.do_get_changes(server, self.revision)
+        if changes["full"]:
+            self.rows = {}
+            self.info_per_id = {}
+            self.id_per_name = {}
+            self.names_per_id = defaultdict(set)
+        # unindex removed and modified rows first, because
+        # a modified row may now use the name of a removed one
+        for key in changes["removed"]:
+            self.unindex_row(self.rows.pop(key))
+        updated_rows = {}
+        for key, fields in changes["rows"].items():
+            row = self.rows.pop(key, None)
+            if row is None:  # new row
+                row = fields
+            else:  # modified row
+                self.unindex_row(row)
+                row = dict(row, **fields)
+            updated_rows[key] = row
+        for key, row in updated_rows.items():
+            self.rows[key] = row
+            self.index_row(row)
+        self.revision = changes["revision"]
+
+    def index_row(self, row):
+        info = dict(row)
+        name = info.pop("name")
+        item_id = info[self.id_field]
+        self.id_per_name[name] = item_id
+        self.info_per_id[item_id] = info
+        self.names_per_id[item_id].add(name)
+
+    def unindex_row(self, row):
+        name, item_id = row["name"], row[self.id_field]
+        del self.id_per_name[name]
+        self.names_per_id[item_id].discard(name)
+        if len(self.names_per_id[item_id]) == 0:
+            del self.names_per_id[item_id]
+            del self.info_per_id[item_id]
+
     def __contains__(self, item_name):
         self.ensure_populated()
         return item_name in self.id_per_name
@@ -623,6 +688,8 @@ class APIItemInfoCache:
         with self.server_link() as server:
             if not self.do_remove_item(server, item_name):
                 return  # failed
+        # our copy no longer matches a revision of the server listing
+        self.revision = None
         item_id = self.id_per_name[item_name]
         self.names_per_id[item_id].remove(item_name)
         if len(self.names_per_id[item_id]) == 0:
@@ -658,6 +725,7 @@ class APIItemInfoCache:
         with self.server_link() as server:
             if not self.do_rename_item(server, item_name, new_item_name):
                 return  # failed
+        self.revision = None  # see __delitem__()
         item_id = self.id_per_name[item_name]
         self.names_per_id[item_id].remove(item_name)
         self.names_per_id[item_id].add(new_item_name)
@@ -666,7 +734,7 @@ class APIItemInfoCache:
         for obj in self.valid_listeners():
             obj.__propagate_rename__(item_name, new_item_name)
 
-    def do_refresh(self, server):
+    def do_get_changes(self, server, revision):
         raise NotImplementedError  # should be implemented in sub-class
 
     def do_remove_item(self, server, item_name):
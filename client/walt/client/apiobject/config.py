@@ -9,7 +9,12 @@ CONFIG_GET_TRANSFORMS = {
 def _get_prop(prop, config_instance):
     v = config_instance.__buffered_get_info__()[prop]
     if prop in CONFIG_GET_TRANSFORMS:
-        v = CONFIG_GET_TRANSFORMS[prop](v)
+        transform = CONFIG_GET_TRANSFORMS[prop]
+        if isinstance(v, dict):
+            # config of a set of nodes, with values differing
+            v = {node_name: transform(val) for node_name, val in v.items()}
+        else:
+            v = transform(v)
     return v
 
 
@@ -1,6 +1,4 @@
-import re
 import sys
-from collections import defaultdict
 from pathlib import Path
 
 from walt.client.apiobject.base import (
@@ -17,30 +15,14 @@ from walt.common.tools import parse_image_fullname
 
 
 class APIImageInfoCache(APIItemInfoCache):
+    id_field = "id"
+
     def __init__(self):
         super().__init__(show_aliases=True)
 
-    def do_refresh(self, server):
+    def do_get_changes(self, server, revision):
         fields = ("id", "name", "fullname", "in_use", "created", "compatibility:tuple")
-        tabular_data = server.get_images_tabular_data(
-            conf.walt.username, refresh=False, fields=fields
-        )
-        # remove ':<suffix>' on field names
-        fields = list(re.sub(r"([^:]*):.*", r"\1", f) for f in fields)
-        # replace rows with dicts
-        image_infos = list(
-            {f: val for f, val in zip(fields, row)} for row in tabular_data
-        )
-        # populate attributes
-        self.info_per_id = {}
-        self.id_per_name = {}
-        self.names_per_id = defaultdict(set)
-        for info in image_infos:
-            name = info.pop("name")
-            image_id = info["id"]
-            self.id_per_name[name] = image_id
-            self.info_per_id[image_id] = info
-            self.names_per_id[image_id].add(name)
+        return server.get_images_info_changes(conf.walt.username, fields, revision)
 
     def do_remove_item(self, server, item_name):
         return server.remove_image(item_name)
@@ -27,21 +27,13 @@ from walt.client.timeout import timeout_context
 
 
 class APINodeInfoCache(APIItemInfoCache):
+    id_field = "mac"
+
     def __init__(self):
         super().__init__(show_aliases=False)
 
-    def do_refresh(self, server):
-        nodes_info = server.get_nodes_info("all-nodes")
-        # populate attributes
-        self.info_per_id = {}
-        self.id_per_name = {}
-        self.names_per_id = defaultdict(set)
-        for info in nodes_info:
-            name = info.pop("name")
-            node_id = info["mac"]
-            self.id_per_name[name] = node_id
-            self.info_per_id[node_id] = info
-            self.names_per_id[node_id].add(name)
+    def do_get_changes(self, server, revision):
+        return server.get_nodes_info_changes(revision)
 
     def do_remove_item(self, server, item_name):
         node_id = self.id_per_name[item_name]
@@ -92,11 +84,16 @@ class Tools:
                 raise ParameterNotAnImageException()
         return image_name_or_default
 
+    @staticmethod
+    def check_owned_or_force(nodes, force=False, mode="owned-or-free"):
+        for n in nodes:
+            with n.__prefetch_context__():
+                n._check_owned_or_force(force, mode)
+
     @staticmethod
     def boot_image(nodes, image, cause, force=False, ownership_mode="owned-or-free"):
         image_name_or_default = Tools.get_image_name_or_default(image)
-        for n in nodes:
-            n._check_owned_or_force(force, ownership_mode)
+        Tools.check_owned_or_force(nodes, force, ownership_mode)
         nodeset = Tools.get_comma_nodeset(nodes)
         with silent_server_link() as server:
             if not server.set_image(nodeset, image_name_or_default):
@@ -110,8 +107,7 @@ class Tools:
 
     @staticmethod
     def acquire(nodes, force=False):
-        for n in nodes:
-            n._check_owned_or_force(force=force, mode="free-or-not-owned")
+        Tools.check_owned_or_force(nodes, force=force, mode="free-or-not-owned")
         nodeset = Tools.get_comma_nodeset(nodes)
         with silent_server_link() as server:
             _, _, image_per_node = server.get_clones_of_default_images(nodeset)
@@ -293,12 +289,49 @@ class APISetOfNodesFactory:
 
             def reboot(self, force=False, hard_only=False):
                 """Reboot all nodes of this set"""
-                for n in self:
-                    n._check_owned_or_force(force)
+                Tools.check_owned_or_force(self, force)
                 with silent_server_link() as server:
                     server.reboot_nodes(Tools.get_comma_nodeset(self),
                                         hard_only=hard_only)
 
+            @property
+            def config(self):
+                return APINodeConfig(self._get_config, self._set_config)
+
+            def _get_config(self):
+                if len(self) == 0:
+                    return {}
+                with silent_server_link() as server:
+                    dev_configs = server.get_device_config_data(
+                        Tools.get_comma_nodeset(self)
+                    )
+                # for each setting, return the value if all nodes share it,
+                # or a dict giving the value of each node otherwise
+                values = defaultdict(dict)
+                for dev_config in dev_configs:
+                    for k, v in dev_config["settings"].items():
+                        values[k.replace(".", "_")][dev_config["name"]] = v
+                config = {}
+                for k, node_values in values.items():
+                    first_value = next(iter(node_values.values()))
+                    if len(node_values) == len(dev_configs) and all(
+                        v == first_value for v in node_values.values()
+                    ):
+                        config[k] = first_value
+                    else:
+                        config[k] = node_values
+                return config
+
+            def _set_config(self, setting_name, setting_value):
+                if len(self) == 0:
+                    return
+                setting_name = setting_name.replace("_", ".")
+                with silent_server_link() as server:
+                    server.set_device_config(
+                        Tools.get_comma_nodeset(self),
+                        (f"{setting_name}={setting_value}",),
+                    )
+
             def wait(self, timeout=-1):
                 """Wait until all nodes of this set are booted"""
                 with silent_server_link() as server:
@@ -1,22 +1,116 @@
 """
 WalT client shell autocompletion helper.
 """
+import json
+import os
 import sys
+from pathlib import Path
+from time import time
 
 from walt.client.config import conf
-from walt.client.link import ClientToServerLink
 from walt.client.plugins import get_hook
 from walt.client.timeout import start_timeout
 
 AUTOCOMPLETE_TIMEOUT = 4
+AUTOCOMPLETE_CACHE_PATH = Path("~/.walt/autocomplete-cache.json").expanduser()
+AUTOCOMPLETE_CACHE_MAX_ENTRIES = 256
+# the access time of cache entries is only used to discard the least
+# recently used ones, so we update it on cache hits only when older than this
+AUTOCOMPLETE_CACHE_ATIME_PRECISION = 3600
+
+# Completion results of some argument types (node names, image names, etc.)
+# are returned with a generation string by the server, and saved in a cache
+# file. When the user types the same completion request again, the cached
+# result is printed immediately, and a background process asks the server
+# whether the generation changed (and if so, updates the cache for next time).
+
+
+def load_cache():
+    try:
+        return json.loads(AUTOCOMPLETE_CACHE_PATH.read_text())
+    except Exception:
+        return {}
+
+
+def save_cache(cache):
+    if len(cache) > AUTOCOMPLETE_CACHE_MAX_ENTRIES:
+        # discard the least recently used entries
+        keys = sorted(cache, key=lambda k: cache[k]["atime"])
+        for key in keys[:len(cache) - AUTOCOMPLETE_CACHE_MAX_ENTRIES]:
+            del cache[key]
+    # write to a temporary file and rename it, for atomicity
+    AUTOCOMPLETE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = AUTOCOMPLETE_CACHE_PATH.with_name(
+        f"{AUTOCOMPLETE_CACHE_PATH.name}.{os.getpid()}"
+    )
+    tmp_path.write_text(json.dumps(cache))
+    tmp_path.rename(AUTOCOMPLETE_CACHE_PATH)
+
+
+def get_cache_key(argv):
+    return json.dumps([conf.walt.server, conf.walt.username, argv])
+
+
+def update_cache(argv, result, generation):
+    cache = load_cache()
+    key = get_cache_key(argv)
+    if generation is None:
+        cache.pop(key, None)
+    else:
+        cache[key] = dict(result=result, generation=generation, atime=time())
+    save_cache(cache)
+
+
+def server_autocomplete(server, argv, debug=False):
+    res = server.shell_autocomplete(
+        conf.walt.username, argv, debug=debug, with_generation=True
+    )
+    if res is None:
+        return None
+    result, generation = res
+    if not debug:
+        update_cache(argv, result, generation)
+    return result
+
+
+def revalidate_in_background(argv, generation):
+    # flush pending output before forking
+    sys.stdout.flush()
+    if os.fork() > 0:
+        return  # parent
+    # child: detach from the shell which is reading our stdout
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        start_timeout(AUTOCOMPLETE_TIMEOUT)
+        from walt.client.link import ClientToServerLink
+
+        with ClientToServerLink() as server:
+            if server.get_autocomplete_generation(argv) != generation:
+                server_autocomplete(server, argv)
+    finally:
+        os._exit(0)
+
+
+def cached_autocomplete(argv):
+    cache = load_cache()
+    entry = cache.get(get_cache_key(argv))
+    if entry is None:
+        return None
+    # avoid rewriting the cache file on each cache hit
+    now = time()
+    if now - entry["atime"] > AUTOCOMPLETE_CACHE_ATIME_PRECISION:
+        entry["atime"] = now
+        save_cache(cache)
+    return entry
 
 
 def ac_helper():
     debug = sys.argv[1] == "--debug"
     if debug:
         other_argv = sys.argv[2:]
-        from time import time
-
         t0 = time()
     else:
         other_argv = sys.argv[1:]
@@ -28,12 +122,19 @@ def ac_helper():
         # check if plugin can handle autocompletion
         if plugin_shell_autocomplete is not None:
             result = plugin_shell_autocomplete(other_argv)
+        # otherwise check the cache (unless debugging)
+        if result is None and not debug:
+            entry = cached_autocomplete(other_argv)
+            if entry is not None:
+                print(entry["result"])
+                revalidate_in_background(other_argv, entry["generation"])
+                return
         # otherwise request the server to do it
         if result is None:
+            from walt.client.link import ClientToServerLink
+
             with ClientToServerLink() as server:
-                result = server.shell_autocomplete(
-                    conf.walt.username, other_argv, debug=debug
-                )
+                result = server_autocomplete(server, other_argv, debug=debug)
         if debug:
             print(f"delay: {time()-t0:.2}s")
         # if still None, there was an issue
@@ -5,6 +5,12 @@ WalT (wireless testbed) control tool.
 """
 import sys
 
+# if enabled, let the client agent run the command (see agent.py)
+from walt.client.agent import agent_enabled, run_with_agent
+
+if agent_enabled():
+    run_with_agent()  # only returns if the agent is not available
+
 # run early startup hooks as soon as possible
 from walt.client.plugins import run_hook_if_any
 
@@ -0,0 +1,138 @@
+import ipaddress
+import os
+import random
+import time
+
+# Stream compression of file transfers.
+# The server lists the compressors it supports in its "READY" line,
+# and the client selects one of them (if the related python module
+# is installed) and a compression level, by measuring how fast each
+# candidate level compresses a sample of data.
+# Note that the speed of the network link is not measured, and thus not
+# taken into account: the probe just ensures compression is fast enough
+# not to be the bottleneck of a gigabit link. On a slow link, a higher
+# level would compress more and still not slow down the transfer; on a
+# fast link with poorly compressible data, a lower level (or no
+# compression) may be faster. See dev/benchmarks/transfer-compression.py.
+
+# compressors in order of preference, with the levels to probe
+# (highest first)
+COMPRESSION_LEVELS = {
+    "zstd": (9, 6, 3, 1),
+    "lz4": (9, 1),
+}
+# use the highest level compressing at least this fast (bytes/s)
+COMPRESSION_MIN_SPEED = 100 * 1024 * 1024
+COMPRESSION_SAMPLE_SIZE = 1024 * 1024
+
+
+def _import_compressor(name):
+    try:
+        if name == "zstd":
+            import zstandard
+            return zstandard
+        elif name == "lz4":
+            import lz4.frame
+            return lz4.frame
+    except ImportError:
+        return None
+
+
+def _compress(name, level, data):
+    module = _import_compressor(name)
+    if name == "zstd":
+        return module.ZstdCompressor(level=level).compress(data)
+    else:
+        return module.compress(data, compression_level=level)
+
+
+def _iter_files(path):
+    if os.path.isfile(path):
+        yield path
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def get_compression_sample(path=None):
+    """Get a sample of the data to be transfered.
+    If path is not given (i.e. the data comes from the server),
+    return a synthetic sample mixing compressible and random bytes."""
+    sample = b""
+    if path is not None:
+        for file_path in _iter_files(path):
+            if not os.path.isfile(file_path):
+                continue  # broken symlink, fifo, etc.
+            try:
+                with open(file_path, "rb") as f:
+                    sample += f.read(COMPRESSION_SAMPLE_SIZE - len(sample))
+            except OSError:
+                continue
+            if len(sample) >= COMPRESSION_SAMPLE_SIZE:
+                break
+    if len(sample) > 0:
+        return sample
+    rand = random.Random(0)
+    text = b" ".join(b"%s=%d" % (rand.choice((b"size", b"mode", b"name", b"path")),
+                                 rand.randrange(1000)) for _ in range(60000))
+    half = COMPRESSION_SAMPLE_SIZE // 2
+    return text[:half] + rand.randbytes(half)
+
+
+def probe_compression_level(name, sample):
+    """Return the highest level of compressor <name> compressing
+    <sample> at COMPRESSION_MIN_SPEED or more (or None).
+    The link speed is ignored (see the note at the top of this file)."""
+    for level in COMPRESSION_LEVELS[name]:
+        t0 = time.perf_counter()
+        _compress(name, level, sample)
+        speed = len(sample) / max(time.perf_counter() - t0, 1e-6)
+        if speed >= COMPRESSION_MIN_SPEED:
+            return level
+    return None
+
+
+def negotiate_compression(ready_line, sock_file, sample_path=None):
+    """Select a compressor among those the server listed in its READY line.
+    Return (name, level) or None (no compression)."""
+    server_compressors = ready_line.split()[1:]
+    if len(server_compressors) == 0:
+        return None  # older server, or no compressor available there
+    # compression is useless when the server is on the same machine
+    if ipaddress.ip_address(sock_file.getpeername()[0]).is_loopback:
+        return None
+    sample = None
+    for name in COMPRESSION_LEVELS:
+        if name not in server_compressors or _import_compressor(name) is None:
+            continue
+        if sample is None:
+            sample = get_compression_sample(sample_path)
+        level = probe_compression_level(name, sample)
+        if level is not None:
+            return (name, level)
+    return None
+
+
+def compressed_writer(compression, fileobj):
+    """Wrap fileobj for writing compressed data, calling close() on
+    the returned object terminates the compressed stream but does
+    not close fileobj."""
+    name, level = compression
+    module = _import_compressor(name)
+    if name == "zstd":
+        cctx = module.ZstdCompressor(level=level)
+        return cctx.stream_writer(fileobj, closefd=False)
+    else:
+        return module.LZ4FrameFile(fileobj, mode="wb", compression_level=level)
+
+
+def decompressed_reader(compression, fileobj):
+    """Wrap fileobj for reading decompressed data."""
+    name, level = compression
+    module = _import_compressor(name)
+    if name == "zstd":
+        dctx = module.ZstdDecompressor()
+        return dctx.stream_reader(fileobj, closefd=False)
+    else:
+        return module.LZ4FrameFile(fileobj, mode="rb")
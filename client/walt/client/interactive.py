@@ -6,7 +6,6 @@ import socket
 import sys
 from select import select
 from socket import SHUT_WR
-from sys import stdin, stdout
 
 from walt.client.link import connect_to_tcp_server
 from walt.common.io import read_and_copy, unbuffered
@@ -49,7 +48,7 @@ class PromptClient(object):
         self.sock_file.readline()
         write_pickle(params, self.sock_file)
         # make stdin unbuffered
-        self.stdin_reader = unbuffered(stdin, "rb")
+        self.stdin_reader = unbuffered(sys.stdin, "rb")
 
     def resize_handler(self, signum, frame):
         self.resize_handler_called = True
@@ -84,9 +83,9 @@ class PromptClient(object):
             captured = io.BytesIO()
             out_buffer = captured
         else:
-            out_buffer = stdout.buffer
+            out_buffer = sys.stdout.buffer
         # we will wait on 2 file descriptors
-        fds = [stdin, self.sock_file]
+        fds = [sys.stdin, self.sock_file]
 
         # this is the main trick when trying to provide a virtual
         # terminal remotely: the client should set its own terminal
@@ -14,8 +14,15 @@ from walt.common.tcp import client_sock_file
 
 @api
 class ExposedStream(object):
-    def __init__(self, stream):
-        self.stream = stream
+    # note: the stream is looked up in module sys on each call,
+    # because the client agent replaces sys.stdin, sys.stdout and
+    # sys.stderr when running a command (see agent.py).
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def stream(self):
+        return getattr(sys, self.name)
 
     @api_expose_method
     def fileno(self):
@@ -54,9 +61,9 @@ class WaltClientService(BaseAPIService):
     @api_expose_attrs("stdin", "stdout", "stderr", "filesystem")
     def __init__(self):
         super().__init__()
-        self.stdin = ExposedStream(sys.stdin)
-        self.stdout = ExposedStream(sys.stdout)
-        self.stderr = ExposedStream(sys.stderr)
+        self.stdin = ExposedStream("stdin")
+        self.stdout = ExposedStream("stdout")
+        self.stderr = ExposedStream("stderr")
         self.filesystem = Filesystem()
         self.link = None
 
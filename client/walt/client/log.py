@@ -1,6 +1,10 @@
 import datetime
+import io
 import re
+import select
+import string
 import sys
+from pickle import Unpickler, UnpicklingError
 
 from plumbum import cli
 from walt.client.application import WalTApplication, WalTCategoryApplication
@@ -23,6 +27,11 @@ DEFAULT_FORMAT_STRING = "{timestamp:%H:%M:%S.%f} {issuer}.{stream} -> {line}"
 
 SECONDS_PER_UNIT = {"s": 1, "m": 60, "h": 3600, "d": 86400}
 NUM_LOGS_CONFIRM_TRESHOLD = 1000
+LOG_RECV_SIZE = 256 * 1024
+LOG_BATCH_MAX_RECORDS = 1024
+# <arg_name>(.<attribute>|[<index>])* in a format string replacement field
+LOG_FIELD_NAME = re.compile(r"([^.[]+)((?:\.[^.[]+|\[[^]]+\])*)$")
+LOG_FIELD_NAME_PART = re.compile(r"\.([^.[]+)|\[([^]]+)\]")
 
 MSG_INVALID_CHECKPOINT_NAME = """\
 Invalid checkpoint name:
@@ -51,9 +60,56 @@ def compute_relative_date(server_time, rel_date):
     return server_time - delay
 
 
+def compile_log_format(format_string):
+    """Compile format_string into a function rendering a log record.
+
+    The function evaluates a f-string generated from format_string,
+    which avoids parsing format_string again for each record.
+    If format_string uses features this compiler does not handle
+    (e.g. nested replacement fields), str.format_map() is used instead.
+    """
+    template, names = "", {}
+
+    def name(value, prefix):
+        var_name = f"{prefix}{len(names)}"
+        names[var_name] = value
+        return var_name
+
+    try:
+        for literal, field_name, spec, conversion in string.Formatter().parse(
+            format_string
+        ):
+            template += literal.replace("{", "{{").replace("}", "}}")
+            if field_name is None:
+                continue
+            m = LOG_FIELD_NAME.match(field_name)
+            if m is None or m.group(1).isdigit() or "{" in spec:
+                raise ValueError
+            first, rest = m.groups()
+            expr = f"r[{name(first, 'K')}]"
+            for attr, key in LOG_FIELD_NAME_PART.findall(rest):
+                if attr != "":
+                    if not attr.isidentifier():
+                        raise ValueError
+                    expr += f".{attr}"
+                else:
+                    if key.isdigit():
+                        key = int(key)
+                    expr += f"[{name(key, 'K')}]"
+            if conversion is not None:
+                expr += f"!{conversion}"
+            if spec != "":
+                expr += f":{{{name(spec, 'S')}}}"
+            template += "{" + expr + "}"
+        return eval("lambda r: f" + repr(template), names)
+    except Exception:
+        return format_string.format_map
+
+
 class LogsFlowFromServer(object):
     def __init__(self):
         self.f = connect_to_tcp_server()
+        self._buf = bytearray()
 
     def read_log_record(self):
         try:
@@ -61,6 +117,56 @@ class LogsFlowFromServer(object):
         except Exception:
             return None
 
+    def _parse_log_records(self):
+        # decode the records fully received, keep any partial one
+        # in the buffer.
+        records, pos = [], 0
+        bio = io.BytesIO(self._buf)
+        unpickler = Unpickler(bio)
+        while pos < len(self._buf) and len(records) < LOG_BATCH_MAX_RECORDS:
+            try:
+                records.append(unpickler.load())
+            except (EOFError, UnpicklingError):
+                break  # truncated record
+            pos = bio.tell()
+        del self._buf[:pos]
+        return records
+
+    def read_log_records(self):
+        """Yield batches of log records.
+
+        Data is received in large chunks and a batch is yielded when no
+        more complete record is available without blocking (or when the
+        batch reaches LOG_BATCH_MAX_RECORDS).
+        Note: this method and read_log_record() should not be mixed on
+        the same connection.
+        """
+        while True:
+            records = self._parse_log_records()
+            if len(records) > 0:
+                yield records
+                continue
+            try:
+                chunk = self.f.read1(LOG_RECV_SIZE)
+            except OSError:
+                return
+            if len(chunk) == 0:
+                return
+            self._buf += chunk
+            # read more if immediately available
+            while len(self._buf) < LOG_RECV_SIZE:
+                try:
+                    if len(select.select([self.f], [], [], 0)[0]) == 0:
+                        break
+                    chunk = self.f.read1(LOG_RECV_SIZE)
+                except OSError:
+                    # note: a TimeoutException must be propagated, otherwise
+                    # the next blocking read would not be interrupted.
+                    break
+                if len(chunk) == 0:
+                    break
+                self._buf += chunk
+
     def request_log_dump(self, **kwargs):
         Requests.send_id(self.f, Requests.REQ_DUMP_LOGS)
         write_pickle(kwargs, self.f)
@@ -189,7 +295,8 @@ class WalTLogShowOrWait(WalTApplication):
         timeout=-1,
     ):
         try:
-            for record in WalTLogShowOrWait.start_streaming(
+            render = compile_log_format(format_string)
+            for records in WalTLogShowOrWait.start_streaming_batches(
                 history_range,
                 realtime,
                 issuers,
@@ -198,7 +305,9 @@ class WalTLogShowOrWait(WalTApplication):
                 stop_test,
                 timeout,
             ):
-                print(format_string.format(**record))
+                # write the whole batch at once, and flush since the
+                # next batch may take time to come (realtime mode)
+                sys.stdout.write("\n".join(map(render, records)) + "\n")
                 sys.stdout.flush()
         except TimeoutException:
             print("Timeout was reached.")
@@ -214,6 +323,16 @@ class WalTLogShowOrWait(WalTApplication):
     @staticmethod
     def start_streaming(
         history_range, realtime, issuers, streams, logline_regexp, stop_test, timeout=-1
+    ):
+        for records in WalTLogShowOrWait.start_streaming_batches(
+            history_range, realtime, issuers, streams, logline_regexp, stop_test,
+            timeout
+        ):
+            yield from records
+
+    @staticmethod
+    def start_streaming_batches(
+        history_range, realtime, issuers, streams, logline_regexp, stop_test, timeout=-1
     ):
         conn = LogsFlowFromServer()
         conn.request_log_dump(
@@ -224,18 +343,18 @@ class WalTLogShowOrWait(WalTApplication):
             logline_regexp=logline_regexp,
         )
         with timeout_context(timeout):
-            while True:
-                record = conn.read_log_record()
-                # most probably sigalarm will be caught by pickle, it will just abort
-                # the read and record will be None. we would miss the TimeoutException
-                # in this case, so we check with timeout_reached().
-                if timeout > 0 and timeout_reached():
-                    raise TimeoutException()
-                if record is None:
-                    break
-                yield record
-                if stop_test is not None and stop_test(**record):
-                    break
+            for records in conn.read_log_records():
+                if stop_test is not None:
+                    for i, record in enumerate(records):
+                        if stop_test(**record):
+                            yield records[:i+1]
+                            return
+                yield records
+            # most probably sigalarm was caught while reading, which just
+            # aborted the read. we would miss the TimeoutException
+            # in this case, so we check with timeout_reached().
+            if timeout > 0 and timeout_reached():
+                raise TimeoutException()
 
 
 @WalTLog.subcommand("show")
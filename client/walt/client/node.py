@@ -439,12 +439,20 @@ class WalTNodeCp(WalTApplication):
     ORDERING = 7
     USAGE = """\
     walt node cp <local-path> <node>:<path>
+    walt node cp <local-path> <node-set>:<dir-path>
     walt node cp <node>:<path> <local-path>
     walt node cp <node>:<path> booted-image
     """
 
     def main(self, src: NODE_CP_SRC, dst: NODE_CP_DST):
         with ClientToServerLink() as server:
+            if ":" not in src and ":" in dst:
+                node_set = dst.rsplit(":", 1)[0]
+                nodes = server.develop_node_set(node_set)
+                if nodes is None:
+                    return False
+                if "," in nodes:
+                    return self.copy_to_node_set(server, node_set, src, dst)
             info = server.validate_node_cp(src, dst)
             if info is None:
                 return
@@ -477,6 +485,26 @@ class WalTNodeCp(WalTApplication):
                     print("Aborted.")
                     return False
 
+    def copy_to_node_set(self, server, node_set, src, dst):
+        # the server receives the archive once and extracts it
+        # on all nodes of the set
+        if not WalTNode.check_nodes_ownership(server, node_set):
+            return False
+        if not WalTNode.wait_for_nodes(server, node_set):
+            return False
+        info = server.validate_node_set_cp(src, dst)
+        if info is None:
+            return
+        if info["status"] == "FAILED":
+            return False
+        from walt.client.transfer import run_transfer_with_node_set
+        try:
+            return run_transfer_with_node_set(**info)
+        except (KeyboardInterrupt, EOFError):
+            print()
+            print("Aborted.")
+            return False
+
 
 @WalTNode.subcommand("wait")
 class WalTNodeWait(WalTApplication):
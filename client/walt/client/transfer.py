@@ -1,11 +1,22 @@
 import select
 import socket
+import sys
 import tarfile
+from collections import defaultdict
 
+from walt.client.compression import (
+    compressed_writer,
+    decompressed_reader,
+    negotiate_compression,
+)
 from walt.client.link import connect_to_tcp_server
 from walt.client.progress import ProgressMessageProcess
 from walt.common.tcp import Requests, write_pickle, MyPickle as pickle
 
+# tar archives are streamed with large buffers to limit the number
+# of system calls
+TRANSFER_BUFSIZE = 256 * 1024
+
 
 def run_transfer_with_image(client_operand_index, **kwargs):
     if client_operand_index == 0:
@@ -27,6 +38,50 @@ def run_transfer_with_node(client_operand_index, **kwargs):
     )
 
 
+def run_transfer_with_node_set(nodes, errors, src_path, dst_name, **kwargs):
+    """Send src_path once, the server copies it to all nodes.
+    nodes is the list of node names validated by the server, errors a dict
+    node_name -> error message of nodes already discarded by the server."""
+    from walt.common.formatting import format_sentence_about_nodes
+    results = dict(errors)
+
+    def add_archive_member(archive):
+        archive.add(src_path, arcname=dst_name, filter=set_root)
+
+    def on_message(msg_thread, msg):
+        if isinstance(msg, str):
+            # the server rejected the request itself
+            msg = dict.fromkeys(nodes, msg)
+        results.update(msg)
+
+    if len(nodes) > 0:
+        run_transfer(
+            req_id=Requests.REQ_TAR_TO_NODES,
+            client_operand_index=0,
+            add_archive_member=add_archive_member,
+            read_message=PickleMessageReader.read_message,
+            on_message=on_message,
+            sample_path=src_path,
+            src_path=src_path,
+            dst_name=dst_name,
+            **kwargs
+        )
+    failures = defaultdict(list)
+    for node_name in nodes:
+        results.setdefault(node_name, "Transfer was interrupted.")
+    for node_name, result in results.items():
+        if result != "OK":
+            failures[result].append(node_name)
+    for result, node_names in failures.items():
+        print(format_sentence_about_nodes(f"%s: {result}", node_names),
+              file=sys.stderr)
+    copied = [node_name for node_name, result in results.items()
+              if result == "OK"]
+    if len(copied) > 0:
+        print(format_sentence_about_nodes("Copied to %s.", copied))
+    return len(failures) == 0
+
+
 def run_transfer_for_image_build(src_dir, **kwargs):
     req_id = Requests.REQ_TAR_FOR_IMAGE_BUILD
 
@@ -125,6 +180,12 @@ class SmartWriter:
         return self.status_ok
 
 
+def open_tar_stream(mode, fileobj):
+    archive = tarfile.open(mode=mode, fileobj=fileobj, bufsize=TRANSFER_BUFSIZE)
+    archive.copybufsize = TRANSFER_BUFSIZE
+    return archive
+
+
 def set_root(tarinfo):
     tarinfo.uid = tarinfo.gid = 0
     tarinfo.uname = tarinfo.gname = "root"
@@ -141,6 +202,8 @@ def run_file_transfer(
     def add_archive_member(archive):
         archive.add(src_path, arcname=dst_name, filter=set_root)
 
+    if client_operand_index == 0:
+        params.update(sample_path=src_path)
     return run_transfer(req_id, client_operand_index, add_archive_member, **params)
 
 
@@ -151,6 +214,7 @@ def run_transfer(
     read_message=None,
     on_message=None,
     progress_message="Transfering...",
+    sample_path=None,
     **params
 ):
     # connect to server
@@ -158,7 +222,11 @@ def run_transfer(
     # send the request id
     Requests.send_id(f, req_id)
     # wait for the READY message from the server
-    f.readline()
+    # (it may list the compressors the server supports)
+    ready_line = f.readline().decode("UTF-8")
+    compression = negotiate_compression(ready_line, f, sample_path)
+    if compression is not None:
+        params.update(compression=compression)
     # write the parameters
     write_pickle(params, f)
     # handle client-side archiving / unarchiving
@@ -175,8 +243,13 @@ def run_transfer(
                         return msg_thd.print_stdout(msg)
 
                 writer = SmartWriter(f, message_thread, read_message, on_message)
-                with tarfile.open(mode="w|", fileobj=writer) as archive:
-                    add_archive_member(archive)
+                if compression is None:
+                    with open_tar_stream("w|", writer) as archive:
+                        add_archive_member(archive)
+                else:
+                    with compressed_writer(compression, writer) as tar_writer:
+                        with open_tar_stream("w|", tar_writer) as archive:
+                            add_archive_member(archive)
                 # let the other end know we are done writing
                 writer.shutdown_write()
                 # wait the other end to close
@@ -186,7 +259,10 @@ def run_transfer(
                 return writer.get_status()
             else:
                 # client is receiving
-                with tarfile.open(mode="r|", fileobj=f) as archive:
+                reader = f
+                if compression is not None:
+                    reader = decompressed_reader(compression, f)
+                with open_tar_stream("r|", reader) as archive:
                     archive.extractall(path=params["dst_dir"])
                 return True
     except OSError as e:
@@ -68,8 +68,13 @@ class UnixServer(GenericServer):
     # listener, and run it.
     def handle_server_socket_event(self, serv_s):
         msg, ancdata, flags, peer_addr = serv_s.recvmsg(65536)
-        req_id, args, kwargs = pickle.loads(msg)
-        listener = self.get_listener(req_id)
+        req = pickle.loads(msg)
+        # the client may add a request uid after the usual
+        # (req_id, args, kwargs) triple, in order to match responses
+        # with requests when sending several ones concurrently.
+        req_id, args, kwargs = req[:3]
+        req_uid = req[3] if len(req) > 3 else None
+        listener = self.get_listener(req_id, req_uid=req_uid)
         if listener is not None:
             listener.run(serv_s, peer_addr, *args, **kwargs)
         # even if there was an issue when running this listener,
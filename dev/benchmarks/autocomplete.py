@@ -0,0 +1,95 @@
+#!dev/python.sh
+"""Benchmark of server-side shell autocompletion with 10k names.
+
+The completion index (server/walt/server/processes/main/autocomplete.py)
+is filled from a fake db with 10,000 device names and a fake image store
+with 10,000 images. The previous implementation filtered the rows of
+db.select("devices") in python on each completion; it is measured too,
+excluding the db round trip itself.
+"""
+import numpy as np
+import types
+from time import perf_counter
+
+from walt.server.processes.main import autocomplete
+
+NUM_NAMES = 10000
+NUM_USERS = 10
+NUM_CALLS = 2000
+
+
+class FakeDB:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query):
+        return self.rows
+
+    def select(self, table, **kwargs):
+        return list(self.rows)
+
+
+def fake_server():
+    names = [f"rpi-{i:05d}" for i in range(NUM_NAMES // 2)]
+    names += [f"sw-{i:05d}" for i in range(NUM_NAMES // 4)]
+    names += [f"dev-{i:05d}" for i in range(NUM_NAMES // 4)]
+    types_ = ["node"] * (NUM_NAMES // 2)
+    types_ += ["switch"] * (NUM_NAMES // 4) + ["unknown"] * (NUM_NAMES // 4)
+    rows = np.rec.fromarrays(
+        [np.array(names, dtype=object), np.array(types_, dtype=object)],
+        names="name,type",
+    )
+    images = {}
+    for i in range(NUM_NAMES):
+        user = f"user{i % NUM_USERS}"
+        images[f"{user}/image{i}:latest"] = types.SimpleNamespace(
+            user=user, name=f"image{i}"
+        )
+    server = types.SimpleNamespace(db=FakeDB(rows))
+    server.images = types.SimpleNamespace(store=images)
+    server.autocomplete_index = autocomplete.CompletionIndex(server)
+    return server
+
+
+def previous_complete_device(server, partial_token):
+    return tuple(
+        dev.name
+        for dev in server.db.select("devices")
+        if dev.name.startswith(partial_token)
+    )
+
+
+def bench(label, f, num_calls=NUM_CALLS):
+    result = f()  # the first call fills the index
+    t0 = perf_counter()
+    for _ in range(num_calls):
+        f()
+    latency = (perf_counter() - t0) / num_calls
+    print(f"{label:<40} {latency * 1e6:9.1f} us ({len(result)} results)")
+
+
+def main():
+    server = fake_server()
+    print(f"{NUM_NAMES} device names, {NUM_NAMES} images")
+    bench("previous complete_device, no db rpc",
+          lambda: previous_complete_device(server, "rpi-0012"), 50)
+    bench("complete_device",
+          lambda: autocomplete.complete_device(server, "rpi-0012"))
+    bench("complete_node (all)",
+          lambda: autocomplete.complete_node(server, ""))
+    bench("complete_set_of_nodes",
+          lambda: autocomplete.complete_set_of_nodes(server, "rpi-00001,rpi-0012"))
+    bench("complete_set_of_emitters",
+          lambda: autocomplete.complete_set_of_emitters(server, "se"))
+    bench("complete_image",
+          lambda: autocomplete.complete_image(server, None, "user3", "image13"))
+
+    def invalidate_and_complete():
+        server.autocomplete_index.invalidate_devices()
+        return autocomplete.complete_device(server, "rpi-0012")
+
+    bench("complete_device after invalidation", invalidate_and_complete, 50)
+
+
+if __name__ == "__main__":
+    main()
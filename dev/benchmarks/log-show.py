@@ -0,0 +1,85 @@
+#!dev/python.sh
+"""Benchmark of log records rendering in 'walt log show'.
+
+A canned stream of pickled log records is sent over a socketpair,
+and rendered record by record (read_log_record() and str.format_map()),
+then in batches (read_log_records() and compile_log_format()).
+"""
+import datetime
+import io
+import pickle
+import socket
+import sys
+import threading
+from time import time
+
+from walt.client.log import (
+    DEFAULT_FORMAT_STRING,
+    LogsFlowFromServer,
+    compile_log_format,
+)
+from walt.common.tcp import RWSocketFile
+
+NUM_RECORDS = 200000
+
+
+def canned_stream():
+    ts = datetime.datetime.now()
+    return b"".join(
+        pickle.dumps(
+            dict(
+                timestamp=ts,
+                issuer=f"node{i % 300}",
+                stream="experiment",
+                line=f"line number {i} with some text",
+            )
+        )
+        for i in range(NUM_RECORDS)
+    )
+
+
+def render_by_record(conn, format_string, out):
+    render = format_string.format_map
+    while True:
+        record = conn.read_log_record()
+        if record is None:
+            break
+        out.write(render(record) + "\n")
+
+
+def render_by_batch(conn, format_string, out):
+    render = compile_log_format(format_string)
+    for records in conn.read_log_records():
+        out.write("\n".join(map(render, records)) + "\n")
+
+
+def run(data, render_func, format_string):
+    s1, s2 = socket.socketpair()
+    feeder = threading.Thread(target=lambda: (s1.sendall(data), s1.close()))
+    feeder.start()
+    conn = LogsFlowFromServer.__new__(LogsFlowFromServer)
+    conn.f, conn._buf = RWSocketFile(s2), bytearray()
+    out = io.StringIO()
+    t0 = time()
+    render_func(conn, format_string, out)
+    duration = time() - t0
+    feeder.join()
+    conn.close()
+    return out.getvalue(), duration
+
+
+def main():
+    format_string = DEFAULT_FORMAT_STRING
+    if len(sys.argv) > 1:
+        format_string = sys.argv[1]
+    data = canned_stream()
+    ref_output, ref_duration = run(data, render_by_record, format_string)
+    output, duration = run(data, render_by_batch, format_string)
+    assert output == ref_output
+    print(f"{NUM_RECORDS} records, format {format_string!r}")
+    print(f"by record: {NUM_RECORDS / ref_duration:8.0f} records/s")
+    print(f"by batch:  {NUM_RECORDS / duration:8.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
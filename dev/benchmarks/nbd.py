@@ -0,0 +1,158 @@
+#!dev/python.sh
+"""Benchmark of the NBD swap server (server/walt/server/services/nbd.py).
+
+The server runs in a subprocess, on a free TCP port. For 1, 8 and 32
+concurrent clients (python threads), each client sends random 4 KiB
+requests (70% reads, 30% writes) on its swap export, keeping
+QUEUE_DEPTH requests in flight, then a sequence of 128 KiB writes.
+The total number of operations per second (and MiB/s) is reported.
+"""
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from time import perf_counter
+
+NUM_CLIENTS = (1, 8, 32)
+NUM_RANDOM_OPS = 20000
+NUM_SEQUENTIAL_OPS = 2000
+QUEUE_DEPTH = 16
+RANDOM_IO_SIZE = 4096
+SEQUENTIAL_IO_SIZE = 128 * 1024
+SWAP_AREA = 256 * 1024 * 1024
+READ_RATIO = 0.7
+
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_CMD_READ, NBD_CMD_WRITE, NBD_CMD_DISC = 0, 1, 2
+
+SERVER_CODE = """\
+import sys
+import walt.server.services.nbd as nbd
+nbd.NBD_PORT = int(sys.argv[1])
+nbd.run()
+"""
+
+
+def start_server():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    server = subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port)])
+    return server, port
+
+
+class Client:
+    def __init__(self, port):
+        while True:
+            try:
+                self.s = socket.create_connection(("127.0.0.1", port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)  # server not listening yet
+        self.f = self.s.makefile("rwb")
+        self.read(18)
+        self.f.write(struct.pack("!I", 3))
+        name = b"swap-1G"
+        data = struct.pack("!I", len(name)) + name + struct.pack("!H", 0)
+        self.f.write(struct.pack("!8sII", b"IHAVEOPT", 7, len(data)) + data)
+        self.f.flush()
+        while True:
+            magic, opt, rep, length = struct.unpack("!QIII", self.read(20))
+            self.read(length)
+            if rep == 1:
+                break
+        self.pending = {}
+
+    def read(self, length):
+        data = self.f.read(length)
+        assert len(data) == length
+        return data
+
+    def send(self, cookie, req_type, offset, length, data=b""):
+        self.f.write(struct.pack("!IHHQQI", NBD_REQUEST_MAGIC, 0, req_type,
+                                 cookie, offset, length) + data)
+        self.pending[cookie] = (req_type, length)
+
+    def recv_one(self):
+        magic, error, cookie = struct.unpack("!IIQ", self.read(16))
+        assert error == 0
+        req_type, length = self.pending.pop(cookie)
+        if req_type == NBD_CMD_READ:
+            self.read(length)
+
+    def run_ops(self, ops):
+        for cookie, op in enumerate(ops):
+            if len(self.pending) == QUEUE_DEPTH:
+                self.f.flush()
+                self.recv_one()
+            self.send(cookie, *op)
+        self.f.flush()
+        while len(self.pending) > 0:
+            self.recv_one()
+
+    def disconnect(self):
+        self.send(0, NBD_CMD_DISC, 0, 0)
+        self.f.flush()
+        self.s.close()
+
+
+def random_ops(rnd, num_ops):
+    data = rnd.randbytes(RANDOM_IO_SIZE)
+    for _ in range(num_ops):
+        offset = rnd.randrange(SWAP_AREA // RANDOM_IO_SIZE) * RANDOM_IO_SIZE
+        if rnd.random() < READ_RATIO:
+            yield (NBD_CMD_READ, offset, RANDOM_IO_SIZE)
+        else:
+            yield (NBD_CMD_WRITE, offset, RANDOM_IO_SIZE, data)
+
+
+def sequential_ops(rnd, num_ops):
+    data = rnd.randbytes(SEQUENTIAL_IO_SIZE)
+    for i in range(num_ops):
+        offset = (i * SEQUENTIAL_IO_SIZE) % SWAP_AREA
+        yield (NBD_CMD_WRITE, offset, SEQUENTIAL_IO_SIZE, data)
+
+
+def bench(port, num_clients, gen_ops, num_ops, io_size):
+    clients = [Client(port) for _ in range(num_clients)]
+    ops = [list(gen_ops(random.Random(i), num_ops // num_clients))
+           for i in range(num_clients)]
+    threads = [threading.Thread(target=client.run_ops, args=(client_ops,))
+               for client, client_ops in zip(clients, ops)]
+    t0 = perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = perf_counter() - t0
+    for client in clients:
+        client.disconnect()
+    total_ops = sum(len(client_ops) for client_ops in ops)
+    return total_ops / duration, total_ops * io_size / duration / (1 << 20)
+
+
+def main():
+    server, port = start_server()
+    try:
+        print(f"queue depth {QUEUE_DEPTH} per client")
+        for num_clients in NUM_CLIENTS:
+            random_iops, random_mibs = bench(
+                port, num_clients, random_ops, NUM_RANDOM_OPS, RANDOM_IO_SIZE)
+            seq_iops, seq_mibs = bench(
+                port, num_clients, sequential_ops, NUM_SEQUENTIAL_OPS,
+                SEQUENTIAL_IO_SIZE)
+            print(f"{num_clients:>3} clients: random 4 KiB r/w "
+                  f"{random_iops:8.0f} ops/s ({random_mibs:6.1f} MiB/s) | "
+                  f"sequential 128 KiB writes {seq_iops:6.0f} ops/s "
+                  f"({seq_mibs:6.1f} MiB/s)")
+    finally:
+        server.kill()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
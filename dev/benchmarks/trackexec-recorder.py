@@ -0,0 +1,111 @@
+#!dev/python.sh
+"""Benchmark of trackexec recorder backends (server/walt/server/trackexec/recorder.py).
+
+Two workloads defined in this script are run without recorder, then
+recorded (in module mode) by the sys.settrace() backend and, with
+python >= 3.12, by the sys.monitoring backend:
+- "walt code": recursive calls, generators and exceptions, i.e. code
+  where all lines are recorded;
+- "library calls": a walt-like function mostly calling the standard
+  library (json, re, ipaddress, datetime, pathlib, textwrap), i.e. code
+  which is mostly filtered out by the recorder.
+"""
+import datetime
+import ipaddress
+import json
+import re
+import shutil
+import sys
+import tempfile
+import textwrap
+from pathlib import Path, PurePosixPath
+from time import perf_counter
+
+from walt.server.trackexec.recorder import MonitoringRecorder, SetTraceRecorder
+
+NUM_ROUNDS = 5
+NUM_WALT_CODE_ITERATIONS = 500
+NUM_LIBRARY_CALLS_ITERATIONS = 5000
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def gen_items(n):
+    for i in range(n):
+        yield i * 2
+
+
+def may_fail(i):
+    if i % 3 == 0:
+        raise ValueError(i)
+    return i
+
+
+def walt_code(n):
+    total = 0
+    for i in range(n):
+        total += fib(10)
+        total += sum(gen_items(20))
+        try:
+            total += may_fail(i)
+        except ValueError:
+            total += 1
+    return total
+
+
+def describe_node(i):
+    ip = ipaddress.ip_address(f"192.168.{i % 250}.{i % 200 + 1}")
+    path = PurePosixPath("/var/lib/walt/images") / f"img{i}" / "rootfs"
+    booted = datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=i)
+    info = dict(name=f"node{i}", ip=str(ip), path=str(path.parent),
+                booted=booted.isoformat(), model="rpi-3-b-plus")
+    text = json.dumps(info, indent=2, sort_keys=True)
+    text = re.sub(r"node(\d+)", lambda m: f"N{m.group(1)}", text)
+    return textwrap.fill(text, width=40)
+
+
+def library_calls(n):
+    return sum(len(describe_node(i)) for i in range(n))
+
+
+def bench(workload, num_iterations, recorder_cls):
+    best = None
+    for _ in range(NUM_ROUNDS):
+        tmp_dir = Path(tempfile.mkdtemp())
+        t0 = perf_counter()
+        if recorder_cls is not None:
+            recorder_cls.record(sys.modules[__name__], tmp_dir / "trackexec")
+        workload(num_iterations)
+        if recorder_cls is not None:
+            recorder_cls.stop()
+        duration = perf_counter() - t0
+        shutil.rmtree(tmp_dir)
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    recorders = [("settrace", SetTraceRecorder)]
+    if sys.version_info >= (3, 12):
+        recorders.append(("monitoring", MonitoringRecorder))
+    print(f"python {sys.version.split()[0]}, best of {NUM_ROUNDS} rounds")
+    for label, workload, num_iterations in (
+        ("walt code", walt_code, NUM_WALT_CODE_ITERATIONS),
+        ("library calls", library_calls, NUM_LIBRARY_CALLS_ITERATIONS),
+    ):
+        base = bench(workload, num_iterations, None)
+        line = f"{label:>13}: no recorder {base * 1000:7.1f}ms"
+        for rec_label, recorder_cls in recorders:
+            duration = bench(workload, num_iterations, recorder_cls)
+            line += (f" | {rec_label} {duration * 1000:7.1f}ms"
+                     f" (x{duration / base:.1f})")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!dev/python.sh
+"""Benchmark of tar stream compression (client/walt/client/compression.py).
+
+For several kinds of data (a source tree, binaries, random bytes), the
+tar stream is compressed with each level of each compressor listed in
+COMPRESSION_LEVELS (the level selected by probe_compression_level() is
+marked with '*'), and decompressed. The transfer time over a link of
+10, 100 and 1000 Mbit/s is then estimated, considering compression,
+transfer and decompression are pipelined (i.e., the slowest of the
+three is the bottleneck).
+"""
+import io
+import os
+import tarfile
+from pathlib import Path
+from time import perf_counter
+
+from walt.client.compression import (
+    COMPRESSION_LEVELS,
+    COMPRESSION_SAMPLE_SIZE,
+    _import_compressor,
+    compressed_writer,
+    decompressed_reader,
+    probe_compression_level,
+)
+
+LINK_SPEEDS_MBITS = (10, 100, 1000)
+MAX_DATA_SIZE = 32 * 1024 * 1024
+RANDOM_DATA_SIZE = 16 * 1024 * 1024
+READ_SIZE = 256 * 1024
+
+
+def tar_bytes(path, excluded=()):
+    buf = io.BytesIO()
+    with tarfile.open(mode="w|", fileobj=buf) as tar:
+        for file_path in sorted(Path(path).rglob("*")):
+            if excluded and excluded & set(file_path.parts):
+                continue
+            if file_path.is_file() and not file_path.is_symlink():
+                tar.add(file_path, recursive=False)
+            if buf.tell() >= MAX_DATA_SIZE:
+                break
+    return buf.getvalue()
+
+
+def get_data_sets():
+    repo_root = Path(__file__).resolve().parents[2]
+    return {
+        "source tree": tar_bytes(repo_root, excluded={".git", ".venv"}),
+        "binaries": tar_bytes("/usr/bin"),
+        "random": os.urandom(RANDOM_DATA_SIZE),
+    }
+
+
+def measure(compression, data):
+    """Return (compressed size, compression time, decompression time)."""
+    t0 = perf_counter()
+    buf = io.BytesIO()
+    with compressed_writer(compression, buf) as writer:
+        for offset in range(0, len(data), READ_SIZE):
+            writer.write(data[offset:offset + READ_SIZE])
+    compression_time = perf_counter() - t0
+    compressed_size = buf.tell()
+    buf.seek(0)
+    t0 = perf_counter()
+    reader = decompressed_reader(compression, buf)
+    decompressed_size = 0
+    while True:
+        chunk = reader.read(READ_SIZE)
+        if len(chunk) == 0:
+            break
+        decompressed_size += len(chunk)
+    decompression_time = perf_counter() - t0
+    assert decompressed_size == len(data)
+    return compressed_size, compression_time, decompression_time
+
+
+def print_row(label, data_size, compressed_size, *cpu_times):
+    ratio = data_size / compressed_size
+    line = f"  {label:<9} ratio {ratio:5.2f}"
+    for speed in LINK_SPEEDS_MBITS:
+        link_time = compressed_size * 8 / (speed * 1000 * 1000)
+        line += f" | {speed:>4} Mbit/s {max(link_time, *cpu_times):6.2f}s"
+    print(line)
+
+
+def main():
+    for data_label, data in get_data_sets().items():
+        print(f"{data_label} ({len(data) / 2**20:.1f} MiB)")
+        print_row("none", len(data), len(data), 0)
+        for name, levels in COMPRESSION_LEVELS.items():
+            if _import_compressor(name) is None:
+                print(f"  {name}: python module not installed")
+                continue
+            probed_level = probe_compression_level(
+                name, data[:COMPRESSION_SAMPLE_SIZE]
+            )
+            for level in levels:
+                mark = "*" if level == probed_level else ""
+                label = f"{name}-{level}{mark}"
+                print_row(label, len(data), *measure((name, level), data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!dev/python.sh
+"""Benchmark of fake TFTP transfers (NodeFakeTFTPGet in
+server/walt/server/processes/main/transfer.py).
+
+This simulates many nodes requesting a boot file at the same time:
+for 1, 20 and 100 clients, each client thread sends its request over
+a socketpair, and the server side listeners run in the event loop of
+the main thread. This is measured with a small file (dtb) and a larger
+one (kernel), with the current implementation (os.sendfile() from the
+event loop) and with the previous one (one forked 'cat' process per
+request).
+"""
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from time import perf_counter
+
+from walt.common.evloop import EventLoop
+from walt.common.tcp import RWSocketFile, write_pickle
+from walt.server.processes.main import transfer
+from walt.server.processes.main.parallel import ParallelProcessSocketListener
+from walt.server.processes.main.transfer import NodeFakeTFTPGet
+
+NUM_CLIENTS = (1, 20, 100)
+BOOT_FILES = {"/dtb": 64 * 1024, "/kernel": 8 * 1024 * 1024}
+NODE_MAC = "52:54:00:12:34:56"
+RECV_SIZE = 256 * 1024
+
+
+class ForkingFakeTFTPGet(ParallelProcessSocketListener):
+    """NodeFakeTFTPGet with the previous implementation."""
+
+    def prepare(self, node_mac=None, **params):
+        params["node_id"] = node_mac
+        full_path = (transfer.NODE_TFTP_ROOT + "%(path)s") % params
+        self.send_client("OK\n")
+        self.send_client(str(os.stat(full_path).st_size) + "\n")
+        self.params["full_path"] = full_path
+        return True
+
+    def get_command(self, **params):
+        return 'cat "%(full_path)s"' % params
+
+
+def client(sock, path, expected_size):
+    f = RWSocketFile(sock)
+    assert f.readline() == b"READY\n"
+    write_pickle(dict(node_mac=NODE_MAC, path=path), f)
+    assert f.readline() == b"OK\n"
+    size = int(f.readline())
+    assert size == expected_size
+    while size > 0:
+        chunk = f.read1(min(size, RECV_SIZE))
+        assert len(chunk) > 0
+        size -= len(chunk)
+    f.close()
+
+
+def bench(listener_cls, num_clients, path):
+    ev_loop = EventLoop()
+    threads = []
+    t0 = perf_counter()
+    for _ in range(num_clients):
+        server_sock, client_sock = socket.socketpair()
+        listener = listener_cls(ev_loop, RWSocketFile(server_sock))
+        ev_loop.register_listener(listener)
+        thread = threading.Thread(
+            target=client, args=(client_sock, path, BOOT_FILES[path])
+        )
+        thread.start()
+        threads.append(thread)
+    ev_loop.loop(lambda: any(thread.is_alive() for thread in threads))
+    for thread in threads:
+        thread.join()
+    return perf_counter() - t0
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    transfer.NODE_TFTP_ROOT = tmp_dir + "/%(node_id)s/tftp"
+    tftp_dir = transfer.NODE_TFTP_ROOT % dict(node_id=NODE_MAC)
+    os.makedirs(tftp_dir)
+    for path, size in BOOT_FILES.items():
+        with open(tftp_dir + path, "wb") as f:
+            f.write(os.urandom(size))
+    try:
+        for path, size in BOOT_FILES.items():
+            print(f"{path[1:]} ({size // 1024} KiB)")
+            for num_clients in NUM_CLIENTS:
+                line = f"{num_clients:>5} clients"
+                for label, listener_cls in (("cat", ForkingFakeTFTPGet),
+                                            ("sendfile", NodeFakeTFTPGet)):
+                    duration = bench(listener_cls, num_clients, path)
+                    line += (f" | {label} {num_clients / duration:7.0f} req/s"
+                             f" ({num_clients * size / duration / 2**20:6.0f} MiB/s)")
+                print(line)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!dev/python.sh
+"""Benchmark of client tar streams
+(open_tar_stream() in client/walt/client/transfer.py).
+
+A 2 GiB file is transferred as a tar archive over a local socketpair,
+in both directions, with a 'tar' process at the other end (as on the
+server side of 'walt image cp' and 'walt node cp'):
+- receiving: 'tar c' writes to the socket, and the client extracts the
+  archive with open_tar_stream("r|", ...);
+- sending: the client archives the file with open_tar_stream("w|", ...),
+  and 'tar x' reads from the socket.
+The same is measured with tarfile's default buffer sizes.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tarfile
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from walt.client.transfer import open_tar_stream
+from walt.common.tcp import RWSocketFile
+
+FILE_SIZE = 2 * 1024 * 1024 * 1024
+CHUNK_SIZE = 4 * 1024 * 1024
+FILE_NAME = "big.bin"
+
+
+def open_default_tar_stream(mode, fileobj):
+    return tarfile.open(mode=mode, fileobj=fileobj)
+
+
+def create_file(path):
+    chunk = os.urandom(CHUNK_SIZE)
+    with open(path, "wb") as f:
+        for _ in range(FILE_SIZE // CHUNK_SIZE):
+            f.write(chunk)
+
+
+def bench_receive(open_stream, src_dir, dst_dir):
+    shutil.rmtree(dst_dir, ignore_errors=True)
+    dst_dir.mkdir()
+    client_s, server_s = socket.socketpair()
+    t0 = perf_counter()
+    tar = subprocess.Popen(["tar", "c", "-C", str(src_dir), FILE_NAME],
+                           stdout=server_s.fileno())
+    server_s.close()
+    f = RWSocketFile(client_s)
+    with open_stream("r|", f) as archive:
+        archive.extractall(path=dst_dir)
+    duration = perf_counter() - t0
+    tar.wait()
+    f.close()
+    assert (dst_dir / FILE_NAME).stat().st_size == FILE_SIZE
+    return FILE_SIZE / duration
+
+
+def bench_send(open_stream, src_dir, dst_dir):
+    shutil.rmtree(dst_dir, ignore_errors=True)
+    dst_dir.mkdir()
+    client_s, server_s = socket.socketpair()
+    t0 = perf_counter()
+    tar = subprocess.Popen(["tar", "x", "-C", str(dst_dir)],
+                           stdin=server_s.fileno())
+    server_s.close()
+    f = RWSocketFile(client_s)
+    with open_stream("w|", f) as archive:
+        archive.add(src_dir / FILE_NAME, arcname=FILE_NAME)
+    f.shutdown(socket.SHUT_WR)
+    tar.wait()
+    duration = perf_counter() - t0
+    f.close()
+    assert (dst_dir / FILE_NAME).stat().st_size == FILE_SIZE
+    return FILE_SIZE / duration
+
+
+def main():
+    tmp_dir = Path(tempfile.mkdtemp())
+    src_dir, dst_dir = tmp_dir / "src", tmp_dir / "dst"
+    src_dir.mkdir()
+    try:
+        create_file(src_dir / FILE_NAME)
+        print(f"{FILE_SIZE // 2**20} MiB file")
+        for label, open_stream in (("default buffers", open_default_tar_stream),
+                                   ("open_tar_stream", open_tar_stream)):
+            recv_speed = bench_receive(open_stream, src_dir, dst_dir)
+            send_speed = bench_send(open_stream, src_dir, dst_dir)
+            print(f"{label:>15}: receive {recv_speed / 1e9:5.2f} GB/s"
+                  f" | send {send_speed / 1e9:5.2f} GB/s")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!dev/python.sh
+"""Benchmark of the VPN endpoint transmission loop (server/walt/server/ext/vpn.c).
+
+_vpn_endpoint_transmission_loop(tap_fd) is run in a subprocess, as
+walt-server-vpn-endpoint does, with its stdin and stdout connected to
+pipes (in place of the ssh channel) and with one end of a SOCK_DGRAM
+socketpair in place of the tap interface (1 datagram = 1 packet).
+For several packet sizes, packets are sent in each direction and the
+number of packets per second is measured when the last one is received.
+"""
+import os
+import socket
+import subprocess
+import sys
+import threading
+from time import perf_counter
+
+NUM_PACKETS = 200000
+PACKET_SIZES = (64, 512, 1400)
+LENGTH_SIZE = 2
+CHUNK_SIZE = 1 << 20
+
+CHILD_CODE = """\
+import sys
+from walt.server.ext._c_ext.lib import _vpn_endpoint_transmission_loop
+_vpn_endpoint_transmission_loop(int(sys.argv[1]))
+"""
+
+
+def start_endpoint():
+    tap, endpoint_tap = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    child = subprocess.Popen(
+        [sys.executable, "-c", CHILD_CODE, str(endpoint_tap.fileno())],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        pass_fds=[endpoint_tap.fileno()],
+    )
+    endpoint_tap.close()
+    tap.settimeout(10)
+    return tap, child
+
+
+def send_packets_on_tap(tap, packet):
+    for _ in range(NUM_PACKETS):
+        tap.send(packet)
+
+
+def bench_tap_to_ssh(tap, child, packet):
+    t0 = perf_counter()
+    thread = threading.Thread(target=send_packets_on_tap, args=(tap, packet))
+    thread.start()
+    expected_size = NUM_PACKETS * (LENGTH_SIZE + len(packet))
+    ssh_fd = child.stdout.fileno()
+    received = []
+    received_size = 0
+    while received_size < expected_size:
+        chunk = os.read(ssh_fd, CHUNK_SIZE)
+        assert len(chunk) > 0
+        received.append(chunk)
+        received_size += len(chunk)
+    duration = perf_counter() - t0
+    thread.join()
+    data = b"".join(received)
+    assert len(data) == expected_size
+    assert data[:LENGTH_SIZE + len(packet)] == (
+        len(packet).to_bytes(LENGTH_SIZE, "big") + packet
+    )
+    return NUM_PACKETS / duration
+
+
+def write_packets_on_ssh_channel(child, packet):
+    frame = len(packet).to_bytes(LENGTH_SIZE, "big") + packet
+    frames_per_chunk = CHUNK_SIZE // len(frame)
+    chunk = frame * frames_per_chunk
+    num_chunks, remainder = divmod(NUM_PACKETS, frames_per_chunk)
+    for _ in range(num_chunks):
+        child.stdin.write(chunk)
+    child.stdin.write(frame * remainder)
+    child.stdin.flush()
+
+
+def bench_ssh_to_tap(tap, child, packet):
+    t0 = perf_counter()
+    thread = threading.Thread(
+        target=write_packets_on_ssh_channel, args=(child, packet)
+    )
+    thread.start()
+    buf = bytearray(2048)
+    for _ in range(NUM_PACKETS):
+        assert tap.recv_into(buf) == len(packet)
+    duration = perf_counter() - t0
+    thread.join()
+    assert buf[:len(packet)] == packet
+    return NUM_PACKETS / duration
+
+
+def main():
+    tap, child = start_endpoint()
+    try:
+        print(f"{NUM_PACKETS} packets per size and direction")
+        for size in PACKET_SIZES:
+            packet = os.urandom(size)
+            tap_to_ssh = bench_tap_to_ssh(tap, child, packet)
+            ssh_to_tap = bench_ssh_to_tap(tap, child, packet)
+            print(f"{size:>5} bytes: tap -> ssh {tap_to_ssh / 1000:7.1f}k packets/s"
+                  f" | ssh -> tap {ssh_to_tap / 1000:7.1f}k packets/s")
+    finally:
+        child.kill()
+        child.wait()
+        tap.close()
+
+
+if __name__ == "__main__":
+    main()
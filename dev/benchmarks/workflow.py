@@ -0,0 +1,93 @@
+#!dev/python.sh
+"""Benchmark of server workflows (server/walt/server/processes/main/workflow.py).
+
+1,000 workflows of 50 steps each are run with an env of about twenty keys,
+including a 1,000-node recarray and an image list. Steps mix wf.next(),
+wf.update_env() and wf.next(**kwargs) calls.
+The same workflows are also run with the previous implementation of
+Workflow.next(), which copied the env and the list of steps on each step.
+"""
+import numpy as np
+from time import perf_counter
+
+from walt.server.processes.main.workflow import Workflow
+
+NUM_NODES = 1000
+NUM_WORKFLOWS = 1000
+NUM_ROUNDS = 5
+
+
+class CopyingWorkflow(Workflow):
+    """Workflow with the previous implementation of next()."""
+
+    def __init__(self, steps, **env):
+        Workflow.__init__(self, steps, **env)
+        self._steps = list(steps)
+
+    def next(self, *args, **kwargs):
+        if len(self._steps) > 0:
+            step, self._steps = self._steps[0], self._steps[1:]
+            env = self._env.copy()
+            env.update(**kwargs)
+            step(self, *args, **env)
+        elif not self.done:
+            end_callbacks = self._end_callbacks
+            self._end_callbacks = None
+            for cb in end_callbacks:
+                cb()
+            del Workflow._instances[self._id]
+
+
+def step_plain(wf, nodes, **env):
+    wf.next()
+
+
+def step_update_env(wf, counter, **env):
+    wf.update_env(counter=counter + 1)
+    wf.next()
+
+
+def step_next_kwargs(wf, **env):
+    wf.next(extra=1)
+
+
+def step_recv_kwargs(wf, extra=None, **env):
+    wf.next()
+
+
+STEPS = [step_plain, step_update_env, step_next_kwargs, step_recv_kwargs,
+         step_plain] * 10
+
+
+def bench(wf_cls, env):
+    best = None
+    for _ in range(NUM_ROUNDS):
+        t0 = perf_counter()
+        for _ in range(NUM_WORKFLOWS):
+            wf = wf_cls(STEPS, **env)
+            wf.run()
+            assert wf.done
+        duration = perf_counter() - t0
+        if best is None or duration < best:
+            best = duration
+    return best / (NUM_WORKFLOWS * len(STEPS))
+
+
+def main():
+    Workflow.trace.enabled = False
+    nodes = np.rec.fromarrays(
+        [np.arange(NUM_NODES), np.array([f"node{i}" for i in range(NUM_NODES)])],
+        names="id,name",
+    )
+    env = dict(nodes=nodes, images=[f"image{i}" for i in range(200)], counter=0)
+    env.update({f"key{i}": i for i in range(20)})
+    print(f"{NUM_WORKFLOWS} workflows of {len(STEPS)} steps, "
+          f"{NUM_NODES} nodes, {len(env)} env keys")
+    for label, wf_cls in (("previous", CopyingWorkflow), ("current", Workflow)):
+        print(f"{label:>8}: {bench(wf_cls, env) * 1e6:.2f} us/step")
+    Workflow.trace.enabled = True
+    print(f"current, traced: {bench(Workflow, env) * 1e6:.2f} us/step")
+
+
+if __name__ == "__main__":
+    main()
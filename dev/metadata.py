@@ -29,7 +29,10 @@ PACKAGE_SPECIFIC_INFO = {
             "walt-common==%(walt_version)s",
             "walt-doc==%(walt_version)s",
         ],
-        extras_require={"g5k": ["walt-client-g5k==%(walt_version)s"]},
+        extras_require={
+            "g5k": ["walt-client-g5k==%(walt_version)s"],
+            "compression": ["zstandard>=0.22.0", "lz4>=4.3.2"],
+        },
         version_str="%(walt_version)s",
         setup=dict(
             description="WalT control tool.",
@@ -92,6 +95,7 @@ PACKAGE_SPECIFIC_INFO = {
             "numpy>=1.24.3",
             "numba>=0.58.1",
             "cffi>=1.16.0",
+            "cryptography>=42.0.0",
             "dnspython>=2.7.0",
             "walt-client==%(walt_version)s",
             "walt-common==%(walt_version)s",
@@ -113,6 +117,8 @@ PACKAGE_SPECIFIC_INFO = {
                     "walt-server-nbd = walt.server.services.nbd:run",
                     "walt-server-trackexec-replay = walt.server.trackexec.player:run",
                     "walt-server-trackexec-analyse = walt.server.trackexec.analyse:run",
+                    "walt-server-trackexec-export = walt.server.trackexec.export:run",
+                    "walt-server-trace-workflows = walt.server.wftrace:run",
                     "walt-dhcp-event = walt.server.dhcpevent:run",
                     "walt-net-config = walt.server.netconfig:run",
                     "walt-image-check = walt.server.imagecheck:run",
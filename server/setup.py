@@ -85,6 +85,8 @@ setup_info = {
             "walt-server-nbd = walt.server.services.nbd:run",
             "walt-server-trackexec-replay = walt.server.trackexec.player:run",
             "walt-server-trackexec-analyse = walt.server.trackexec.analyse:run",
+            "walt-server-trackexec-export = walt.server.trackexec.export:run",
+            "walt-server-trace-workflows = walt.server.wftrace:run",
             "walt-dhcp-event = walt.server.dhcpevent:run",
             "walt-net-config = walt.server.netconfig:run",
             "walt-image-check = walt.server.imagecheck:run",
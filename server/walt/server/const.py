@@ -16,6 +16,9 @@ SSH_NODE_COMMAND = (
 )
 SSH_DEVICE_COMMAND = "walt-device-ssh"
 WALT_NODE_NET_SERVICE_PORT = 12346
+WALT_SERVER_HEARTBEAT_PORT = 12343  # UDP
+NODE_HEARTBEAT_PERIOD = 5
+NODE_HEARTBEAT_ACK_TIMEOUT = 3
 SERVER_SNMP_CONF = dict(version=2, community="private")
 UNIX_SERVER_SOCK_PATH = "/var/run/walt/walt-server/walt-server.socket"
 PODMAN_API_SOCK_PATH = "/run/walt/podman/podman.socket"
@@ -9,6 +9,8 @@ void _regfree(void *preg);
 char *_regerror_alloc(char *regex);
 void free(void *ptr);
 void _vpn_endpoint_transmission_loop(int tap_fd);
+int _punch_hole(int fd, long offset, long len);
+int _zero_range(int fd, long offset, long len);
 """
 
 ffibuilder.cdef(PROTOTYPES)
@@ -17,7 +19,8 @@ ffibuilder.set_source(
     "walt.server.ext._c_ext",  # name of the output C extension
     PROTOTYPES,
     sources=["walt/server/ext/posix_regex.c",
-             "walt/server/ext/vpn.c"],
+             "walt/server/ext/vpn.c",
+             "walt/server/ext/fallocate.c"],
 )
 
 if __name__ == "__main__":
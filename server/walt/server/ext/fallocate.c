@@ -0,0 +1,24 @@
+#define _GNU_SOURCE
+#include <fcntl.h>
+#include <errno.h>
+
+/* Deallocate a range of a file: subsequent reads return zeros
+ * and the underlying disk space is released.
+ * Returns 0 on success, -errno on failure. */
+int _punch_hole(int fd, long offset, long len) {
+    if (fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                  offset, len) == -1) {
+        return -errno;
+    }
+    return 0;
+}
+
+/* Zero a range of a file, keeping the underlying disk space allocated.
+ * Returns 0 on success, -errno on failure. */
+int _zero_range(int fd, long offset, long len) {
+    if (fallocate(fd, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE,
+                  offset, len) == -1) {
+        return -errno;
+    }
+    return 0;
+}
@@ -1,4 +1,5 @@
-#include <sys/select.h>
+#define _GNU_SOURCE
+#include <sys/epoll.h>
 #include <sys/time.h>
 #include <sys/types.h>
 #include <sys/stat.h>
@@ -12,6 +13,7 @@
 #include <stdlib.h>
 #include <assert.h>
 #include <string.h>
+#include <poll.h>
 
 //#define DEBUG
 #ifdef DEBUG
@@ -50,54 +52,6 @@ static void redirect_sigint() {
 /* note: ternary op in this macro is just here to avoid warn unused result */
 #define write_stderr(msg) (void)(write(2, msg, strlen(msg))?1:0)
 
-static inline int read_fd_once(int fd, unsigned char *start, ssize_t max_size,
-                                 ssize_t *out_length, char *fd_label) {
-    ssize_t sres;
-    sres = read(fd, start, max_size);
-    if (sres < 1) {
-        if (fd_label) {
-            if (sres == 0) {
-                write_stderr("short read on ");
-                write_stderr(fd_label);
-                write_stderr("\n");
-            }
-            else {
-                write_stderr(fd_label);
-                write_stderr(" read error\n");
-            }
-        }
-        return -1;
-    }
-    start += sres;
-    if (out_length != NULL) {
-        *out_length = sres;
-    }
-    return 0;
-}
-
-static inline int write_fd(int fd, unsigned char *start, unsigned char *end,
-                            char *fd_label) {
-    ssize_t sres;
-    while (start < end) {
-        sres = write(fd, start, end - start);
-        if (fd_label) {
-            if (sres == 0) {
-                write_stderr("short write on ");
-                write_stderr(fd_label);
-                write_stderr("\n");
-            }
-            if (sres == -1) {
-                write_stderr(fd_label);
-                write_stderr(" write error\n");
-                return -1;
-            }
-        }
-        start += sres;
-    }
-    return 0;
-}
-
-
 static void *malloc_or_abort(size_t size) {
     void *res = malloc(size);
     if (res == NULL) {
@@ -245,59 +199,193 @@ static inline void store_packet_len(unsigned char *len_pos, ssize_t sres) {
     len_pos[1] = (unsigned char)(sres & 0xff);
 }
 
+/* when a tap packet is available, we read up to TAP_BATCH_SIZE packets
+ * (or less, if no more are pending) and send them on the ssh channel
+ * with a single writev() call */
+#define TAP_BATCH_SIZE      64
+/* the default pipe capacity (64k) is small compared to what a full batch
+ * of packets may use, so we try to enlarge the pipes of the ssh channel */
+#define PIPE_BUFFER_SIZE    (1<<20)
+
+#ifndef F_SETPIPE_SZ
+#define F_SETPIPE_SZ        1031
+#endif
+
+static void enlarge_pipe(int fd) {
+    /* this fails if fd is not a pipe or if PIPE_BUFFER_SIZE is above
+     * /proc/sys/fs/pipe-max-size for an unprivileged process;
+     * in this case we just keep the default capacity */
+    (void)fcntl(fd, F_SETPIPE_SZ, PIPE_BUFFER_SIZE);
+}
+
+static int set_non_blocking(int fd) {
+    int flags = fcntl(fd, F_GETFL);
+    if (flags == -1) {
+        return -1;
+    }
+    return fcntl(fd, F_SETFL, flags | O_NONBLOCK);
+}
+
+static inline int writev_fd(int fd, struct iovec *iov, int iovcnt,
+                            char *fd_label) {
+    ssize_t sres;
+    while (iovcnt > 0) {
+        sres = writev(fd, iov, iovcnt);
+        if (sres < 1) {
+            if (sres == -1 && errno == EINTR) {
+                continue;
+            }
+            write_stderr(fd_label);
+            write_stderr(" write error\n");
+            return -1;
+        }
+        /* handle partial writes */
+        while (iovcnt > 0 && (size_t)sres >= iov->iov_len) {
+            sres -= iov->iov_len;
+            iov++;
+            iovcnt--;
+        }
+        if (iovcnt > 0) {
+            iov->iov_base = (unsigned char *)iov->iov_base + sres;
+            iov->iov_len -= sres;
+        }
+    }
+    return 0;
+}
+
+/* read pending packets on tap (up to TAP_BATCH_SIZE) and write them to
+ * ssh channel, each one prefixed with its length */
+static int tap_to_ssh(int tap_fd, int ssh_write_fd, unsigned char *bufs,
+                      struct iovec *iov) {
+    unsigned char *buf;
+    ssize_t sres;
+    int num_packets;
+    for (num_packets = 0; num_packets < TAP_BATCH_SIZE; num_packets++) {
+        buf = bufs + num_packets * PACKET_BUFFER_SIZE;
+        /* when reading on tap, 1 read() means 1 packet */
+        sres = read(tap_fd, buf + LENGTH_SIZE, ETHERNET_MAX_SIZE);
+        if (sres == -1 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+            break;  // no more pending packets
+        }
+        if (sres == -1 && errno == EINTR) {
+            break;
+        }
+        if (sres < 1) {
+            if (sres == 0) {
+                write_stderr("short read on tap\n");
+            }
+            else {
+                write_stderr("tap read error\n");
+            }
+            return -1;
+        }
+        /* prefix packet length as 2 bytes, big endian */
+        store_packet_len(buf, sres);
+        iov[num_packets].iov_base = buf;
+        iov[num_packets].iov_len = LENGTH_SIZE + sres;
+    }
+    if (num_packets == 0) {
+        return 0;
+    }
+    /* write packets to ssh stdin */
+    if (writev_fd(ssh_write_fd, iov, num_packets, "ssh channel") == -1) {
+        return -2;
+    }
+    return 0;
+}
+
+static int cbuf_flush_to_tap(circular_buffer_t *cbuf, int size, int tap_fd) {
+    struct pollfd pfd;
+    while (cbuf_flush(cbuf, size, tap_fd) == -1) {
+        if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+            return -1;
+        }
+        /* tap_fd is in non-blocking mode, wait until it is writable */
+        pfd.fd = tap_fd;
+        pfd.events = POLLOUT;
+        (void)poll(&pfd, 1, -1);
+    }
+    return 0;
+}
+
 static int ssh_tap_transfer_loop(int ssh_read_fd, int ssh_write_fd, int tap_fd) {
-    unsigned char *buf_tap_to_ssh, *pos_tap_to_ssh;
-    int res, max_fd;
-    ssize_t sres, packet_len;
-    fd_set fds, init_fds;
+    unsigned char *bufs_tap_to_ssh;
+    struct iovec iov_tap_to_ssh[TAP_BATCH_SIZE];
+    struct epoll_event ev, events[2];
+    int res, i, num_events, epoll_fd;
+    ssize_t packet_len;
     circular_buffer_t buf_ssh_to_tap;
 
-    /* when reading on tap, 1 read() means 1 packet */
-    buf_tap_to_ssh = malloc_or_abort(PACKET_BUFFER_SIZE * sizeof(unsigned char));
-    pos_tap_to_ssh = buf_tap_to_ssh + LENGTH_SIZE;
+    bufs_tap_to_ssh = malloc_or_abort(
+            TAP_BATCH_SIZE * PACKET_BUFFER_SIZE * sizeof(unsigned char));
     /* when reading on ssh stdout, we are reading a continuous flow */
     cbuf_setup(&buf_ssh_to_tap, BUFFER_SIZE);
 
-    redirect_sigint();
+    enlarge_pipe(ssh_read_fd);
+    enlarge_pipe(ssh_write_fd);
+    /* we read tap until no more packets are pending */
+    if (set_non_blocking(tap_fd) == -1) {
+        perror("fcntl error");
+        free(bufs_tap_to_ssh);
+        cbuf_release(&buf_ssh_to_tap);
+        return 1;
+    }
 
-    FD_ZERO(&init_fds);
-    FD_SET(ssh_read_fd, &init_fds);
-    FD_SET(tap_fd, &init_fds);
-    max_fd = MAX(ssh_read_fd, tap_fd) + 1;
+    epoll_fd = epoll_create1(EPOLL_CLOEXEC);
+    if (epoll_fd == -1) {
+        perror("epoll_create1 error");
+        free(bufs_tap_to_ssh);
+        cbuf_release(&buf_ssh_to_tap);
+        return 1;
+    }
+    ev.events = EPOLLIN;
+    ev.data.fd = ssh_read_fd;
+    res = epoll_ctl(epoll_fd, EPOLL_CTL_ADD, ssh_read_fd, &ev);
+    if (res == 0) {
+        ev.events = EPOLLIN;
+        ev.data.fd = tap_fd;
+        res = epoll_ctl(epoll_fd, EPOLL_CTL_ADD, tap_fd, &ev);
+    }
+    if (res == -1) {
+        /* e.g. EPERM if one of the fds is a regular file */
+        perror("epoll_ctl error");
+        close(epoll_fd);
+        free(bufs_tap_to_ssh);
+        cbuf_release(&buf_ssh_to_tap);
+        return 1;
+    }
 
-    /* start select loop
+    redirect_sigint();
+
+    /* start event loop
        we will:
        * transfer packets coming from the tap interface to ssh stdin
        * transfer packets coming from ssh stdout to the tap interface
     */
     status = RUNNING;
     while (status == RUNNING) {
-        fds = init_fds;
-        res = select(max_fd, &fds, NULL, NULL, NULL);
-        if (res < 1) {
-            perror("select error");
+        num_events = epoll_wait(epoll_fd, events, 2, -1);
+        if (num_events < 1) {
+            if (num_events == -1 && errno == EINTR) {
+                continue;   // status may have been updated by handle_signal()
+            }
+            perror("epoll_wait error");
             status = STOPPED_SHOULD_REINIT;  // caller should reinit
             break;
         }
-        if (FD_ISSET(tap_fd, &fds)) {
-            /* read new packet on tap */
-            res = read_fd_once(tap_fd, pos_tap_to_ssh, ETHERNET_MAX_SIZE, &sres,
-                             "tap");
-            if (res == -1) {
-                status = STOPPED_SHOULD_ABORT;
-                break;
-            }
-            /* prefix packet length as 2 bytes, big endian */
-            store_packet_len(buf_tap_to_ssh, sres);
-            /* write packet to ssh stdin */
-            res = write_fd(ssh_write_fd, buf_tap_to_ssh, pos_tap_to_ssh + sres,
-                              "ssh channel");
-            if (res == -1) {
-                status = STOPPED_SHOULD_REINIT;
-                break;
+        for (i = 0; i < num_events && status == RUNNING; i++) {
+            if (events[i].data.fd == tap_fd) {
+                /* read new packets on tap and write them to ssh stdin */
+                res = tap_to_ssh(tap_fd, ssh_write_fd,
+                                 bufs_tap_to_ssh, iov_tap_to_ssh);
+                if (res == -1) {
+                    status = STOPPED_SHOULD_ABORT;
+                }
+                if (res == -2) {
+                    status = STOPPED_SHOULD_REINIT;
+                }
+                continue;
             }
-        }
-        else {
             /* we have to read network packets from ssh stdout, but these come as a
              * continuous data flow, and we have to write them on a tap interface,
              * with one write() per packet.
@@ -323,7 +411,7 @@ static int ssh_tap_transfer_loop(int ssh_read_fd, int ssh_write_fd, int tap_fd)
                 cbuf_pass(&buf_ssh_to_tap, LENGTH_SIZE);
 
                 /* write packet on tap */
-                res = cbuf_flush(&buf_ssh_to_tap, packet_len, tap_fd);
+                res = cbuf_flush_to_tap(&buf_ssh_to_tap, packet_len, tap_fd);
                 if (res == -1) {
                     status = STOPPED_SHOULD_ABORT;
                     break;
@@ -331,7 +419,8 @@ static int ssh_tap_transfer_loop(int ssh_read_fd, int ssh_write_fd, int tap_fd)
             }
         }
     }
-    free(buf_tap_to_ssh);
+    close(epoll_fd);
+    free(bufs_tap_to_ssh);
     cbuf_release(&buf_ssh_to_tap);
     assert(status != RUNNING);
     return (status == STOPPED_SHOULD_REINIT);
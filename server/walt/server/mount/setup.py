@@ -15,6 +15,9 @@ from walt.server import spec
 from walt.server.const import (
     WALT_INTF,
     WALT_NODE_NET_SERVICE_PORT,
+    WALT_SERVER_HEARTBEAT_PORT,
+    NODE_HEARTBEAT_ACK_TIMEOUT,
+    NODE_HEARTBEAT_PERIOD,
     NODE_SSH_ECDSA_HOST_KEY_PATH,
     NODE_SSH_ECDSA_HOST_KEY_PUB_PATH,
     NODE_DROPBEAR_ECDSA_HOST_KEY_PATH,
@@ -59,6 +62,9 @@ TEMPLATE_ENV = dict(
     walt_server_logs_port=WALT_SERVER_TCP_PORT,
     walt_server_notify_bootup_port=WALT_SERVER_TCP_PORT,
     walt_node_net_service_port=WALT_NODE_NET_SERVICE_PORT,
+    walt_server_heartbeat_port=WALT_SERVER_HEARTBEAT_PORT,
+    walt_bootup_heartbeat_period=NODE_HEARTBEAT_PERIOD,
+    walt_bootup_heartbeat_ack_timeout=NODE_HEARTBEAT_ACK_TIMEOUT,
 )
 
 RESOLV_CONF = """
@@ -264,8 +270,14 @@ def _setup(image_id, mount_path, image_size_kib, img_print):
     image_bindir = mount_path + "/bin/"
     image_widir = image_bindir + '_walt_internal_/'
     Path(image_widir).mkdir(exist_ok=True)
+    # read image spec file if any
+    image_spec = spec.read_image_spec(mount_path)
+    # images declaring the "bootup-heartbeat" capability report their
+    # bootup status with UDP heartbeats instead of a permanent TCP connection
+    bootup_heartbeat = spec.image_has_capability(image_spec, "bootup-heartbeat")
     env = dict(walt_image_id=image_id,
                walt_image_size_kib=image_size_kib,
+               walt_bootup_heartbeat=int(bootup_heartbeat),
                **TEMPLATE_ENV)
     for script_name, script_info in NODE_SCRIPTS.items():
         template, internal = script_info
@@ -276,8 +288,6 @@ def _setup(image_id, mount_path, image_size_kib, img_print):
         shutil.copy(script_path(script_name), dst_dir)
         if template:
             update_template(dst_dir + script_name, env)
-    # read image spec file if any
-    image_spec = spec.read_image_spec(mount_path)
     if image_spec is not None:
         # update template files specified there
         spec.update_templates(mount_path, image_spec, env, img_print)
@@ -55,6 +55,14 @@ class CSAPI(APISession):
             context.nodes.get_nodes_info(context.requester, node_set)
         )
 
+    @api_expose_method
+    def get_nodes_info_changes(self, context, revision):
+        nodes_info = np_recarray_to_tuple_of_dicts(
+            context.nodes.get_nodes_info(context.requester, "all-nodes")
+        )
+        rows = {info["mac"]: info for info in nodes_info}
+        return context.server.change_feeds.get_changes("nodes", rows, revision)
+
     @api_expose_method
     def get_device_ip(self, context, device_name):
         return context.devices.get_device_ip(context.requester, device_name)
@@ -111,6 +119,11 @@ class CSAPI(APISession):
         return context.server.validate_cp(
                 context.task, context.requester, "node", src, dst)
 
+    @api_expose_method
+    def validate_node_set_cp(self, context, src, dst):
+        return context.server.validate_node_set_cp(
+                context.task, context.requester, src, dst)
+
     @api_expose_method
     def node_cp_to_booted_image(self, context, node_name, **path_info):
         return context.server.node_cp_to_booted_image(
@@ -194,6 +207,20 @@ class CSAPI(APISession):
             context.requester, username, refresh, fields
         ).tolist()
 
+    @api_expose_method
+    def get_images_info_changes(self, context, username, fields, revision):
+        tabular_data = context.images.get_user_tabular_data(
+            context.requester, username, False, fields
+        ).tolist()
+        # remove ':<suffix>' on field names
+        fields = tuple(f.split(":")[0] for f in fields)
+        rows = {}
+        for values in tabular_data:
+            row = dict(zip(fields, values))
+            rows[row["name"]] = row
+        feed_key = ("images", username, fields)
+        return context.server.change_feeds.get_changes(feed_key, rows, revision)
+
     @api_expose_method
     def create_image_shell_session(self, context, image_name, task_label):
         session = context.images.create_shell_session(
@@ -306,11 +333,17 @@ class CSAPI(APISession):
         ))
 
     @api_expose_method
-    def shell_autocomplete(self, context, username, argv, debug=False):
+    def shell_autocomplete(self, context, username, argv, debug=False,
+                           with_generation=False):
         return context.server.shell_autocomplete(
-            context.task, context.requester, username, argv, debug=debug
+            context.task, context.requester, username, argv, debug=debug,
+            with_generation=with_generation
         )
 
+    @api_expose_method
+    def get_autocomplete_generation(self, context, argv):
+        return context.server.get_autocomplete_generation(argv)
+
     @api_expose_method
     def get_registries(self, context):
         return context.server.get_registries()
@@ -1,5 +1,6 @@
 from walt.common.api import api, api_expose_method
 from walt.server.processes.main.apisession import APISession
+from walt.server.processes.main.workflow import Workflow
 
 # Server -> Server API (thus the name SSAPI)
 # Provides remote calls performed from one server executable
@@ -32,3 +33,14 @@ class SSAPI(APISession):
     @api_expose_method
     def revoke_vpn_auth_key(self, context, cert_id):
         return context.server.vpn.revoke_vpn_auth_key(cert_id)
+
+    @api_expose_method
+    def get_workflow_trace(self, context, clear=False):
+        trace = Workflow.trace.export_chrome_trace()
+        if clear:
+            Workflow.trace.clear()
+        return trace
+
+    @api_expose_method
+    def set_workflow_tracing(self, context, enabled):
+        Workflow.trace.enabled = enabled
@@ -1,50 +1,164 @@
 import numpy as np
+import os
+from bisect import bisect_left
+from collections import defaultdict
 from time import time
 
 from walt.server.processes.main.workflow import Workflow
 
+# greater than any character of device or image names
+MAX_NAME_CHAR = "\U0010ffff"
+
+# completions of these argument types only depend on the names in
+# CompletionIndex, so clients may cache them as long as the generation
+# number of the related kind of names does not change.
+CACHEABLE_ARG_TYPES = {
+    "NODE": "devices",
+    "SET_OF_NODES": "devices",
+    "DEVICE": "devices",
+    "SWITCH": "devices",
+    "SET_OF_DEVICES": "devices",
+    "RESCAN_SET_OF_DEVICES": "devices",
+    "SET_OF_ISSUERS": "devices",
+    "IMAGE": "images",
+    "IMAGE_OR_DEFAULT": "images",
+}
+
+
+class SortedNames:
+    """Sorted sequence of names, allowing prefix lookups by bisection."""
+
+    def __init__(self, names=()):
+        self._names = sorted(names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        i = bisect_left(self._names, name)
+        return i < len(self._names) and self._names[i] == name
+
+    def all(self):
+        return tuple(self._names)
+
+    def startswith(self, prefix):
+        if prefix == "":
+            return tuple(self._names)
+        lo = bisect_left(self._names, prefix)
+        hi = bisect_left(self._names, prefix + MAX_NAME_CHAR, lo)
+        return tuple(self._names[lo:hi])
+
+
+class CompletionIndex:
+    """In-memory index of the names proposed by shell autocompletion.
+
+    Device names are reloaded with a single db query on the first
+    completion following a call to invalidate_devices(); the code
+    adding, renaming or removing devices calls it.
+    Image names are indexed per user from the image store, which
+    calls invalidate_images() when its set of images changes.
+    Each invalidation also increments the generation number of this
+    kind of names, allowing clients to cache completion results.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self._devices = None
+        self._images = None
+        # generation numbers restart at 0 when the server restarts,
+        # so they are prefixed with a random instance id.
+        self._instance_id = os.urandom(4).hex()
+        self._generations = dict(devices=0, images=0)
+
+    def invalidate_devices(self):
+        self._devices = None
+        self._generations["devices"] += 1
+
+    def invalidate_images(self):
+        self._images = None
+        self._generations["images"] += 1
+
+    def get_generation(self, arg_type):
+        """Return a generation string for the completions of this
+        argument type, or None if they should not be cached."""
+        kind = CACHEABLE_ARG_TYPES.get(arg_type)
+        if kind is None:
+            return None
+        return f"{self._instance_id}:{kind}:{self._generations[kind]}"
+
+    def _get_devices(self):
+        if self._devices is None:
+            names_per_type = defaultdict(list)
+            rows = self.server.db.execute("SELECT name, type FROM devices")
+            for name, dev_type in zip(rows.name, rows.type):
+                names_per_type[dev_type].append(name)
+            self._devices = dict(
+                all=SortedNames(sum(names_per_type.values(), [])),
+                nodes=SortedNames(names_per_type["node"]),
+                switches=SortedNames(names_per_type["switch"]),
+                emitters=SortedNames(names_per_type["node"] +
+                                     names_per_type["server"]),
+            )
+        return self._devices
+
+    @property
+    def devices(self):
+        return self._get_devices()["all"]
+
+    @property
+    def nodes(self):
+        return self._get_devices()["nodes"]
+
+    @property
+    def switches(self):
+        return self._get_devices()["switches"]
+
+    @property
+    def emitters(self):
+        return self._get_devices()["emitters"]
 
-def complete_node(server, username):
-    return server.nodes.show(username, show_all=True, names_only=True).split()
+    def get_user_images(self, username):
+        if self._images is None:
+            names_per_user = defaultdict(list)
+            for image in self.server.images.store.values():
+                names_per_user[image.user].append(image.name)
+            self._images = {user: SortedNames(names)
+                            for user, names in names_per_user.items()}
+        return self._images.get(username, SortedNames())
+
+
+def complete_node(server, partial_token):
+    return server.autocomplete_index.nodes.startswith(partial_token)
 
 
 def complete_device(server, partial_token):
-    return tuple(
-        dev.name
-        for dev in server.db.select("devices")
-        if dev.name.startswith(partial_token)
-    )
+    return server.autocomplete_index.devices.startswith(partial_token)
 
 
 def complete_switch(server, partial_token):
-    return tuple(
-        dev.name
-        for dev in server.db.select("devices", type="switch")
-        if dev.name.startswith(partial_token)
-    )
+    return server.autocomplete_index.switches.startswith(partial_token)
 
 
-def complete_set(possible_items, partial_token):
+def complete_set(names, keywords, partial_token):
     set_items = partial_token.split(",")
     partial_item = set_items[-1]
     prefix = "".join(item + "," for item in set_items[:-1])
-    possible = tuple(
-        prefix + item for item in possible_items if item.startswith(partial_item)
+    possible_items = names.startswith(partial_item) + tuple(
+        kw for kw in keywords if kw.startswith(partial_item)
     )
+    possible = tuple(prefix + item for item in possible_items)
     # if only one possible match, propose this match or this match plus a comma
     if len(possible) == 1:
         possible = (possible[0], possible[0] + ",")
     return possible
 
 
-def complete_set_of_nodes(server, username, partial_token):
-    all_nodes = complete_node(server, username)
+def complete_set_of_nodes(server, partial_token):
     keywords = ["my-nodes", "all-nodes", "free-nodes"]
-    return complete_set(all_nodes + keywords, partial_token)
+    return complete_set(server.autocomplete_index.nodes, keywords, partial_token)
 
 
 def complete_set_of_devices(server, partial_token):
-    all_devices = list(dev.name for dev in server.db.select("devices"))
     keywords = [
         "all-devices",
         "all-switches",
@@ -53,34 +167,33 @@ def complete_set_of_devices(server, partial_token):
         "all-nodes",
         "free-nodes",
     ]
-    return complete_set(all_devices + keywords, partial_token)
+    return complete_set(server.autocomplete_index.devices, keywords, partial_token)
 
 
 def complete_set_of_emitters(server, partial_token):
-    all_allowed_devices = list(
-        dev.name
-        for dev in server.db.select("devices")
-        if dev.name.startswith(partial_token) and dev.type in ("node", "server")
-    )
     keywords = ["my-nodes", "all-nodes", "free-nodes", "server"]
-    return complete_set(all_allowed_devices + keywords, partial_token)
+    return complete_set(server.autocomplete_index.emitters, keywords, partial_token)
 
 
 def complete_rescan_set_of_devices(server, partial_token):
     # allow to complete a switch which has lldp exploration forbidden,
     # so that the user can try and get the informative error message.
-    all_switches = list(
-        dev.name for dev in server.db.select("devices") if dev.type == "switch"
-    )
     keywords = ["explorable-switches", "server"]
-    return complete_set(all_switches + keywords, partial_token)
+    return complete_set(server.autocomplete_index.switches, keywords, partial_token)
 
 
-def complete_image(server, requester, username):
-    rows = server.images.get_user_tabular_data(
-        requester, username, refresh=False, fields=["name"]
-    )
-    names = tuple(row[0] for row in rows)
+def complete_image(server, requester, username, partial_token=""):
+    user_images = server.autocomplete_index.get_user_images(username)
+    if len(user_images) > 0:
+        # the repo part of the image name is a prefix of partial_token
+        # or the opposite, whether a tag or a remote path follows or not
+        names = user_images.startswith(partial_token.split(":", 1)[0])
+    else:
+        # new user, this slower path may clone default images for them
+        rows = server.images.get_user_tabular_data(
+            requester, username, refresh=False, fields=["name"]
+        )
+        names = tuple(row[0] for row in rows)
     implicit_names = tuple(f"{name}:latest" for name in names if ":" not in name)
     return names + implicit_names
 
@@ -124,11 +237,17 @@ def wf_after_get_completions(wf, entity, possible, remote_completions, **env):
     wf.next()
 
 
-def get_cp_entities(server, requester, username, entity_type):
+def get_cp_entities(server, requester, username, entity_type, partial_token):
     if entity_type == "node":
-        return complete_node(server, username)
+        if ":" in partial_token:
+            # '<node>:<remote-path>' pattern
+            node_name = partial_token.split(":", 1)[0]
+            if node_name in server.autocomplete_index.nodes:
+                return (node_name,)
+            return ()
+        return complete_node(server, partial_token)
     elif entity_type == "image":
-        return complete_image(server, requester, username)
+        return complete_image(server, requester, username, partial_token)
 
 
 def wf_complete_cp_src(wf, server, requester, username,
@@ -136,7 +255,8 @@ def wf_complete_cp_src(wf, server, requester, username,
     possible = []
     if ":" not in partial_token:
         possible += list(requester.filesystem.get_completions(partial_token))
-    possible_entities = get_cp_entities(server, requester, username, entity_type)
+    possible_entities = get_cp_entities(
+            server, requester, username, entity_type, partial_token)
     for entity in possible_entities:
         if partial_token.startswith(f"{entity}:"):
             wf.update_env(entity=entity)
@@ -153,7 +273,8 @@ def wf_complete_cp_dst(wf, server, requester, username,
     src_is_remote = ":" in src_token
     dst_is_remote = not src_is_remote
     if dst_is_remote:
-        possible_entities = get_cp_entities(server, requester, username, entity_type)
+        possible_entities = get_cp_entities(
+                server, requester, username, entity_type, partial_dst_token)
         for entity in possible_entities:
             if partial_dst_token.startswith(f"{entity}:"):
                 wf.update_env(entity=entity, partial_token=partial_dst_token)
@@ -277,13 +398,14 @@ def wf_shell_autocomplete_switch(wf, task, server, requester, username, argv, **
         wf.next()
     else:
         if arg_type == "NODE":
-            possible = complete_node(server, username)
+            possible = complete_node(server, partial_token)
         elif arg_type == "SET_OF_NODES":
-            possible = complete_set_of_nodes(server, username, partial_token)
+            possible = complete_set_of_nodes(server, partial_token)
         elif arg_type == "IMAGE":
-            possible = complete_image(server, requester, username)
+            possible = complete_image(server, requester, username, partial_token)
         elif arg_type == "IMAGE_OR_DEFAULT":
-            possible = ("default",) + complete_image(server, requester, username)
+            possible = ("default",) + complete_image(
+                    server, requester, username, partial_token)
         elif arg_type == "NODE_CONFIG_PARAM":
             possible = complete_device_config_param(server, requester, argv)
         elif arg_type == "DEVICE":
@@ -322,7 +444,14 @@ def mark_incomplete(token):
     return (f"{token}a", f"{token}b")
 
 
-def wf_shell_autocomplete(wf, task, debug, **env):
+def return_autocomplete_result(task, result, generation, with_generation):
+    if with_generation:
+        task.return_result((result, generation))
+    else:
+        task.return_result(result)
+
+
+def wf_shell_autocomplete(wf, task, debug, with_generation, **env):
     # autocompletion should not print failure messages
     wf.insert_steps([wf_shell_autocomplete_switch])
     try:
@@ -331,7 +460,7 @@ def wf_shell_autocomplete(wf, task, debug, **env):
         if debug:
             raise
         wf.interrupt()
-        task.return_result("")
+        return_autocomplete_result(task, "", None, with_generation)
 
 
 def wf_filter_possible(wf, argv, possible, **env):
@@ -370,15 +499,17 @@ def wf_filter_possible(wf, argv, possible, **env):
     wf.next()
 
 
-def wf_return_result(wf, task, possible, debug, t0=None, **env):
+def wf_return_result(wf, task, possible, debug, generation,
+                     with_generation, t0=None, **env):
     result = " ".join(possible)
     if debug:
         print(f"{time()-t0:.2}s -- returning: {result}")
-    task.return_result(result)
+    return_autocomplete_result(task, result, generation, with_generation)
     wf.next()
 
 
-def shell_autocomplete(server, task, requester, username, argv, debug=False):
+def shell_autocomplete(server, task, requester, username, argv, debug=False,
+                       with_generation=False):
     env=dict(
         server=server,
         task=task,
@@ -386,6 +517,11 @@ def shell_autocomplete(server, task, requester, username, argv, debug=False):
         username=username,
         argv=argv,
         debug=debug,
+        with_generation=with_generation,
+        # get the generation before computing the result: if names
+        # change meanwhile, the client will just refresh its cache
+        # one more time.
+        generation=server.autocomplete_index.get_generation(argv[0]),
     )
     if debug:
         env.update(t0=time())
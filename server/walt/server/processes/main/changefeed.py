@@ -0,0 +1,55 @@
+import os
+from collections import deque
+
+# number of past snapshots kept for each feed
+CHANGE_FEED_HISTORY_SIZE = 16
+
+
+class ChangeFeeds:
+    """Revision-based change feeds.
+
+    Clients of the python API keep a copy of some listings (nodes,
+    images of a user). When refreshing it, they give the revision they
+    got last time, and get_changes() returns only the rows which were
+    added, removed or modified since then (with only the modified fields).
+    The last CHANGE_FEED_HISTORY_SIZE snapshots of each feed are kept;
+    if the client revision is older (or comes from a previous run of
+    the server), all rows are returned and the client resyncs fully.
+    """
+
+    def __init__(self):
+        self._instance_id = os.urandom(4).hex()
+        self._last_revision = 0
+        self._history = {}
+
+    def get_changes(self, feed_key, rows, since_revision):
+        """rows is the current listing, as a dict: <key> -> <dict of fields>."""
+        history = self._history.get(feed_key)
+        if history is None:
+            history = deque(maxlen=CHANGE_FEED_HISTORY_SIZE)
+            self._history[feed_key] = history
+        # record a new revision if the listing changed
+        if len(history) == 0 or history[-1][1] != rows:
+            self._last_revision += 1
+            revision = f"{self._instance_id}:{self._last_revision}"
+            history.append((revision, rows))
+        revision = history[-1][0]
+        for past_revision, past_rows in history:
+            if past_revision == since_revision:
+                return dict(revision=revision, full=False,
+                            **self._diff(past_rows, rows))
+        return dict(revision=revision, full=True, rows=rows, removed=[])
+
+    def _diff(self, past_rows, rows):
+        removed = [key for key in past_rows if key not in rows]
+        changed = {}
+        for key, row in rows.items():
+            past_row = past_rows.get(key)
+            if past_row is None:
+                changed[key] = row
+            elif past_row != row:
+                changed[key] = {
+                    f: v for f, v in row.items()
+                    if f not in past_row or past_row[f] != v
+                }
+        return dict(rows=changed, removed=removed)
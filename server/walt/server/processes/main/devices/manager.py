@@ -137,6 +137,7 @@ class DevicesManager(object):
         # all is fine, let's update it
         self.db.update("devices", "mac", mac=device_info.mac, name=new_name)
         self.db.commit()
+        self.server.autocomplete_index.invalidate_devices()
         return True
 
     def get_type(self, mac):
@@ -391,6 +392,7 @@ class DevicesManager(object):
             self.logs.platform_log("devices", line=logline)
         if modified:
             self.db.commit()
+            self.server.autocomplete_index.invalidate_devices()
         return modified
 
     def show(self):
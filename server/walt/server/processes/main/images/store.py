@@ -107,6 +107,7 @@ class NodeImageStore(object):
                     )
                     self.db.delete("images", fullname=db_fullname)
                     self.db.commit()
+        self.server.autocomplete_index.invalidate_images()
 
     def resync_from_registry(self, rescan=False):
         "Resync function podman repo -> this image store"
@@ -123,6 +124,7 @@ class NodeImageStore(object):
                 db_images.add(fullname)  # for the next loop below
             if fullname not in self.images:
                 self.images[fullname] = NodeImage(self, fullname)
+                self.server.autocomplete_index.invalidate_images()
         # all images should be available in this store
         # if not, this means they were deleted from registry,
         # so remove them here too (and in db)
@@ -137,6 +139,7 @@ class NodeImageStore(object):
         self.db.insert("images", fullname=image_fullname)
         self.db.commit()
         self.images[image_fullname] = NodeImage(self, image_fullname)
+        self.server.autocomplete_index.invalidate_images()
 
     def update_default_images(self, requester, task_cb):
         # we ignore the final reboot status of nodes
@@ -181,12 +184,14 @@ class NodeImageStore(object):
         img.rename(new_fullname)
         self.images[new_fullname] = img
         del self.images[old_fullname]
+        self.server.autocomplete_index.invalidate_images()
 
     # Make sure to remove the image from docker *before* calling this.
     def remove(self, image_fullname):
         self.db.delete("images", fullname=image_fullname)
         self.db.commit()
         del self.images[image_fullname]
+        self.server.autocomplete_index.invalidate_images()
 
     def __getitem__(self, image_fullname):
         return self.get_images_per_fullnames((image_fullname,))[0]
@@ -17,13 +17,91 @@ TFTP_STATIC_DIR = Path(TFTP_ROOT + "tftp-static")
 TFTP_STATIC_DIR_TS = 1741598952
 NODE_PROBING_PATH = Path(NODES_PATH) / 'probing'
 NODE_PROBING_TFTP_PATH = NODE_PROBING_PATH / 'tftp'
-TFTP_STATUS_PATH = Path(NODES_PATH) / "status.pickle"
+TFTP_STATUS_PATH = Path(NODES_PATH) / "status.snapshot"
+TFTP_JOURNAL_PATH = Path(NODES_PATH) / "status.journal"
+OBSOLETE_TFTP_STATUS_PATH = Path(NODES_PATH) / "status.pickle"
+TFTP_JOURNAL_MIN_COMPACT_SIZE = 1000
 TFTP_STATUS = None
+TFTP_JOURNAL_SIZE = 0
+
+
+# The status (i.e., the set of directives describing the expected content
+# of NODES_PATH) is stored in two files:
+# - a snapshot file, with one directive per line;
+# - a journal file, with one line per change applied since the snapshot
+#   was written: "+<directive>" or "-<directive>".
+# Usually, only a few lines are appended to the journal on each update,
+# instead of rewriting the whole status. When the journal becomes larger
+# than the snapshot, we compact the two into a new snapshot.
+# The snapshot is written to a temporary file and renamed over the previous
+# one, and a truncated last line in the journal (crash while appending) is
+# ignored and removed from the file when loading. In the worst case, the
+# status loaded describes the state before the last update, and since the
+# filesystem operations we apply are idempotent, running the update again
+# fixes things up.
+
+
+def _write_file_atomic(path, content):
+    tmp_path = path.parent / f".{path.name}.tmp"
+    with tmp_path.open("w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp_path.rename(path)
 
 
 def save_tftp_status():
+    global TFTP_JOURNAL_SIZE
     TFTP_STATUS_PATH.parent.mkdir(parents=True, exist_ok=True)
-    TFTP_STATUS_PATH.write_bytes(pickle.dumps(TFTP_STATUS))
+    content = "".join(f"{directive}\n" for directive in sorted(TFTP_STATUS))
+    _write_file_atomic(TFTP_STATUS_PATH, content)
+    TFTP_JOURNAL_PATH.unlink(missing_ok=True)
+    TFTP_JOURNAL_SIZE = 0
+
+
+def journal_tftp_status_changes(removed, added):
+    global TFTP_JOURNAL_SIZE
+    TFTP_JOURNAL_SIZE += len(removed) + len(added)
+    if TFTP_JOURNAL_SIZE > max(len(TFTP_STATUS), TFTP_JOURNAL_MIN_COMPACT_SIZE):
+        save_tftp_status()  # compact
+        return
+    lines = [f"-{directive}\n" for directive in removed]
+    lines += [f"+{directive}\n" for directive in added]
+    with TFTP_JOURNAL_PATH.open("a") as f:
+        f.write("".join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_tftp_status():
+    global TFTP_JOURNAL_SIZE
+    if OBSOLETE_TFTP_STATUS_PATH.exists():
+        # convert the status file of older walt versions
+        status = pickle.loads(OBSOLETE_TFTP_STATUS_PATH.read_bytes())
+        TFTP_JOURNAL_PATH.unlink(missing_ok=True)
+        TFTP_JOURNAL_SIZE = 0
+        return status
+    if not TFTP_STATUS_PATH.exists():
+        return None
+    status = set(TFTP_STATUS_PATH.read_text().splitlines())
+    TFTP_JOURNAL_SIZE = 0
+    if TFTP_JOURNAL_PATH.exists():
+        content = TFTP_JOURNAL_PATH.read_bytes()
+        end = content.rfind(b"\n") + 1
+        if end < len(content):
+            # truncated last line, remove it: otherwise the next change
+            # would be appended to it.
+            os.truncate(TFTP_JOURNAL_PATH, end)
+        lines = content[:end].decode().splitlines()
+        for line in lines:
+            if line.startswith("+"):
+                status.add(line[1:])
+            elif line.startswith("-"):
+                status.discard(line[1:])
+            else:
+                return None  # corrupted journal
+        TFTP_JOURNAL_SIZE = len(lines)
+    return status
 
 
 def is_real_dir(path):
@@ -91,10 +169,12 @@ def prepare():
         archive_path = this_dir / "tftp-static.tar.gz"
         with tarfile.open(str(archive_path)) as tar:
             tar.extractall(str(TFTP_STATIC_DIR.parent))
-    if TFTP_STATUS_PATH.exists():
-        TFTP_STATUS = pickle.loads(TFTP_STATUS_PATH.read_bytes())
-    else:
+    TFTP_STATUS = load_tftp_status()
+    if TFTP_STATUS is None:
         revert_to_empty_status()
+    elif OBSOLETE_TFTP_STATUS_PATH.exists():
+        save_tftp_status()
+        OBSOLETE_TFTP_STATUS_PATH.unlink()
     if not NODE_PROBING_PATH.exists():
         NODE_PROBING_PATH.mkdir(parents=True)
     if not NODE_PROBING_TFTP_PATH.is_symlink():
@@ -244,64 +324,86 @@ def update(db, images, cleanup=False):
         # nothing changed
         return
     while True:
-        valid_status = True
-        # -- remove entries of old status no longer present
-        # note: we sort to ensure SYMLINK directives are first
-        for directive in sorted(TFTP_STATUS - status, reverse=True):
-            args = directive.split()
-            if args[0] == "SYMLINK":
-                if not Path(NODES_PATH + args[2]).is_symlink():
-                    # the status file contains invalid information
-                    valid_status = False
-                    break
-                #print(f"tftp: remove {args[2]}")
-                Path(NODES_PATH + args[2]).unlink()
-            elif args[0] == "DIR":
-                if not is_real_dir(Path(NODES_PATH + args[1])):
-                    # the status file contains invalid information
-                    valid_status = False
-                    break
-                #print(f"tftp: remove {args[1]}")
-                shutil.rmtree(NODES_PATH + args[1])
-        if not valid_status:
-            revert_to_empty_status()
+        removed, added = TFTP_STATUS - status, status - TFTP_STATUS
+        if apply_tftp_changes(removed, added):
+            break
+        # the status file contains invalid information
+        revert_to_empty_status()
+    # -- save the changes
+    TFTP_STATUS = status
+    journal_tftp_status_changes(removed, added)
+
+
+def _parse_directives(directives):
+    dirs, symlinks = set(), {}
+    for directive in directives:
+        args = directive.split()
+        if args[0] == "DIR":
+            dirs.add(args[1])
+        elif args[0] == "SYMLINK":
+            symlinks[args[2]] = args[1]
+    return dirs, symlinks
+
+
+def _create_symlink_atomic(symlink_path, target):
+    # create the symlink with a temporary name and rename it over
+    # the previous one (if any), so that a tftp or nfs client never
+    # sees a missing entry when the target changes.
+    tmp_path = symlink_path.parent / f".{symlink_path.name}.tmp"
+    tmp_path.unlink(missing_ok=True)
+    tmp_path.symlink_to(target)
+    tmp_path.rename(symlink_path)
+
+
+def apply_tftp_changes(removed, added):
+    removed_dirs, removed_symlinks = _parse_directives(removed)
+    added_dirs, added_symlinks = _parse_directives(added)
+    # when a symlink target changes, we will just rename the new symlink
+    # over the previous one, so we do not need to remove it first.
+    for path in added_symlinks.keys() & removed_symlinks.keys():
+        del removed_symlinks[path]
+    # -- remove entries of old status no longer present
+    # note: symlinks first, since they may be stored in removed dirs
+    # note: all operations below are idempotent, so that we can safely
+    # re-apply them if walt-server-daemon was interrupted before the
+    # status was saved.
+    for path in sorted(removed_symlinks):
+        symlink_path = Path(NODES_PATH + path)
+        if not symlink_path.is_symlink():
+            if symlink_path.exists():
+                return False
             continue
-        # -- add new entries
-        # notes:
-        # * we sort to ensure DIR directives are first
-        # * some dir entries might already be present because we kept
-        #   persist_dirs, persist_dir, networks, disks subdirs in prepare() above.
-        for directive in sorted(status - TFTP_STATUS):
-            args = directive.split()
-            if args[0] == "DIR":
-                #print(f"tftp: create {args[1]}")
-                mac_dir_path = Path(NODES_PATH + args[1])
-                mac_dir_path.mkdir(exist_ok=True)
-            elif args[0] == "SYMLINK":
-                if Path(NODES_PATH + args[2]).exists():
-                    # the status file contains invalid information
-                    valid_status = False
-                    break
-                #print(f"tftp: create {args[2]}")
-                symlink_path = Path(NODES_PATH + args[2])
-                mac_dir_path = symlink_path.parent
-                target_path = mac_dir_path / args[1]
-                # automatically move <mac>/persist_dir (older walt version)
-                # to <mac>/persist_dirs/<owner>, or just create
-                # <mac>/persist_dirs/<owner> if missing.
-                if not target_path.exists():
-                    if target_path.parent.name == "persist_dirs":
-                        persist_dir_path = mac_dir_path / "persist_dir"
-                        if persist_dir_path.exists():
-                            target_path.parent.mkdir(exist_ok=True)
-                            persist_dir_path.rename(target_path)
-                        else:
-                            target_path.mkdir(parents=True)
-                symlink_path.symlink_to(args[1])
-        if not valid_status:
-            revert_to_empty_status()
+        symlink_path.unlink()
+    for mac in sorted(removed_dirs):
+        mac_dir_path = Path(NODES_PATH + mac)
+        if not is_real_dir(mac_dir_path):
+            if mac_dir_path.exists():
+                return False
             continue
-        # -- save the new status
-        TFTP_STATUS = status
-        save_tftp_status()
-        return  # ok
+        shutil.rmtree(mac_dir_path)
+    # -- add new entries
+    # notes:
+    # * dirs first, since they will contain some of the symlinks
+    # * some dir entries might already be present because we kept
+    #   persist_dirs, persist_dir, networks, disks subdirs in prepare() above.
+    for mac in sorted(added_dirs):
+        Path(NODES_PATH + mac).mkdir(exist_ok=True)
+    for path, target in sorted(added_symlinks.items()):
+        symlink_path = Path(NODES_PATH + path)
+        if symlink_path.exists() and not symlink_path.is_symlink():
+            return False
+        mac_dir_path = symlink_path.parent
+        target_path = mac_dir_path / target
+        # automatically move <mac>/persist_dir (older walt version)
+        # to <mac>/persist_dirs/<owner>, or just create
+        # <mac>/persist_dirs/<owner> if missing.
+        if not target_path.exists():
+            if target_path.parent.name == "persist_dirs":
+                persist_dir_path = mac_dir_path / "persist_dir"
+                if persist_dir_path.exists():
+                    target_path.parent.mkdir(exist_ok=True)
+                    persist_dir_path.rename(target_path)
+                else:
+                    target_path.mkdir(parents=True)
+        _create_symlink_atomic(symlink_path, target)
+    return True
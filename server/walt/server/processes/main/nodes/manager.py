@@ -55,7 +55,7 @@ class NodesManager(object):
         self.logs = server.logs
         self.blocking = server.blocking
         self.settings = server.settings
-        self.wait_info = WaitInfo()
+        self.wait_info = WaitInfo(server.ev_loop)
         self.ev_loop = server.ev_loop
         self.exports = server.exports
         self.clock = NodesClockSyncInfo(server.ev_loop)
@@ -70,8 +70,8 @@ class NodesManager(object):
         )
         self._cleaning_up = False
 
-    def forget_device(self, mac):
-        self.status_manager.forget_device(mac)
+    def forget_device(self, device):
+        self.status_manager.forget_device(device)
 
     def prepare(self):
         known_hosts_nodes = Path("/var/lib/walt/ssh/known_hosts.nodes")
@@ -79,6 +79,7 @@ class NodesManager(object):
         pub_key = NODE_SSH_ECDSA_HOST_KEY_PUB_PATH.read_text()
         alg, key = pub_key.split()[:2]
         known_hosts_nodes.write_text(f"walt.node {alg} {key}")
+        self.status_manager.prepare()
 
     def restore(self):
         # init powersave
@@ -1,26 +1,54 @@
-from collections import defaultdict
+import os
+import socket
+from collections import defaultdict, deque
+from time import time
 
+import numpy as np
 from walt.server.tools import NonBlockingSocket
 from walt.server.const import WALT_NODE_NET_SERVICE_PORT
 
 NODE_REQUEST_DELAY_SECS = 15.0
+NODE_REQUEST_MAX_CONCURRENCY = 64
+NODE_REQUEST_RECV_SIZE = 4096
+NODE_REQUEST_MAX_RESP_SIZE = 4096
+# print latency stats of batches targeting at least this number of nodes
+NODE_REQUEST_STATS_MIN_NODES = 16
 
 
 class ServerToNodeRequest(NonBlockingSocket):
-    def __init__(self, ev_loop, node, req, cb, env):
+    def __init__(self, ev_loop, node, req, batch):
         self.node = node
         self.req = req
-        self.cb = cb
-        self.env = env
+        self.batch = batch
+        self.resp = b''
+        self.done = False
+        self.timing_out = False
         NonBlockingSocket.__init__(self, ev_loop,
                     self.node.ip, WALT_NODE_NET_SERVICE_PORT,
                     NODE_REQUEST_DELAY_SECS)
 
     def run(self):
-        self.start_connect()
+        self.start_time = time()
+        try:
+            self.start_connect()
+        except OSError as e:
+            # report the error before close() reports a generic one
+            self.report(e.strerror)
+            self.close()
+
+    def report(self, result_msg):
+        if not self.done:
+            self.done = True
+            self.batch.on_result(self, result_msg)
+
+    def on_timeout(self, timeout_id):
+        # the event loop will call close() before the on_*_timeout()
+        # handler reports the appropriate error
+        self.timing_out = (self.timeout_id == timeout_id)
+        NonBlockingSocket.on_timeout(self, timeout_id)
 
     def on_connect_timeout(self):
-        self.cb(self.env, self.node, "Connection timed out")
+        self.report("Connection timed out")
 
     def on_connect(self):
         try:
@@ -30,57 +58,112 @@ class ServerToNodeRequest(NonBlockingSocket):
                 result_msg = "Connection refused"
             else:
                 result_msg = e.strerror
-            print(result_msg)
-            self.cb(self.env, self.node, result_msg)
+            self.report(result_msg)
             # ev_loop will call close()
             return False
         self.start_wait_read()  # wait for the response
 
     def on_read_timeout(self):
-        self.cb(self.env, self.node, "Timed out waiting for reply")
+        self.report("Timed out waiting for reply")
 
     def on_read_ready(self):
-        resp = b''
-        while True:
-            try:
-                c = self.recv(1)
-            except Exception as e:
-                print(e)
-                result_msg = "Broken connection"
-                self.cb(self.env, self.node, result_msg)
-                # ev_loop will call close()
-                return False
-            if c == b'\n':
-                break
-            elif c == b'':
-                break
-            resp += c
+        try:
+            chunk = self.recv(NODE_REQUEST_RECV_SIZE)
+        except BlockingIOError:
+            self.start_wait_read()  # spurious wake-up
+            return True
+        except Exception:
+            self.report("Broken connection")
+            # ev_loop will call close()
+            return False
+        self.resp += chunk
+        if (len(chunk) > 0 and b'\n' not in chunk and
+                len(self.resp) < NODE_REQUEST_MAX_RESP_SIZE):
+            self.start_wait_read()  # incomplete line, wait for more
+            return True
+        resp = self.resp.split(b'\n', 1)[0]
         resp = tuple(part.strip() for part in
-                     resp.decode('ascii').split(" ", 1))
+                     resp.decode('ascii', errors='replace').split(" ", 1))
         if resp[0] == "OK":
-            self.cb(self.env, self.node, "OK")
+            self.report("OK")
         elif len(resp) == 2:
-            self.cb(self.env, self.node, resp[1])
+            self.report(resp[1])
         else:
-            self.cb(self.env, self.node, "Node did not respond properly")
+            self.report("Node did not respond properly")
         return False  # ev_loop will call close()
 
+    def close(self):
+        # the event loop may also remove us because of a socket error
+        # (e.g., connection refused while connecting)
+        result_msg = "Connection failed"
+        if self.sock is not None:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                result_msg = os.strerror(err)
+        NonBlockingSocket.close(self)
+        if not self.timing_out:
+            self.report(result_msg)
+
+
+class NodeRequestBatch:
+    """Sends a request to a set of nodes, with at most
+    NODE_REQUEST_MAX_CONCURRENCY connections at once, and calls
+    cb(results, **cb_kwargs) when all nodes have answered (or failed).
+    results is a dict: <result_msg> -> <list of nodes>.
+    """
+
+    def __init__(self, ev_loop, nodes, req, cb, cb_kwargs):
+        self.ev_loop = ev_loop
+        self.req = req
+        self.cb = cb
+        self.cb_kwargs = cb_kwargs
+        self.results = defaultdict(list)
+        self.num_nodes = len(nodes)
+        self.num_pending = self.num_nodes
+        self.queue = deque(nodes)
+        self.num_free_slots = NODE_REQUEST_MAX_CONCURRENCY
+        self.starting = False
+        self.latencies = np.empty(self.num_nodes, dtype=float)
+
+    def run(self):
+        if self.num_nodes == 0:
+            self.cb(self.results, **self.cb_kwargs)
+            return
+        self.start_requests()
+
+    def start_requests(self):
+        # when a request fails synchronously (e.g., network unreachable),
+        # on_result() is called from request.run(), thus from this loop:
+        # in this case we just let the loop start the next requests,
+        # instead of recursing.
+        if self.starting:
+            return
+        self.starting = True
+        while self.num_free_slots > 0 and len(self.queue) > 0:
+            self.num_free_slots -= 1
+            node = self.queue.popleft()
+            ServerToNodeRequest(self.ev_loop, node, self.req, self).run()
+        self.starting = False
+
+    def on_result(self, request, result_msg):
+        self.results[result_msg].append(request.node)
+        self.num_pending -= 1
+        self.num_free_slots += 1
+        self.latencies[self.num_pending] = time() - request.start_time
+        if self.num_pending == 0:  # done
+            if self.num_nodes >= NODE_REQUEST_STATS_MIN_NODES:
+                self.print_stats()
+            self.cb(self.results, **self.cb_kwargs)
+        else:
+            self.start_requests()
 
-def node_request_cb(env, node, result_msg):
-    env["results"][result_msg].append(node)
-    env["num_nodes"] -= 1
-    if env["num_nodes"] == 0:  # done
-        cb, cb_kwargs, results = env["cb"], env["cb_kwargs"], env["results"]
-        cb(results, **cb_kwargs)
+    def print_stats(self):
+        p50, p90, p99 = np.percentile(self.latencies, (50, 90, 99))
+        req_name = self.req.split(" ", 1)[0]
+        print(f"node request {req_name}: {self.num_nodes} nodes, "
+              f"latency p50={p50:.3f}s p90={p90:.3f}s p99={p99:.3f}s "
+              f"max={self.latencies.max():.3f}s")
 
 
 def node_request(ev_loop, nodes, req, cb, cb_kwargs):
-    num_nodes = len(nodes)
-    results = defaultdict(list)
-    if num_nodes == 0:
-        cb(results, **cb_kwargs)
-        return
-    env = dict(num_nodes=num_nodes, results=results, cb=cb, cb_kwargs=cb_kwargs)
-    for node in nodes:
-        request = ServerToNodeRequest(ev_loop, node, req, node_request_cb, env)
-        request.run()
+    NodeRequestBatch(ev_loop, nodes, req, cb, cb_kwargs).run()
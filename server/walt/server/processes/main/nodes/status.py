@@ -1,14 +1,32 @@
 #!/usr/bin/env python
 import operator
+import socket
 import numpy as np
 from time import time
 
 from walt.common.tcp import Requests
+from walt.common.udp import udp_server_socket
+from walt.server.const import (
+    NODE_HEARTBEAT_ACK_TIMEOUT,
+    NODE_HEARTBEAT_PERIOD,
+    WALT_SERVER_HEARTBEAT_PORT,
+)
 
 NODE_DEFAULT_BOOT_RETRIES = 9
 NODE_DEFAULT_BOOT_TIMEOUT = 180
 NODE_MIN_BOOT_TIMEOUT = 60
 
+# after sending a heartbeat, a node waits for the ack (up to
+# NODE_HEARTBEAT_ACK_TIMEOUT seconds) then sleeps NODE_HEARTBEAT_PERIOD
+# seconds (see walt-notify-bootup); a node is considered down when it
+# missed 3 heartbeats.
+NODE_HEARTBEAT_MAX_INTERVAL = NODE_HEARTBEAT_PERIOD + NODE_HEARTBEAT_ACK_TIMEOUT
+NODE_HEARTBEAT_TIMEOUT = 3 * NODE_HEARTBEAT_MAX_INTERVAL + 1
+NODE_HEARTBEAT_SWEEP_PERIOD = 1
+NODE_HEARTBEAT_MAX_BATCH = 1024
+NODE_HEARTBEAT_RCVBUF = 1024 * 1024
+NODE_HEARTBEAT_TABLE_DT = [("seq", "u8"), ("deadline", "f8")]
+
 np_extract_cause = np.vectorize(operator.methodcaller("get", "cause", None), otypes="O")
 
 
@@ -80,6 +98,125 @@ class NodeBootupStatusListener:
             self.sock_file = None
 
 
+class NodeHeartbeatListener:
+    """Listens for UDP heartbeats sent by nodes whose image declared the
+    "bootup-heartbeat" capability.
+
+    All nodes share this single socket. Liveness info is kept in a numpy
+    table (one row per node) and a periodic sweep detects expired deadlines.
+    """
+
+    def __init__(self, manager, port):
+        self.manager = manager
+        self.s = udp_server_socket(port)
+        self.s.setblocking(False)
+        # absorb bursts of heartbeats (e.g., when many nodes boot together)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, NODE_HEARTBEAT_RCVBUF)
+        self._row_per_ip = {}
+        self._ips = []
+        self._table = np.zeros(64, dtype=NODE_HEARTBEAT_TABLE_DT).view(np.recarray)
+
+    def join_event_loop(self, ev_loop):
+        ev_loop.register_listener(self)
+        ev_loop.plan_event(
+            ts=time() + NODE_HEARTBEAT_SWEEP_PERIOD,
+            callback=self.sweep,
+            repeat_delay=NODE_HEARTBEAT_SWEEP_PERIOD,
+        )
+
+    # let the event loop know what we are reading on
+    def fileno(self):
+        return self.s.fileno()
+
+    def _recv_batch(self):
+        batch = []
+        for _ in range(NODE_HEARTBEAT_MAX_BATCH):
+            try:
+                batch.append(self.s.recvfrom(64))
+            except BlockingIOError:
+                break
+        return batch
+
+    def _add_row(self, node_ip):
+        row = len(self._ips)
+        if row == self._table.size:
+            table = np.zeros(2 * row, dtype=NODE_HEARTBEAT_TABLE_DT)
+            table[:row] = self._table
+            self._table = table.view(np.recarray)
+        self._ips.append(node_ip)
+        self._row_per_ip[node_ip] = row
+        return row
+
+    def handle_event(self, ts):
+        deadline = ts + NODE_HEARTBEAT_TIMEOUT
+        for msg, addrinfo in self._recv_batch():
+            words = msg.split()
+            if len(words) != 2 or words[0] != b"HB" or not words[1].isdigit():
+                continue  # ignore malformed datagram
+            seq = int(words[1])
+            node_ip = addrinfo[0]
+            row = self._row_per_ip.get(node_ip)
+            if row is None:
+                row = self._add_row(node_ip)
+                self.manager.add_booted_event(node_ip, True, {})
+            elif seq < self._table.seq[row]:
+                # the sequence was restarted (its first datagrams may have
+                # been lost), the node rebooted without us noticing it.
+                self.manager.add_booted_event(
+                    node_ip, False, dict(cause="unknown", note="heartbeat restarted")
+                )
+                self.manager.add_booted_event(node_ip, True, {})
+            elif seq == self._table.seq[row]:
+                # duplicate datagram, just acknowledge it
+                self._send_ack(seq, addrinfo)
+                continue
+            self._table.seq[row] = seq
+            self._table.deadline[row] = deadline
+            self._send_ack(seq, addrinfo)
+        return True
+
+    def _send_ack(self, seq, addrinfo):
+        try:
+            self.s.sendto(b"ACK %d\n" % seq, addrinfo)
+        except OSError:
+            pass  # the node will send its next heartbeat anyway
+
+    def sweep(self, **kwargs):
+        num_rows = len(self._ips)
+        if num_rows == 0 or self.manager.cleaning_up:
+            return
+        table = self._table[:num_rows]
+        expired = table.deadline < time()
+        if not expired.any():
+            return
+        for node_ip in np.array(self._ips, dtype="O")[expired]:
+            self.manager.add_booted_event(
+                node_ip, False, dict(cause="unknown", note="heartbeat timeout")
+            )
+        self._remove_rows(expired)
+
+    def forget(self, node_ips):
+        """Drop the rows of nodes the manager marked down or forgot: the
+        next heartbeat of these nodes will be handled as a bootup."""
+        rows = [self._row_per_ip[ip] for ip in node_ips if ip in self._row_per_ip]
+        if len(rows) == 0:
+            return
+        removed = np.zeros(len(self._ips), dtype=bool)
+        removed[rows] = True
+        self._remove_rows(removed)
+
+    def _remove_rows(self, removed):
+        # compact the table
+        kept = ~removed
+        num_kept = int(np.count_nonzero(kept))
+        self._table[:num_kept] = self._table[:len(self._ips)][kept]
+        self._ips = np.array(self._ips, dtype="O")[kept].tolist()
+        self._row_per_ip = dict(zip(self._ips, range(num_kept)))
+
+    def close(self):
+        self.s.close()
+
+
 class NodeBootupStatusManager(object):
     def __init__(self, tcp_server, nodes_manager):
         self._sock_files_per_ip = {}
@@ -95,6 +232,7 @@ class NodeBootupStatusManager(object):
         self._next_bg_process = None
         self._bg_processing = False
         self._cleaning_up = False
+        self._heartbeats = None
         for cls in [NodeBootupStatusListener]:
             tcp_server.register_listener_class(
                 manager=self,
@@ -103,13 +241,24 @@ class NodeBootupStatusManager(object):
                 sock_files_per_ip=self._sock_files_per_ip,
             )
 
+    def prepare(self):
+        self._heartbeats = NodeHeartbeatListener(self, WALT_SERVER_HEARTBEAT_PORT)
+        self._heartbeats.join_event_loop(self._ev_loop)
+
     def cleanup(self):
         self._cleaning_up = True
 
+    @property
+    def cleaning_up(self):
+        return self._cleaning_up
+
     def get_booted_macs(self):
         return self._booted_macs.copy()
 
-    def forget_device(self, mac):
+    def forget_device(self, device):
+        mac = device.mac
+        if self._heartbeats is not None:
+            self._heartbeats.forget([device.ip])
         self._booted_macs.discard(mac)  # if ever it was inside
         if mac in self._boot_info:
             del self._boot_info[mac]
@@ -191,6 +340,10 @@ class NodeBootupStatusManager(object):
         self._boot_info_table.remaining_retries[update_mask] = retries
 
     def change_nodes_bootup_status(self, nodes, booted=True, **details):
+        if not booted and self._heartbeats is not None:
+            # a heartbeat received after the node restarts is a bootup event,
+            # whatever its sequence number.
+            self._heartbeats.forget([node.ip for node in nodes])
         self._booted_events += [(node.ip, booted, details) for node in nodes]
         self._plan_bg_process()
 
@@ -1,6 +1,7 @@
 from collections import defaultdict
+from time import time
 
-from walt.common.formatting import format_sentence_about_nodes
+from walt.common.formatting import MAX_PRINTED_NODES, format_sentence_about_nodes
 
 # note: sending a notification message to a requester or ending a task
 # involves a remote procedure call, thus another bootup notification
@@ -8,35 +9,65 @@ from walt.common.formatting import format_sentence_about_nodes
 # as a result wait() and node_bootup_event() functions had to be
 # carefully written regarding these remote procedure calls.
 
+# status messages are coalesced and sent at most once per this delay
+WAIT_STATUS_MIN_PERIOD = 1.0
+
 
 class WaitInfo(object):
-    def __init__(self):
+    def __init__(self, ev_loop):
+        self.ev_loop = ev_loop
         self.tid_to_macs = defaultdict(set)
+        self.tid_to_num_nodes = {}
         self.mac_to_tids = defaultdict(set)
         self.mac_to_name = {}
         self.tasks = {}
-        self.tid_to_message = {}
+        self.pending_status_tids = set()
         self.completed_tasks = []
+        self.last_status_flush = 0
+        self.status_flush_planned = False
+
+    def get_status_message(self, tid):
+        waiting_macs = self.tid_to_macs[tid]
+        num_waiting = len(waiting_macs)
+        if num_waiting <= MAX_PRINTED_NODES:
+            waiting_names = [self.mac_to_name[mac] for mac in waiting_macs]
+            return format_sentence_about_nodes("Waiting for bootup of %s",
+                                               waiting_names)
+        num_nodes = self.tid_to_num_nodes[tid]
+        return (f"Waiting for bootup of {num_waiting} nodes "
+                f"({num_nodes - num_waiting}/{num_nodes} booted)")
 
     def push_status_message(self, tid):
-        waiting_names = [self.mac_to_name[mac] for mac in self.tid_to_macs[tid]]
-        message = format_sentence_about_nodes("Waiting for bootup of %s", waiting_names)
-        self.tid_to_message[tid] = message
+        self.pending_status_tids.add(tid)
 
     def flush(self):
-        tid_to_message = self.tid_to_message.copy()
-        self.tid_to_message = {}    # reset
         # unblock clients
         while len(self.completed_tasks) > 0:
-            task = self.completed_tasks[0]
-            self.completed_tasks = self.completed_tasks[1:]
-            tid = id(task)
-            if tid in tid_to_message:
-                del tid_to_message[tid]
+            task = self.completed_tasks.pop(0)
             task.end(0)  # unblock the client
-        # send status messages
-        for tid, message in tid_to_message.items():
-            requester = self.tasks[tid].context.requester
+        # send status messages, unless we did it recently
+        if len(self.pending_status_tids) == 0 or self.status_flush_planned:
+            return
+        next_flush = self.last_status_flush + WAIT_STATUS_MIN_PERIOD
+        if time() < next_flush:
+            self.status_flush_planned = True
+            self.ev_loop.plan_event(ts=next_flush, callback=self.flush_status_messages)
+        else:
+            self.flush_status_messages()
+
+    def flush_status_messages(self):
+        self.status_flush_planned = False
+        self.last_status_flush = time()
+        messages = {}
+        for tid in self.pending_status_tids:
+            if tid in self.tasks:   # if not, task is completed
+                messages[tid] = self.get_status_message(tid)
+        self.pending_status_tids = set()    # reset
+        for tid, message in messages.items():
+            task = self.tasks.get(tid)
+            if task is None:
+                continue  # task completed meanwhile
+            requester = task.context.requester
             if not requester.get_username():
                 continue  # requester is disconnected
             requester.set_busy_label(message)
@@ -56,23 +87,28 @@ class WaitInfo(object):
             self.mac_to_tids[node.mac].add(tid)
             self.tid_to_macs[tid].add(node.mac)
             self.mac_to_name[node.mac] = node.name
+        self.tid_to_num_nodes[tid] = len(self.tid_to_macs[tid])
         self.push_status_message(tid)
         self.flush()
 
     def node_bootup_event(self, node):
-        tids = self.mac_to_tids[node.mac]
-        if len(tids) > 0:
-            del self.mac_to_tids[node.mac]
-            del self.mac_to_name[node.mac]
-            for tid in tids:
-                self.tid_to_macs[tid].remove(node.mac)
-                if len(self.tid_to_macs[tid]) == 0:
-                    # the queue is no more associated with any awaited nodes
-                    self.completed_tasks.append(self.tasks[tid])
-                    del self.tasks[tid]
-                    del self.tid_to_macs[tid]
-                else:
-                    # task is still waiting for other nodes, just let
-                    # requester know that one more is booted
-                    self.push_status_message(tid)
-            self.flush()
+        # thanks to the reverse index mac_to_tids, this costs
+        # O(<number of tasks waiting for this node>).
+        tids = self.mac_to_tids.pop(node.mac, None)
+        if tids is None:
+            return
+        del self.mac_to_name[node.mac]
+        for tid in tids:
+            self.tid_to_macs[tid].remove(node.mac)
+            if len(self.tid_to_macs[tid]) == 0:
+                # the queue is no more associated with any awaited nodes
+                self.completed_tasks.append(self.tasks[tid])
+                del self.tasks[tid]
+                del self.tid_to_macs[tid]
+                del self.tid_to_num_nodes[tid]
+                self.pending_status_tids.discard(tid)
+            else:
+                # task is still waiting for other nodes, just let
+                # requester know that one more is booted
+                self.push_status_message(tid)
+        self.flush()
@@ -42,7 +42,10 @@ class ParallelProcessSocketListener(object):
         self.params = None
         self.client_sock_file = sock_file
         self.slave_r, self.slave_w = None, None
-        self.send_client("READY\n")
+        self.send_client(self.get_ready_message())
+
+    def get_ready_message(self):
+        return "READY\n"  # override in subclasses if needed
 
     def send_client(self, s):
         self.client_sock_file.write(s.encode("UTF-8"))
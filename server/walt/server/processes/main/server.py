@@ -19,7 +19,11 @@ from walt.server.const import (
     NODE_DROPBEAR_ECDSA_HOST_KEY_PATH,
 )
 from walt.server.processes.main.apisession import APISession
-from walt.server.processes.main.autocomplete import shell_autocomplete
+from walt.server.processes.main.autocomplete import (
+    CompletionIndex,
+    shell_autocomplete,
+)
+from walt.server.processes.main.changefeed import ChangeFeeds
 from walt.server.processes.main.devices.manager import DevicesManager
 from walt.server.processes.main.exports import FilesystemsExporter
 from walt.server.processes.main.images.manager import NodeImageManager
@@ -36,6 +40,7 @@ from walt.server.processes.main.transfer import (
     TransferManager,
     format_node_to_booted_image_transfer_cmd,
     validate_cp,
+    validate_node_set_cp,
 )
 from walt.server.processes.main.unix import UnixSocketServer
 from walt.server.processes.main.vpn import VPNManager
@@ -51,6 +56,8 @@ class Server(object):
         self.ev_loop = ev_loop
         self.db = db
         self.db.configure()
+        self.autocomplete_index = CompletionIndex(self)
+        self.change_feeds = ChangeFeeds()
         self.registry = WalTLocalRegistry()
         self.blocking = blocking
         self.blocking.configure(self)
@@ -313,9 +320,10 @@ class Server(object):
             do(f"iptables --delete WALT --source '{device.ip}' --jump ACCEPT")
         self.logs.forget_device(device)
         self.db.forget_device(device.mac)
+        self.autocomplete_index.invalidate_devices()
         self.dhcpd.update()
         self.named.update()
-        self.nodes.forget_device(device.mac)
+        self.nodes.forget_device(device)
         wf.next()
 
     def wf_unblock_client(self, wf, task, **env):
@@ -477,6 +485,9 @@ class Server(object):
     def validate_cp(self, task, requester, image_or_node_label, src, dst):
         return validate_cp(task, image_or_node_label, self, requester, src, dst)
 
+    def validate_node_set_cp(self, task, requester, src, dst):
+        return validate_node_set_cp(task, self, requester, src, dst)
+
     def node_cp_to_booted_image(
         self, requester, task, api_session, node_name, **path_info
     ):
@@ -512,8 +523,13 @@ class Server(object):
         requester.set_busy_label("Transfering")
         self.blocking.run_shell_cmd(requester, cb, cmd, shell=True)
 
-    def shell_autocomplete(self, task, requester, username, argv, debug=False):
-        return shell_autocomplete(self, task, requester, username, argv, debug=debug)
+    def shell_autocomplete(self, task, requester, username, argv, debug=False,
+                           with_generation=False):
+        return shell_autocomplete(self, task, requester, username, argv,
+                                  debug=debug, with_generation=with_generation)
+
+    def get_autocomplete_generation(self, argv):
+        return self.autocomplete_index.get_generation(argv[0])
 
     def get_client_install_wheels(self):
         p = Path(__file__)
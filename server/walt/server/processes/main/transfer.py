@@ -1,7 +1,16 @@
 import os
 import random
-
-from walt.common.tcp import Requests
+import shlex
+import shutil
+import stat
+import tempfile
+import time
+from collections import deque
+from functools import cache
+from subprocess import DEVNULL, PIPE, Popen
+
+from walt.common.evloop import POLL_OPS_WRITE
+from walt.common.tcp import Requests, write_pickle
 from walt.server.const import SSH_NODE_COMMAND
 from walt.server.mount.setup import script_path
 from walt.server.processes.main.parallel import ParallelProcessSocketListener
@@ -39,6 +48,18 @@ Regular files as well as directories are accepted.
 )
 
 NODE_TFTP_ROOT = "/var/lib/walt/nodes/%(node_id)s/tftp"
+FAKE_TFTP_SENDFILE_CHUNK = 256 * 1024
+NODE_CP_FANOUT_MAX_PARALLEL = 16
+NODE_CP_FANOUT_RECV_SIZE = 256 * 1024
+NODE_CP_FANOUT_MAX_SPOOL_SIZE = 4 * 1024 * 1024 * 1024
+NODE_CP_FANOUT_VALIDITY = 600   # seconds
+NODE_CP_FANOUT_STDERR_TAIL = 4096
+
+# stream compressors: name -> (compress command, decompress command)
+TAR_COMPRESSORS = {
+    "zstd": ("zstd -q -c -T0 -%(level)d", "zstd -q -d -c"),
+    "lz4": ("lz4 -q -c -%(level)d", "lz4 -q -d -c"),
+}
 
 
 class ClientFilesystemWorkflow:
@@ -295,7 +316,51 @@ TarReceiveCommand = """\
         cd %(dst_dir)s && tar x"""
 
 
-class ImageTarSender(ParallelProcessSocketListener):
+@cache
+def get_available_compressors():
+    return tuple(name for name in TAR_COMPRESSORS if shutil.which(name) is not None)
+
+
+class TarTransferListener(ParallelProcessSocketListener):
+    """Base class of tar transfers, with optional stream compression.
+
+    The READY message lists the compressors available on this server;
+    the client may then select one in the parameters it sends
+    (compression=(<name>, <level>)) and the command is then wrapped in
+    a shell pipeline compressing its output (senders) or decompressing
+    its input (receivers).
+    """
+    SENDER = True
+
+    def get_ready_message(self):
+        return " ".join(("READY",) + get_available_compressors()) + "\n"
+
+    def prepare(self, compression=None, **params):
+        if compression is not None:
+            name, level = compression
+            if (name not in get_available_compressors() or
+                    not isinstance(level, int)):
+                self.send_error("INVALID COMPRESSION PARAMETERS")
+                return False
+        return True
+
+    def send_error(self, msg):
+        self.send_client(msg + "\n")
+
+    def start(self):
+        compression = self.params.get("compression")
+        if compression is not None:
+            name, level = compression
+            compress_cmd, decompress_cmd = TAR_COMPRESSORS[name]
+            if self.SENDER:
+                pipeline = f"{self.params['cmd']} | {compress_cmd % dict(level=level)}"
+            else:
+                pipeline = f"{decompress_cmd} | {self.params['cmd']}"
+            self.params["cmd"] = "sh -c " + shlex.quote(pipeline)
+        return ParallelProcessSocketListener.start(self)
+
+
+class ImageTarSender(TarTransferListener):
     REQ_ID = Requests.REQ_TAR_FROM_IMAGE
 
     def get_command(self, src_path, **params):
@@ -305,14 +370,15 @@ class ImageTarSender(ParallelProcessSocketListener):
         )
 
 
-class ImageTarReceiver(ParallelProcessSocketListener):
+class ImageTarReceiver(TarTransferListener):
     REQ_ID = Requests.REQ_TAR_TO_IMAGE
+    SENDER = False
 
     def get_command(self, **params):
         return docker_wrap_cmd(TarReceiveCommand, input_needed=True) % params
 
 
-class NodeTarSender(ParallelProcessSocketListener):
+class NodeTarSender(TarTransferListener):
     REQ_ID = Requests.REQ_TAR_FROM_NODE
 
     def get_command(self, src_path, **params):
@@ -322,8 +388,9 @@ class NodeTarSender(ParallelProcessSocketListener):
         )
 
 
-class NodeTarReceiver(ParallelProcessSocketListener):
+class NodeTarReceiver(TarTransferListener):
     REQ_ID = Requests.REQ_TAR_TO_NODE
+    SENDER = False
 
     def get_command(self, **params):
         return ssh_wrap_cmd(TarReceiveCommand) % params
@@ -342,8 +409,21 @@ class ImageBuildTarReceiver(ParallelProcessSocketListener):
 
 
 class NodeFakeTFTPGet(ParallelProcessSocketListener):
+    """Send a boot file to a node using the fake TFTP protocol.
+
+    Many nodes may request their boot files at the same time (e.g.,
+    after a fleet-wide reboot) and these files are usually small
+    (kernel, dtb files, etc.). So instead of forking a process per
+    request, we send the file directly from the event loop, using
+    os.sendfile() each time the socket is writable.
+    """
     REQ_ID = Requests.REQ_FAKE_TFTP_GET
 
+    def __init__(self, *args, **kwargs):
+        self._file_fd = None
+        self._offset, self._remaining = 0, 0
+        ParallelProcessSocketListener.__init__(self, *args, **kwargs)
+
     def prepare(self, node_mac=None, node_ip=None, **params):
         if node_mac is not None:
             params["node_id"] = node_mac
@@ -353,22 +433,57 @@ class NodeFakeTFTPGet(ParallelProcessSocketListener):
             self.send_client("NO MAC OR IP SPECIFIED\n")
             return False
         full_path = (NODE_TFTP_ROOT + "%(path)s") % params
-        if os.path.exists(full_path):
-            self.send_client("OK\n")
-            # send file length
-            # (client will be able to close connection immediately after
-            # the transfer, this is faster than detecting the end of the
-            # 'cat' command)
-            self.send_client(str(os.stat(full_path).st_size) + "\n")
-            # save full_path for get_command() below
-            self.params["full_path"] = full_path
-            return True
-        else:
+        try:
+            file_fd = os.open(full_path, os.O_RDONLY)
+        except OSError:
             self.send_client("NO SUCH FILE\n")
             return False
+        file_stat = os.fstat(file_fd)
+        if not stat.S_ISREG(file_stat.st_mode):
+            os.close(file_fd)
+            self.send_client("NO SUCH FILE\n")
+            return False
+        self._file_fd, self._remaining = file_fd, file_stat.st_size
+        self.send_client("OK\n")
+        # send file length
+        # (client will be able to close connection immediately after
+        # the transfer, this is faster than detecting the end of the
+        # connection)
+        self.send_client(str(file_stat.st_size) + "\n")
+        return True
 
     def get_command(self, **params):
-        return 'cat "%(full_path)s"' % params
+        return None  # no command, see start()
+
+    def start(self):
+        # from now on, we just wait for the socket to be writable
+        os.set_blocking(self.fileno(), False)
+        self.ev_loop.update_listener(self, POLL_OPS_WRITE)
+        return True
+
+    def handle_event(self, ts):
+        if self._file_fd is None:
+            return ParallelProcessSocketListener.handle_event(self, ts)
+        sock_fd = self.fileno()
+        try:
+            while self._remaining > 0:
+                sent = os.sendfile(sock_fd, self._file_fd, self._offset,
+                                   min(self._remaining, FAKE_TFTP_SENDFILE_CHUNK))
+                if sent == 0:
+                    return False  # file was truncated
+                self._offset += sent
+                self._remaining -= sent
+        except BlockingIOError:
+            return True  # socket buffer is full, wait until writable again
+        except OSError:
+            return False  # client probably disconnected
+        return False  # done, this will call self.close()
+
+    def close(self):
+        if self._file_fd is not None:
+            os.close(self._file_fd)
+            self._file_fd = None
+        ParallelProcessSocketListener.close(self)
 
 
 class VPNNodeImageDump(ParallelProcessSocketListener):
@@ -395,6 +510,303 @@ class VPNNodeImageDump(ParallelProcessSocketListener):
         )
 
 
+class BoundedParallelRunner:
+    """Call start_item(item, done_cb) for each item, with at most
+    max_parallel items in progress, then call on_done()."""
+
+    def __init__(self, items, start_item, on_done,
+                 max_parallel=NODE_CP_FANOUT_MAX_PARALLEL):
+        self._queue = deque(items)
+        self._num_pending = len(self._queue)
+        self._start_item = start_item
+        self._on_done = on_done
+        self._max_parallel = max_parallel
+
+    def run(self):
+        if self._num_pending == 0:
+            self._on_done()
+            return
+        for _ in range(min(self._max_parallel, self._num_pending)):
+            self._start_next()
+
+    def _start_next(self):
+        if len(self._queue) > 0:
+            self._start_item(self._queue.popleft(), self._item_done)
+
+    def _item_done(self):
+        self._num_pending -= 1
+        if self._num_pending == 0:
+            self._on_done()
+        else:
+            self._start_next()
+
+
+def _wf_fanout_after_ping(wf, alive, node, errors, done_cb, **env):
+    if alive:
+        wf.next()
+    else:
+        errors[node.name] = "Could not reach this node."
+        wf.interrupt()
+        done_cb()
+
+
+def _wf_fanout_check_dst_type(wf, ftype, node, path, errors, done_cb, **env):
+    if ftype != "d":
+        errors[node.name] = f"No such directory: {path}"
+    wf.next()
+    done_cb()
+
+
+def validate_node_set_cp(task, server, requester, src, dst):
+    """Validate 'walt node cp <local-path> <node-set>:<dir>'.
+
+    Node ownership and bootup are checked by the client beforehand.
+    The file or directory is sent once by the client and the server
+    then copies it to all nodes of the set (see NodeSetTarFanOut).
+    Destination directories of all nodes are checked in one batched
+    pass, with at most NODE_CP_FANOUT_MAX_PARALLEL nodes at once.
+    The valid nodes and the destination directory are kept on server
+    side (see PendingNodeSetCopies): the client just gets an identifier
+    to give back when sending the archive.
+    """
+    node_set, dst_path = dst.rsplit(":", 1)
+    nodes = server.nodes.parse_node_set(requester, node_set)
+    if nodes is None:
+        return RESPONSE_BAD
+    src_path = src.rstrip("/")
+    if requester.filesystem.get_file_type(src_path) is None:
+        requester.stderr.write("No such file or directory: %s\n" % src_path)
+        return RESPONSE_BAD
+    dst_path = dst_path.rstrip("/")
+    if not dst_path.startswith("/"):
+        dst_path = "./" + dst_path
+    if os.path.basename(src_path) == ".":
+        dst_name = "."
+    else:
+        dst_name = os.path.basename(src_path)
+    errors = {}
+    task.set_async()
+
+    def check_node(node, done_cb):
+        node_fs = server.nodes.filesystems[node.ip]
+        wf = Workflow([node_fs.wf_ping,
+                       _wf_fanout_after_ping,
+                       node_fs.wf_get_file_type,
+                       _wf_fanout_check_dst_type],
+                      node=node, path=dst_path, errors=errors,
+                      done_cb=done_cb)
+        wf.run()
+
+    def on_done():
+        valid_nodes = [(node.name, node.ip) for node in nodes
+                       if node.name not in errors]
+        copy_id = server.transfer.pending_node_set_copies.add(
+                valid_nodes, dst_path)
+        task.return_result(dict(
+            status="OK",
+            copy_id=copy_id,
+            nodes=[node_name for node_name, _ in valid_nodes],
+            errors=errors,
+            src_path=src_path,
+            dst_name=dst_name,
+        ))
+
+    BoundedParallelRunner(nodes, check_node, on_done).run()
+
+
+class PendingNodeSetCopies:
+    """Node set copies validated by validate_node_set_cp(), waiting for
+    the client to send the archive.
+
+    The client only gets back a random identifier, so that the target
+    nodes and the destination directory of the fan-out cannot be
+    altered in the parameters it sends to NodeSetTarFanOut.
+    """
+
+    def __init__(self):
+        self._copies = {}
+
+    def add(self, nodes, dst_dir):
+        now = time.time()
+        # forget copies the client never started
+        for copy_id, (ts, _, _) in tuple(self._copies.items()):
+            if ts < now - NODE_CP_FANOUT_VALIDITY:
+                del self._copies[copy_id]
+        copy_id = os.urandom(16).hex()
+        self._copies[copy_id] = (now, nodes, dst_dir)
+        return copy_id
+
+    def pop(self, copy_id):
+        """Return (<nodes>, <dst_dir>), or None if copy_id is unknown"""
+        copy_info = self._copies.pop(copy_id, None)
+        if copy_info is None:
+            return None
+        return copy_info[1:]
+
+
+def _read_tail(f, size):
+    f.seek(max(0, f.seek(0, os.SEEK_END) - size))
+    return f.read().decode("UTF-8", errors="replace").strip()
+
+
+class NodeSetTarFanOut(TarTransferListener):
+    """Receive a tar archive once and extract it on a set of nodes.
+
+    The archive (possibly compressed) is spooled to a temporary file
+    from the event loop (up to NODE_CP_FANOUT_MAX_SPOOL_SIZE bytes),
+    then a ssh+tar pipeline per node reads this file, with at most
+    NODE_CP_FANOUT_MAX_PARALLEL pipelines at once.
+    The client finally receives a pickled dict:
+    <node_name> -> "OK" or <error message>.
+    If the request is invalid, the client receives a pickled error
+    message instead.
+    """
+    REQ_ID = Requests.REQ_TAR_TO_NODES
+    SENDER = False
+
+    def __init__(self, *args, pending_copies, **kwargs):
+        self._pending_copies = pending_copies
+        self._nodes = None
+        self._spool = None
+        self._spool_size = 0
+        self._fanout_pending = False
+        TarTransferListener.__init__(self, *args, **kwargs)
+
+    def prepare(self, copy_id=None, **params):
+        copy_info = self._pending_copies.pop(copy_id)
+        if copy_info is None:
+            self.send_error("INVALID OR EXPIRED COPY ID")
+            return False
+        self._nodes, self._dst_dir = copy_info
+        self._results = {}
+        if TarTransferListener.prepare(self, **params) is False:
+            return False
+        self._spool = tempfile.NamedTemporaryFile(prefix="walt-node-cp-")
+        return True
+
+    def send_error(self, msg):
+        # the client only reads pickled messages
+        if self._nodes is None:
+            self._send_pickle(msg)
+        else:
+            self._report_all(msg)
+
+    def get_command(self, **params):
+        return None  # no command, see handle_event()
+
+    def start(self):
+        return True  # wait for the archive data
+
+    def handle_event(self, ts):
+        if self.params is None:
+            return ParallelProcessSocketListener.handle_event(self, ts)
+        try:
+            chunk = self.client_sock_file.read1(NODE_CP_FANOUT_RECV_SIZE)
+            if len(chunk) > 0:
+                self._spool_size += len(chunk)
+                if self._spool_size > NODE_CP_FANOUT_MAX_SPOOL_SIZE:
+                    max_gib = NODE_CP_FANOUT_MAX_SPOOL_SIZE // 1024**3
+                    self._report_all(
+                        f"Archive is too large (max {max_gib}GiB).")
+                    return False
+                self._spool.write(chunk)
+                return True
+            self._spool.flush()
+        except Exception as e:
+            print(self, "exception:", repr(e))
+            self._report_all("Server failed to receive the archive.")
+            return False
+        # client is done writing, start copying to nodes.
+        # returning False removes us from the event loop, but close()
+        # will keep the socket open until the fan-out is done.
+        self._fanout_pending = True
+        BoundedParallelRunner(self._nodes,
+                              self._copy_to_node,
+                              self._fanout_done).run()
+        return False
+
+    def _report_all(self, msg):
+        for node_name, _ in self._nodes:
+            self._results[node_name] = msg
+        self._send_results()
+
+    def _copy_to_node(self, node, done_cb):
+        # this pipeline is run without a local shell, and the destination
+        # directory is quoted for the remote shell of the node.
+        node_name, node_ip = node
+        remote_cmd = f"cd {shlex.quote(self._dst_dir)} && tar x"
+        ssh_args = shlex.split(SSH_NODE_COMMAND) + [f"root@{node_ip}", remote_cmd]
+        # stderr is redirected to a file, not a pipe, so that many error
+        # messages cannot block the pipeline
+        stderr_file = tempfile.TemporaryFile(prefix="walt-node-cp-")
+        # each pipeline reads the spool file with its own file offset
+        spool_fd = os.open(self._spool.name, os.O_RDONLY)
+        procs = []
+        try:
+            compression = self.params.get("compression")
+            if compression is None:
+                stdin = spool_fd
+            else:
+                decompress_cmd = TAR_COMPRESSORS[compression[0]][1]
+                procs.append(Popen(shlex.split(decompress_cmd), stdin=spool_fd,
+                                   stdout=PIPE, stderr=stderr_file))
+                stdin = procs[0].stdout
+            procs.append(Popen(ssh_args, stdin=stdin, stdout=DEVNULL,
+                               stderr=stderr_file))
+        except OSError as e:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            stderr_file.close()
+            self._results[node_name] = f"Failed to start the transfer: {e}"
+            done_cb()
+            return
+        finally:
+            os.close(spool_fd)
+            if compression is not None and len(procs) > 0:
+                procs[0].stdout.close()
+
+        def cb():
+            retcode = procs[-1].wait()
+            if retcode != 0:
+                # the decompressor may be left with unread input
+                for proc in procs[:-1]:
+                    proc.kill()
+            for proc in procs[:-1]:
+                proc.wait()
+            if retcode == 0:
+                self._results[node_name] = "OK"
+            else:
+                msg = _read_tail(stderr_file, NODE_CP_FANOUT_STDERR_TAIL)
+                self._results[node_name] = msg or f"Failed (exit code {retcode})"
+            stderr_file.close()
+            done_cb()
+
+        self.ev_loop.auto_waitpid(procs[-1].pid, cb)
+
+    def _fanout_done(self):
+        self._fanout_pending = False
+        self._send_results()
+        self.close()
+
+    def _send_results(self):
+        self._send_pickle(self._results)
+
+    def _send_pickle(self, obj):
+        try:
+            write_pickle(obj, self.client_sock_file)
+        except Exception as e:
+            print(self, "exception:", repr(e))
+
+    def close(self):
+        if self._fanout_pending:
+            return  # we will close when the fan-out is done
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        ParallelProcessSocketListener.close(self)
+
+
 class TransferManager(object):
     def __init__(self, tcp_server, ev_loop):
         for cls in [
@@ -409,6 +821,13 @@ class TransferManager(object):
             tcp_server.register_listener_class(
                 req_id=cls.REQ_ID, cls=cls, ev_loop=ev_loop
             )
+        self.pending_node_set_copies = PendingNodeSetCopies()
+        tcp_server.register_listener_class(
+            req_id=NodeSetTarFanOut.REQ_ID,
+            cls=NodeSetTarFanOut,
+            ev_loop=ev_loop,
+            pending_copies=self.pending_node_set_copies,
+        )
 
 
 def format_node_to_booted_image_transfer_cmd(src_path, **params):
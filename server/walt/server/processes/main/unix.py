@@ -11,7 +11,13 @@ NODE_TFTP_ROOT = "/var/lib/walt/nodes/%(node_ip)s/tftp"
 
 class BaseUnixSocketListener:
 
+    def __init__(self, server, req_uid=None, **params):
+        self.server = server
+        self.req_uid = req_uid
+
     def send_resp_fd(self, s, peer_addr, resp, fd):
+        if self.req_uid is not None:
+            resp = dict(resp, req_uid=self.req_uid)
         try:
             if fd is None:
                 s.sendto(pickle.dumps(resp), peer_addr)
@@ -28,9 +34,6 @@ class BaseUnixSocketListener:
 class VPNEnrollListener(BaseUnixSocketListener):
     REQ_ID = Requests.REQ_VPN_ENROLL
 
-    def __init__(self, server, **params):
-        self.server = server
-
     def run(self, s, peer_addr, node_ip, pubkey, **params):
         result = self.server.vpn.enrollment(ip=node_ip, pubkey=pubkey)
         self.send_resp(s, peer_addr, result)
@@ -39,9 +42,6 @@ class VPNEnrollListener(BaseUnixSocketListener):
 class FileGeneratorListener(BaseUnixSocketListener):
     REQ_ID = Requests.REQ_GENERATE_FILE
 
-    def __init__(self, server, **params):
-        self.server = server
-
     def run(self, s, peer_addr, file_id, node_ip=None):
         if file_id == "ssh-ep-host-keys":
             result = self.server.vpn.generate_ssh_ep_host_keys()
@@ -55,9 +55,6 @@ class FileGeneratorListener(BaseUnixSocketListener):
 class PropertyListener(BaseUnixSocketListener):
     REQ_ID = Requests.REQ_PROPERTY
 
-    def __init__(self, server, **params):
-        self.server = server
-
     def get_entrypoint_property(self, proto):
         ep = self.server.vpn.get_vpn_entrypoint(proto)
         if ep is None:
@@ -87,9 +84,6 @@ class PropertyListener(BaseUnixSocketListener):
 class FakeTFTPGetFDListener(BaseUnixSocketListener):
     REQ_ID = Requests.REQ_FAKE_TFTP_GET_FD
 
-    def __init__(self, server, **params):
-        self.server = server
-
     def run(self, s, peer_addr, node_ip, path):
         full_path = (NODE_TFTP_ROOT % {"node_ip": node_ip}) + path
         if not os.path.exists(full_path):
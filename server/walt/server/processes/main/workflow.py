@@ -2,16 +2,110 @@ import functools
 import numpy as np
 import sys
 
+from collections import deque
+from time import monotonic
+
+# number of events kept in the ring buffer of WorkflowTrace
+WORKFLOW_TRACE_SIZE = 65536
+
+
+def _step_func(step):
+    # return the function of a step, without the object of a bound
+    # method or the arguments of a partial(), for the trace not to
+    # keep them alive
+    while isinstance(step, functools.partial):
+        # see map_as_parallel_steps()
+        if step.func is Workflow._mapped_parallel_step:
+            step = step.args[0]
+        else:
+            step = step.func
+    step = getattr(step, "__func__", step)
+    if not hasattr(step, "__qualname__"):
+        step = type(step)  # callable object
+    return step
+
+
+class WorkflowTrace:
+    """Records the latest workflow events in a ring buffer.
+
+    Recording an event costs a call to monotonic() and a deque append
+    of a small tuple, so tracing is enabled by default. For steps, only
+    the step function is kept (not the object of a bound method or the
+    arguments of a partial()), and step names are only computed on
+    export.
+    """
+
+    def __init__(self, size=WORKFLOW_TRACE_SIZE):
+        self.enabled = True
+        self._events = deque(maxlen=size)
+
+    def record(self, *event):
+        self._events.append(event)
+
+    def record_step(self, wf_id, step, t0, t1):
+        # we keep the function of the step only, to avoid keeping its
+        # object or arguments alive; names are computed on export.
+        self._events.append(("step", wf_id, _step_func(step), t0, t1))
+
+    def clear(self):
+        self._events.clear()
+
+    def export_chrome_trace(self):
+        """Return the events in Chrome trace format, suitable for
+        chrome://tracing, https://ui.perfetto.dev or speedscope.
+        Each workflow is a separate thread (tid=<workflow-id>)."""
+        trace_events, wf_names = [], {}
+        for event in self._events:
+            kind, wf_id = event[0], event[1]
+            common = dict(cat="workflow", pid=1, tid=wf_id)
+            if kind == "step":
+                step_func, t0, t1 = event[2:]
+                name = step_func.__qualname__
+                trace_events.append(dict(name=name, ph="X", ts=t0 * 1e6,
+                                         dur=(t1 - t0) * 1e6, **common))
+                wf_names.setdefault(wf_id, name)
+            elif kind == "parallel":
+                branch_funcs, t0, t1 = event[2:]
+                branch_names = [f.__qualname__ for f in branch_funcs]
+                trace_events.append(dict(
+                    name=f"parallel({len(branch_names)})", ph="X",
+                    ts=t0 * 1e6, dur=(t1 - t0) * 1e6,
+                    args=dict(branches=branch_names), **common))
+            elif kind == "branch-end":
+                remaining, t = event[2:]
+                trace_events.append(dict(
+                    name="branch-end", ph="i", s="t", ts=t * 1e6,
+                    args=dict(remaining=remaining), **common))
+            elif kind == "wait":
+                other_wf_id, t = event[2:]
+                trace_events.append(dict(
+                    name=f"wait Workflow{other_wf_id}", ph="i", s="t",
+                    ts=t * 1e6, args=dict(other=other_wf_id), **common))
+            elif kind == "end":
+                t0, t1 = event[2:]
+                trace_events.append(dict(name="workflow", ph="X", ts=t0 * 1e6,
+                                         dur=(t1 - t0) * 1e6, **common))
+        for wf_id, name in wf_names.items():
+            trace_events.append(dict(
+                name="thread_name", ph="M", pid=1, tid=wf_id,
+                args=dict(name=f"Workflow{wf_id}: {name}")))
+        return dict(traceEvents=trace_events, displayTimeUnit="ms")
+
+
 
 class Workflow:
     _next_id = 0
     _instances = {}
+    trace = WorkflowTrace()
     def __init__(self, steps, **env):
         self._id = Workflow._next_id
         Workflow._next_id += 1
-        self._steps = list(steps)
+        self._steps = deque(steps)
         self._env = env
         self._end_callbacks = []
+        self._trace_start = monotonic()
+        self._trace_step = None
+        self._trace_parallel = None
         Workflow._instances[self._id] = self
         #print(f"new {self}")
 
@@ -26,14 +120,29 @@ class Workflow:
         return self._end_callbacks is None
 
     def next(self, *args, **kwargs):
+        trace = Workflow.trace
+        if trace.enabled:
+            t = monotonic()
+            if self._trace_step is not None:
+                # record the end of the previous step
+                trace.record_step(self._id, *self._trace_step, t)
+                self._trace_step = None
         if len(self._steps) > 0:
-            step, self._steps = self._steps[0], self._steps[1:]
-            env = self._env.copy()
-            env.update(**kwargs)
+            step = self._steps.popleft()
             #print(f"<Workflow{self._id}>.next()", step)
-            step(self, *args, **env)
+            if trace.enabled and step not in Workflow._untraced_steps:
+                self._trace_step = (step, t)
+            # note: the ** syntax already passes a new dict to the step,
+            # so we do not need to copy self._env ourselves. keyword
+            # arguments of next() only apply to this step.
+            if len(kwargs) == 0:
+                step(self, *args, **self._env)
+            else:
+                step(self, *args, **{**self._env, **kwargs})
         elif not self.done:  # because wf.interrupt() may be called at any time
             #print(f"<Workflow{self._id}> end")
+            if trace.enabled:
+                trace.record("end", self._id, self._trace_start, t)
             end_callbacks = self._end_callbacks
             self._end_callbacks = None
             for cb in end_callbacks:
@@ -41,11 +150,11 @@ class Workflow:
             del Workflow._instances[self._id]
 
     def interrupt(self):
-        self._steps = []
+        self._steps.clear()
         self.next()  # end properly and call optional callbacks
 
     def update_env(self, **env):
-        self._env.update(**env)
+        self._env.update(env)
 
     def run(self):
         self.next()
@@ -64,15 +173,18 @@ class Workflow:
         Workflow._instances = {}
 
     def insert_steps(self, steps):
-        self._steps = list(steps) + self._steps
+        self._steps.extendleft(reversed(list(steps)))
 
     def append_steps(self, steps):
-        self._steps = self._steps + list(steps)
+        self._steps.extend(steps)
 
     @staticmethod
     def _wf_run_parallel_steps(wf, _parallel_steps, **env):
         num_parallel_steps = len(_parallel_steps)
         wf.update_env(_remaining_parallel_steps = num_parallel_steps)
+        if Workflow.trace.enabled:
+            wf._trace_parallel = (
+                [_step_func(step) for step in _parallel_steps], monotonic())
         wf.insert_steps([wf._wf_after_one_parallel_step] * num_parallel_steps)
         for step in _parallel_steps:
             step(wf, **env)
@@ -80,11 +192,21 @@ class Workflow:
     @staticmethod
     def _wf_after_one_parallel_step(wf, _remaining_parallel_steps, **env):
         _remaining_parallel_steps -= 1
+        if Workflow.trace.enabled:
+            wf._trace_parallel_branch_end(_remaining_parallel_steps)
         if _remaining_parallel_steps == 0:
             wf.next()  # all parallel steps are done
         else:
             wf.update_env(_remaining_parallel_steps = _remaining_parallel_steps)
 
+    def _trace_parallel_branch_end(self, remaining):
+        t = monotonic()
+        Workflow.trace.record("branch-end", self._id, remaining, t)
+        if remaining == 0 and self._trace_parallel is not None:
+            branch_funcs, t0 = self._trace_parallel
+            self._trace_parallel = None
+            Workflow.trace.record("parallel", self._id, branch_funcs, t0, t)
+
     def insert_parallel_steps(self, steps):
         self.update_env(_parallel_steps = steps)
         self.insert_steps([self._wf_run_parallel_steps])
@@ -105,6 +227,8 @@ class Workflow:
 
     def continue_after_other_workflow(self, other_wf):
         #print("continue_after_other_workflow")
+        if Workflow.trace.enabled:
+            Workflow.trace.record("wait", self._id, other_wf._id, monotonic())
         other_wf._end_callbacks.append(self.next)
 
     def print_missed(self):
@@ -124,3 +248,9 @@ class Workflow:
             self.print_missed()
             print(f"{self} was not ended when garbage collected.", file=sys.stderr)
             del Workflow._instances[self._id]
+
+
+# internal steps are not recorded as steps, parallel sections
+# are recorded instead
+Workflow._untraced_steps = (Workflow._wf_run_parallel_steps,
+                            Workflow._wf_after_one_parallel_step)
@@ -1,4 +1,6 @@
 import bottle
+import gevent
+import hashlib
 import json
 import os
 import sdnotify
@@ -6,11 +8,14 @@ import shlex
 import socket
 import walt
 
-from functools import lru_cache
-from gevent.fileobject import FileObject
-from gevent.lock import RLock as Lock
-from gevent.pywsgi import WSGIServer
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from functools import cache, lru_cache
+from gevent import pywsgi
+from gevent import socket as gsocket
 from gevent import subprocess
+from gevent.event import AsyncResult
+from gevent.socket import wait_write
 from pathlib import Path
 from time import time
 from walt.common.apilink import ServerAPILink
@@ -60,73 +65,189 @@ HTML_DOC_DIR = str(files(walt) / "doc" / "html")
 WALT_T0 = 1340000000  # Epoch timestamp corresponding to some time in june 2012
 HTTP_BOOT_SERVER_PRIV_KEY = Path("/var/lib/walt/http-boot/private.pem")
 HTTP_BOOT_SERVER_PUB_KEY = Path("/var/lib/walt/http-boot/public.pem")
+HTTP_BOOT_SIG_CACHE_DIR = Path("/var/cache/walt/http-boot-sig")
 
 
-# this will hold the socket to walt-server-daemon
-s_conn = None
-# this will allow to serialize communication with the server on
-# the unix socket
-s_lock = Lock()
+BOOT_FILE_CACHE_TTL = 3  # seconds
 
 
-def open_from_server_daemon(path, node_ip):
-    req_id = UnixRequests.REQ_FAKE_TFTP_GET_FD
-    args = ()
-    kwargs = dict(node_ip=node_ip, path=path)
-    fds = query_main_daemon(req_id, args, kwargs, maxfds=1)
-    if isinstance(fds, Exception):
-        raise fds
-    assert len(fds) == 1
-    fd = fds[0]
-    return fd
-
-
-def query_main_daemon(req_id, args, kwargs, msglen=256, maxfds=0):
-    with s_lock:
-        return _query_main_daemon(req_id, args, kwargs, msglen, maxfds)
-
-
-def _query_main_daemon(req_id, args, kwargs, msglen, maxfds):
-    global s_conn
-    req = req_id, args, kwargs
-    error = "Unknown error, sorry."
-    for i in range(2):
-        if s_conn is None:
-            s_conn = get_socket()
-        try:
-            # send message
-            s_conn.send(pickle.dumps(req))
-            # receive the response
-            if maxfds > 0:
-                msg, fds = recv_msg_fds(s_conn, msglen, maxfds)
-            else:
-                msg = s_conn.recv(msglen)
+class MainDaemonClient:
+    """Concurrent queries to walt-server-daemon over its unix socket.
+
+    Each request carries a unique id, echoed back by walt-server-daemon
+    in its response, so that several greenlets can wait for their
+    response at the same time: a reader greenlet dispatches incoming
+    responses (and file descriptors) to them.
+    """
+    def __init__(self):
+        self._sock = None
+        self._pending = {}
+        self._req_uid = 0
+
+    def _get_socket(self):
+        if self._sock is None:
+            s = gsocket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            bind_to_random_sockname(s)
+            s.connect(UNIX_SERVER_SOCK_PATH)
+            self._sock = s
+            gevent.spawn(self._read_responses, s)
+        return self._sock
+
+    def _reset_socket(self, s):
+        if s is not None and self._sock is s:
+            self._sock = None
+            s.close()
+
+    def _read_responses(self, s):
+        while True:
+            try:
+                msg, fds = recv_msg_fds(s, 65536, 1)
+            except OSError:
+                self._reset_socket(s)
+                return
             resp = pickle.loads(msg)
-            # return result
-            assert "status" in resp
-            if resp["status"] == "OK":
-                if maxfds > 0:
-                    return fds
-                elif "response_text" in resp:
-                    return resp["response_text"]
-                else:
-                    return "OK\n"
-            else:
-                assert "error_msg" in resp
-                error = resp["error_msg"]
-                continue
-        except OSError as e:
-            if i == 0:
-                # try to re-init the socket to walt-server-daemon
-                s_conn.close()
-                s_conn = None
+            result = self._pending.pop(resp.get("req_uid"), None)
+            if result is None:
+                # the requester gave up (timeout)
+                for fd in fds:
+                    os.close(fd)
                 continue
+            result.set((resp, fds))
+
+    def _query(self, req_id, args, kwargs):
+        self._req_uid += 1
+        req_uid = self._req_uid
+        result = AsyncResult()
+        self._pending[req_uid] = result
+        s = None
+        try:
+            s = self._get_socket()
+            s.send(pickle.dumps((req_id, args, kwargs, req_uid)))
+            return result.get(timeout=MAIN_DAEMON_SOCKET_TIMEOUT)
+        except gevent.Timeout:
+            self._reset_socket(s)
+            raise OSError("Timed out waiting for walt-server-daemon.")
+        except OSError:
+            self._reset_socket(s)
+            raise
+        finally:
+            self._pending.pop(req_uid, None)
+
+    def query(self, req_id, args, kwargs, with_fds=False):
+        for i in range(2):
+            try:
+                resp, fds = self._query(req_id, args, kwargs)
+                break
+            except OSError as e:
+                # on first error, retry with a new socket
+                if i == 1:
+                    return bottle.HTTPError(500, str(e))
+        # return result
+        assert "status" in resp
+        if resp["status"] == "OK":
+            if with_fds:
+                return fds
+            elif "response_text" in resp:
+                return resp["response_text"]
             else:
-                return bottle.HTTPError(500, str(e))
-    if error == "NO SUCH FILE":
-        return bottle.HTTPError(404, "No such file.")
-    else:
-        return bottle.HTTPError(400, error)
+                return "OK\n"
+        assert "error_msg" in resp
+        error = resp["error_msg"]
+        if error == "NO SUCH FILE":
+            return bottle.HTTPError(404, "No such file.")
+        else:
+            return bottle.HTTPError(400, error)
+
+
+class BootFileCache:
+    """Short-TTL cache of boot files retrieved from walt-server-daemon.
+
+    Entries map (node_ip, path) to a file identity (device, inode, size,
+    mtime), and each file identity to an open file descriptor. When many
+    nodes boot at the same time, they usually request the same files of
+    the same image, so they share the same file descriptor.
+    Concurrent lookups of the same (node_ip, path) wait for a single
+    query to walt-server-daemon.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._fds = {}
+        self._resolving = {}
+        self._next_expiry_check = 0
+
+    def _expire(self, now):
+        if now < self._next_expiry_check:
+            return
+        self._next_expiry_check = now + BOOT_FILE_CACHE_TTL
+        self._entries = {
+            key: entry for key, entry in self._entries.items() if entry[0] > now
+        }
+        used_file_ids = set(entry[1] for entry in self._entries.values())
+        for file_id in list(self._fds):
+            if file_id not in used_file_ids:
+                os.close(self._fds.pop(file_id))
+
+    def _resolve(self, key):
+        result = self._resolving.get(key)
+        if result is not None:
+            return result.get()  # another greenlet is querying
+        result = AsyncResult()
+        self._resolving[key] = result
+        try:
+            node_ip, path = key
+            kwargs = dict(node_ip=node_ip, path=path)
+            fds = main_daemon.query(UnixRequests.REQ_FAKE_TFTP_GET_FD,
+                                    (), kwargs, with_fds=True)
+            if isinstance(fds, Exception):
+                raise fds
+            assert len(fds) == 1
+            fd = fds[0]
+            stat = os.fstat(fd)
+            file_id = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if file_id in self._fds:
+                os.close(fd)
+            else:
+                self._fds[file_id] = fd
+            self._entries[key] = (time() + BOOT_FILE_CACHE_TTL, file_id)
+            result.set(file_id)
+            return file_id
+        except BaseException as e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self._resolving[key]
+
+    def open(self, node_ip, path):
+        """Return a new file descriptor and the identity of the file"""
+        now = time()
+        self._expire(now)
+        key = (node_ip, path)
+        entry = self._entries.get(key)
+        if entry is None:
+            file_id = self._resolve(key)
+        else:
+            file_id = entry[1]
+        # note: the caller is responsible for closing this new fd
+        return os.dup(self._fds[file_id]), file_id
+
+
+main_daemon = MainDaemonClient()
+boot_files = BootFileCache()
+
+
+def open_from_server_daemon(path, node_ip):
+    return boot_files.open(node_ip, path)
+
+
+def query_main_daemon(req_id, args, kwargs):
+    return main_daemon.query(req_id, args, kwargs)
+
+
+def boot_file_response(fd, file_id):
+    bottle.response.add_header("Content-Length", file_id[2])
+    # note: walt-server-httpd sends this file with os.sendfile(),
+    # see SendFileWrapper below.
+    return open(fd, "rb")
 
 
 def requester_ip():
@@ -153,7 +274,7 @@ def vpn_enroll(node_ip, pubkey_file):
 def dump_generated_file(file_id, **kwargs):
     req_id = UnixRequests.REQ_GENERATE_FILE
     kwargs.update(file_id=file_id)
-    return query_main_daemon(req_id, (), kwargs, msglen=65536)
+    return query_main_daemon(req_id, (), kwargs)
 
 
 def get_property_value(property_id, **kwargs):
@@ -177,14 +298,6 @@ def notify_systemd():
         sdnotify.SystemdNotifier().notify("READY=1")
 
 
-def get_socket():
-    s_conn = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-    bind_to_random_sockname(s_conn)
-    s_conn.settimeout(MAIN_DAEMON_SOCKET_TIMEOUT)
-    s_conn.connect(UNIX_SERVER_SOCK_PATH)
-    return s_conn
-
-
 def _web_api_v1(entry):
     query_params = dict(bottle.request.query.decode())
     with ServerAPILink("localhost", "SSAPI") as server:
@@ -229,42 +342,72 @@ def _get_logs(ts_from, ts_to, ts_unit, issuers, streams_regexp):
     )
 
 
-_cache_context = {}
+def _pread_all(fd):
+    chunks, offset = [], 0
+    while True:
+        chunk = os.pread(fd, 1 << 20, offset)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        offset += len(chunk)
 
 
-@lru_cache
-def _generate_boot_sig(key):
+@cache
+def _get_boot_server_priv_key():
+    return serialization.load_pem_private_key(
+            HTTP_BOOT_SERVER_PRIV_KEY.read_bytes(), password=None)
+
+
+@cache
+def _get_boot_server_key_id():
+    pub_key = _get_boot_server_priv_key().public_key().public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(pub_key).hexdigest()[:16]
+
+
+def _compute_boot_sig(fd):
     # notes:
-    # * we had to pass fd using a _cache_context global
-    #   variable and not as a parameter because it should
-    #   not be taken into account by lru_cache for cache
-    #   lookup.
-    # * for coherency between cache and non-cache paths
-    #   it is important not to close fd here (thus the
-    #   parameter closefd=False)
-    fd = _cache_context["fd"]
-    boot_img = FileObject(fd, mode="rb", closefd=False)
-    boot_img_content = boot_img.read()
-    boot_img.close()
-    cmd = f"openssl dgst -sha256 -hex"
-    res = subprocess.run(shlex.split(cmd),
-                         input=boot_img_content,
-                         capture_output=True)
-    sha256 = res.stdout.decode().split()[1]
-    cmd = f"openssl dgst -sign {HTTP_BOOT_SERVER_PRIV_KEY} -sha256 -hex"
-    res = subprocess.run(shlex.split(cmd),
-                         input=boot_img_content,
-                         capture_output=True)
-    rsa2048 = res.stdout.decode().split()[1]
+    # * this function runs in a thread, to avoid blocking the event loop.
+    # * fd may share its file offset with other ones (see
+    #   BootFileCache), so we read it with pread().
+    # * signatures are saved on disk, keyed by the sha256 of the file
+    #   content and the identifier of the signing key, so they are still
+    #   available after walt-server-httpd restarts.
+    boot_img_content = _pread_all(fd)
+    sha256 = hashlib.sha256(boot_img_content).hexdigest()
+    sig_path = HTTP_BOOT_SIG_CACHE_DIR / f"{_get_boot_server_key_id()}-{sha256}"
+    if sig_path.exists():
+        return sig_path.read_text()
+    # the signature is equivalent to
+    # "openssl dgst -sign <priv-key> -sha256 -hex"
+    rsa2048 = _get_boot_server_priv_key().sign(
+            boot_img_content, padding.PKCS1v15(), hashes.SHA256()).hex()
     ts = int(time())
-    return f"{sha256}\nts: {ts}\nrsa2048: {rsa2048}\n"
+    boot_sig = f"{sha256}\nts: {ts}\nrsa2048: {rsa2048}\n"
+    sig_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = sig_path.parent / f".{sig_path.name}.tmp"
+    tmp_path.write_text(boot_sig)
+    tmp_path.rename(sig_path)
+    return boot_sig
 
 
-def get_boot_sig(fd):
-    stat =  os.fstat(fd)
-    key = (stat.st_ino, stat.st_mtime, stat.st_size)
+_cache_context = {}
+
+
+@lru_cache(maxsize=256)
+def _generate_boot_sig(file_id):
+    # note: we had to pass fd using a _cache_context global
+    # variable and not as a parameter because it should
+    # not be taken into account by lru_cache for cache
+    # lookup.
+    fd = _cache_context["fd"]
+    return gevent.get_hub().threadpool.apply(_compute_boot_sig, (fd,))
+
+
+def get_boot_sig(fd, file_id):
     _cache_context.update(fd=fd)
-    return _generate_boot_sig(key)
+    return _generate_boot_sig(file_id)
 
 
 def generate_boot_server_keys():
@@ -279,6 +422,58 @@ def generate_boot_server_keys():
         subprocess.run(shlex.split(cmd), check=True)
 
 
+class SendFileWrapper:
+    """wsgi.file_wrapper allowing WSGIHandler to use os.sendfile()"""
+    def __init__(self, filelike, block_size=65536):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        # fallback if sendfile cannot be used
+        # note: the file descriptor may share its file offset with
+        # other ones (see BootFileCache), so we use pread().
+        fd, offset = self.filelike.fileno(), 0
+        while True:
+            chunk = os.pread(fd, self.block_size, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.filelike.close()
+
+
+class WSGIHandler(pywsgi.WSGIHandler):
+    def get_environ(self):
+        env = super().get_environ()
+        env["wsgi.file_wrapper"] = SendFileWrapper
+        return env
+
+    def process_result(self):
+        if (isinstance(self.result, SendFileWrapper) and
+                self.status and not self.headers_sent):
+            self.write(b"")   # send headers
+            if not self.response_use_chunked:
+                self.response_length += self._sendfile(
+                        self.result.filelike.fileno())
+                return
+        super().process_result()
+
+    def _sendfile(self, fd):
+        sock_fd, offset, size = self.socket.fileno(), 0, os.fstat(fd).st_size
+        while offset < size:
+            try:
+                sent = os.sendfile(sock_fd, fd, offset, size - offset)
+            except BlockingIOError:
+                wait_write(sock_fd, timeout=self.socket.gettimeout())
+                continue
+            if sent == 0:
+                break   # file was truncated
+            offset += sent
+        return offset
+
+
 class MyBottle(bottle.Bottle):
     def default_error_handler(self, error):
         prefer_header = bottle.request.get_header("Prefer")
@@ -320,9 +515,8 @@ def run():
         node_ip = bottle.request.query.get("node_ip")
         if node_ip is None:
             node_ip = requester_ip()
-        fd = open_from_server_daemon(node_ip=node_ip, path="/"+path)
-        bottle.response.add_header("Content-Length", os.fstat(fd).st_size)
-        return FileObject(fd, mode="rb")
+        fd, file_id = open_from_server_daemon(node_ip=node_ip, path="/"+path)
+        return boot_file_response(fd, file_id)
 
     @app.route("/walt-vpn/per-ip/<path:path>")
     def serve_vpn_per_mac(path):
@@ -331,14 +525,14 @@ def run():
         if path == "boot.sig":
             # this file is generated from boot.img on the fly
             # because it includes a signature using the VPN private key
-            fd = open_from_server_daemon(node_ip=ip, path="/boot.img")
-            content = get_boot_sig(fd)
-            os.close(fd)
-            return content
+            fd, file_id = open_from_server_daemon(node_ip=ip, path="/boot.img")
+            try:
+                return get_boot_sig(fd, file_id)
+            finally:
+                os.close(fd)
         else:
-            fd = open_from_server_daemon(node_ip=ip, path="/"+path)
-            bottle.response.add_header("Content-Length", os.fstat(fd).st_size)
-            return FileObject(fd, mode="rb")
+            fd, file_id = open_from_server_daemon(node_ip=ip, path="/"+path)
+            return boot_file_response(fd, file_id)
 
     @app.route("/walt-vpn/enroll", method='POST')
     def serve_vpn_enroll():
@@ -461,6 +655,7 @@ def run():
         return _get_logs(ts_from, ts_to, ts_unit, issuers, streams_regexp)
 
     # run web app
-    server = WSGIServer(('', WALT_HTTPD_PORT), app)
+    server = pywsgi.WSGIServer(('', WALT_HTTPD_PORT), app,
+                               handler_class=WSGIHandler)
     notify_systemd()
     server.serve_forever()
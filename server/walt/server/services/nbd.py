@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
+import io
 import os
 import re
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryFile
 
 from walt.common.evloop import EventLoop
 from walt.common.tcp import set_sock_reuseaddr, set_tcp_nodelay, set_tcp_keepalive
+from walt.server.ext._c_ext.lib import _punch_hole, _zero_range
 from walt.server.tools import NetworkMsg, NetworkBuf
 
 
@@ -29,10 +33,29 @@ from walt.server.tools import NetworkMsg, NetworkBuf
 # server disk space unless the node really starts swapping.
 # The file is not visible on the disk (cf. tempfile.TemporaryFile
 # in python doc).
+#
+# The event loop only reads the requests sent by the clients (without
+# blocking, the socket may contain partial requests). The requests are
+# then handled by a pool of threads, and each thread sends its reply
+# when done, so the replies may be sent in a different order than the
+# requests, as allowed by the NBD protocol (the client identifies replies
+# by the request cookie). This way, a node swapping heavily (or slow disk
+# I/O) does not stall the other nodes.
+# NBD_CMD_TRIM and NBD_CMD_WRITE_ZEROES requests allow to release disk
+# space when the node no longer needs the swap areas (fallocate() with
+# FALLOC_FL_PUNCH_HOLE).
+# When a client has too many requests in progress (or too much write data
+# pending), the event loop stops reading its socket; the threads of the pool
+# ask the event loop to resume reading when enough requests are done (see
+# ResumeNotifier).
 
 
 SYSTEMD_FIRST_FD = 3
 LISTEN_BACKLOG = 10
+NUM_IO_THREADS = 16
+RECV_SIZE = 256*1024
+MAX_INFLIGHT_REQUESTS = 64
+MAX_INFLIGHT_BYTES = 16*1024*1024
 
 NBD_PORT = 10809
 NBD_FLAG_FIXED_NEWSTYLE = 0x1
@@ -51,6 +74,18 @@ NBD_INFO_BLOCK_SIZE = 3
 NBD_CMD_READ = 0
 NBD_CMD_WRITE = 1
 NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_TRIM = 4
+NBD_CMD_WRITE_ZEROES = 6
+NBD_CMD_FLAG_NO_HOLE = 1 << 1
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_SEND_TRIM = 1 << 5
+NBD_FLAG_SEND_WRITE_ZEROES = 1 << 6
+TRANSMISSION_FLAGS = (NBD_FLAG_HAS_FLAGS |
+                      NBD_FLAG_SEND_TRIM |
+                      NBD_FLAG_SEND_WRITE_ZEROES)
+NBD_EIO = 5
+NBD_EINVAL = 22
 
 SERVER_HANDSHAKE = NetworkMsg('!8s8sH',
                               b'NBDMAGIC', b'IHAVEOPT',
@@ -64,15 +99,15 @@ NBD_REQ_HEADER = NetworkMsg('!IHH8sQI')
 NBD_SIMPLE_REPLY_HEADER = NetworkMsg('!II8s', NBD_SIMPLE_REPLY_MAGIC)
 
 
-def handle_opt_go(netbuf):
-    name_len = NetworkMsg('!I').read(netbuf)
-    export_name = netbuf.read(name_len)
+def handle_opt_go(opt_buf, netbuf):
+    name_len = NetworkMsg('!I').read(opt_buf)
+    export_name = opt_buf.read(name_len)
     digits = re.sub(b'^swap-([0-9]+)G$', b'\\1', b'swap-16G')
     export_size = int(digits) * 1024 * 1024 * 1024
-    num_info_reqs = NetworkMsg('!H').read(netbuf)
+    num_info_reqs = NetworkMsg('!H').read(opt_buf)
     # ignore info reqs
     if num_info_reqs > 0:
-        netbuf.read(2*num_info_reqs)
+        opt_buf.read(2*num_info_reqs)
     # send NBD_OPT_GO response with block size info type
     info_block_size_msg = NBD_INFO_BLOCK_SIZE_MSG.format(
             MIN_BLOCK_SIZE, PREF_BLOCK_SIZE, MAX_BLOCK_SIZE)
@@ -80,7 +115,7 @@ def handle_opt_go(netbuf):
             NBD_OPT_GO, NBD_REP_INFO, len(info_block_size_msg))
     netbuf.write(resp_header + info_block_size_msg)
     # send NBD_OPT_GO response with export info type
-    info_export_msg = NBD_INFO_EXPORT_MSG.format(export_size, 0)
+    info_export_msg = NBD_INFO_EXPORT_MSG.format(export_size, TRANSMISSION_FLAGS)
     resp_header = NBD_OPT_RESP_HEADER.format(
             NBD_OPT_GO, NBD_REP_INFO, len(info_export_msg))
     netbuf.write(resp_header + info_export_msg)
@@ -89,20 +124,51 @@ def handle_opt_go(netbuf):
     return export_size
 
 
-def handle_request(netbuf, swap_file):
-    magic, flags, req_type, cookie, offset, length = NBD_REQ_HEADER.read(netbuf)
-    assert(magic == NBD_REQUEST_MAGIC)
+def handle_request(netbuf, swap_fd, req_type, flags, cookie, offset, length, data):
+    # note: this runs in a thread of the pool, and several threads may be
+    # handling requests of the same client at the same time.
     if req_type == NBD_CMD_READ:
-        NBD_SIMPLE_REPLY_HEADER.write(netbuf, 0, cookie)
-        netbuf.sendfile(swap_file, offset, length)
-    elif req_type == NBD_CMD_WRITE:
-        swap_file.seek(offset)
-        buf = netbuf.read(length)
-        swap_file.write(buf)
-        NBD_SIMPLE_REPLY_HEADER.write(netbuf, 0, cookie)
-    elif req_type == NBD_CMD_DISC:
-        return False
-    return True
+        with netbuf.send_lock:
+            NBD_SIMPLE_REPLY_HEADER.write(netbuf, 0, cookie)
+            netbuf.sendfile(swap_fd, offset, length)
+        return
+    error = 0
+    try:
+        if req_type == NBD_CMD_WRITE:
+            view = memoryview(data)
+            while len(view) > 0:
+                written = os.pwrite(swap_fd, view, offset)
+                view, offset = view[written:], offset + written
+        elif req_type in (NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES):
+            if req_type == NBD_CMD_WRITE_ZEROES and flags & NBD_CMD_FLAG_NO_HOLE:
+                res = _zero_range(swap_fd, offset, length)
+            else:
+                res = _punch_hole(swap_fd, offset, length)
+            if res < 0:
+                raise OSError(-res, os.strerror(-res))
+        else:
+            # other commands (e.g., NBD_CMD_FLUSH) were not negotiated
+            error = NBD_EINVAL
+    except OSError as e:
+        print(f"I/O error: {e}")
+        error = NBD_EIO
+    with netbuf.send_lock:
+        NBD_SIMPLE_REPLY_HEADER.write(netbuf, error, cookie)
+
+
+class ConnNetworkBuf(NetworkBuf):
+    # NetworkBuf allowing to send replies from several threads
+    def __init__(self, s):
+        super().__init__(s)
+        self.send_lock = threading.Lock()
+
+    def sendfile(self, fd, offset, length):
+        sock_fd = self.fileno()
+        while length > 0:
+            sent = os.sendfile(sock_fd, fd, offset, length)
+            if sent == 0:
+                raise Exception("Unexpected end of file")
+            offset, length = offset + sent, length - sent
 
 
 def get_server_sockets():
@@ -120,10 +186,47 @@ def get_server_sockets():
         return [serv_s]
 
 
+class ResumeNotifier:
+    # allows the threads of the pool to ask the event loop to resume
+    # reading the socket of paused clients
+    def __init__(self):
+        self._r, self._w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._lock = threading.Lock()
+        self._listeners = set()
+
+    def fileno(self):
+        return self._r
+
+    def notify(self, listener):
+        # note: this runs in a thread of the pool
+        with self._lock:
+            self._listeners.add(listener)
+        try:
+            os.write(self._w, b'\0')
+        except BlockingIOError:
+            pass  # the event loop already has notifications to read
+
+    def handle_event(self, ts):
+        try:
+            os.read(self._r, 4096)
+        except BlockingIOError:
+            pass
+        with self._lock:
+            listeners, self._listeners = self._listeners, set()
+        for listener in listeners:
+            listener.resume()
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
 class ServerSocketListener:
-    def __init__(self, ev_loop, serv_s):
+    def __init__(self, ev_loop, serv_s, io_pool, notifier):
         self._ev_loop = ev_loop
         self._serv_s = serv_s
+        self._io_pool = io_pool
+        self._notifier = notifier
 
     def fileno(self):
         return self._serv_s.fileno()
@@ -132,7 +235,8 @@ class ServerSocketListener:
         s = self._serv_s.accept()[0]
         set_tcp_nodelay(s)
         set_tcp_keepalive(s)
-        listener = CommSocketListener(s)
+        listener = CommSocketListener(self._ev_loop, s, self._io_pool,
+                                      self._notifier)
         listener.start_handshake()
         self._ev_loop.register_listener(listener)
 
@@ -145,13 +249,28 @@ class COMM_STATE:
     WAIT_CLIENT_FLAGS = 1
     WAIT_CLIENT_OPT = 2
     WAIT_CLIENT_REQUEST = 3
+    DISCONNECTING = 4
 
 
 class CommSocketListener:
-    def __init__(self, s):
+    def __init__(self, ev_loop, s, io_pool, notifier):
+        self._ev_loop = ev_loop
         self._step = COMM_STATE.INIT
-        self._netbuf = NetworkBuf(s)
+        self._netbuf = ConnNetworkBuf(s)
+        self._io_pool = io_pool
+        self._notifier = notifier
+        self._inbuf = bytearray()
         self._swap_file = None
+        self._export_size = None
+        # the socket and swap file are released when the event loop
+        # and all pending requests have released their reference
+        self._refs = 1
+        self._refs_lock = threading.Lock()
+        # requests being processed by the pool (protected by _refs_lock)
+        self._inflight_requests = 0
+        self._inflight_bytes = 0
+        self._paused = False
+        self._closed = False
 
     def start_handshake(self):
         SERVER_HANDSHAKE.write(self._netbuf)
@@ -160,41 +279,155 @@ class CommSocketListener:
     def fileno(self):
         return self._netbuf.fileno()
 
+    def _pop_input(self, length):
+        # return the next <length> bytes of input data,
+        # or None if not fully received yet
+        if len(self._inbuf) < length:
+            return None
+        data = bytes(self._inbuf[:length])
+        del self._inbuf[:length]
+        return data
+
+    def _handle_input(self):
+        # handle one message in self._inbuf, if complete, and return True
+        # in this case
+        if self._step == COMM_STATE.WAIT_CLIENT_FLAGS:
+            data = self._pop_input(CLIENT_FLAGS.size)
+            if data is None:
+                return False
+            client_flags = CLIENT_FLAGS.read(io.BytesIO(data))
+            assert(client_flags & NBD_FLAG_C_FIXED_NEWSTYLE > 0)
+            self._step = COMM_STATE.WAIT_CLIENT_OPT
+        elif self._step == COMM_STATE.WAIT_CLIENT_OPT:
+            if len(self._inbuf) < NBD_OPT_HEADER.size:
+                return False
+            magic, opt_type, opt_datalen = NBD_OPT_HEADER.read(
+                    io.BytesIO(self._inbuf[:NBD_OPT_HEADER.size]))
+            data = self._pop_input(NBD_OPT_HEADER.size + opt_datalen)
+            if data is None:
+                return False
+            assert(opt_type == NBD_OPT_GO)
+            opt_buf = io.BytesIO(data[NBD_OPT_HEADER.size:])
+            self._export_size = handle_opt_go(opt_buf, self._netbuf)
+            self._swap_file = TemporaryFile(buffering=0)
+            self._swap_file.truncate(self._export_size)
+            self._step = COMM_STATE.WAIT_CLIENT_REQUEST
+        elif self._step == COMM_STATE.WAIT_CLIENT_REQUEST:
+            if len(self._inbuf) < NBD_REQ_HEADER.size:
+                return False
+            with self._refs_lock:
+                if self._too_many_inflight():
+                    # stop reading the socket until the pool
+                    # handled some of the pending requests
+                    self._paused = True
+                    return False
+            magic, flags, req_type, cookie, offset, length = NBD_REQ_HEADER.read(
+                    io.BytesIO(self._inbuf[:NBD_REQ_HEADER.size]))
+            assert(magic == NBD_REQUEST_MAGIC)
+            req_len = NBD_REQ_HEADER.size
+            if req_type == NBD_CMD_WRITE:
+                req_len += length
+            data = self._pop_input(req_len)
+            if data is None:
+                return False
+            if req_type == NBD_CMD_DISC:
+                self._step = COMM_STATE.DISCONNECTING
+                return False
+            if offset + length > self._export_size:
+                with self._netbuf.send_lock:
+                    NBD_SIMPLE_REPLY_HEADER.write(self._netbuf, NBD_EINVAL, cookie)
+                return True
+            self._submit_request(req_type, flags, cookie, offset, length,
+                                 data[NBD_REQ_HEADER.size:])
+        else:
+            return False
+        return True
+
+    def _too_many_inflight(self):
+        return (self._inflight_requests >= MAX_INFLIGHT_REQUESTS or
+                self._inflight_bytes >= MAX_INFLIGHT_BYTES)
+
+    def _submit_request(self, *req_args):
+        data_len = len(req_args[-1])
+        with self._refs_lock:
+            self._refs += 1
+            self._inflight_requests += 1
+            self._inflight_bytes += data_len
+        self._io_pool.submit(self._run_request, data_len, *req_args)
+
+    def _run_request(self, data_len, *req_args):
+        try:
+            handle_request(self._netbuf, self._swap_file.fileno(), *req_args)
+        except Exception as e:
+            print(f"{e}: failed to handle request.")
+        finally:
+            with self._refs_lock:
+                self._inflight_requests -= 1
+                self._inflight_bytes -= data_len
+                resume = self._paused and not self._too_many_inflight()
+                if resume:
+                    self._paused = False
+            if resume:
+                self._notifier.notify(self)
+            self._release()
+
+    def _process_input(self):
+        # loop until no complete message remains in the input buffer
+        # (or until we have to pause)
+        while self._handle_input():
+            pass
+        if self._step == COMM_STATE.DISCONNECTING:
+            return False  # end
+        if self._paused:
+            # only watch for errors until resume() is called
+            self._ev_loop.update_listener(self, 0)
+
+    def resume(self):
+        if self._closed:
+            return
+        self._ev_loop.update_listener(self)
+        try:
+            if self._process_input() is False:
+                self._ev_loop.remove_listener(self)
+        except Exception as e:
+            print(f"{e}: closing.")
+            self._ev_loop.remove_listener(self)
+
     def handle_event(self, ts):
         try:
-            # self._netbuf may bufferize input data, so loop
-            # until the input buffer is empty.
-            while True:
-                if self._step == COMM_STATE.WAIT_CLIENT_FLAGS:
-                    client_flags = CLIENT_FLAGS.read(self._netbuf)
-                    assert(client_flags & NBD_FLAG_C_FIXED_NEWSTYLE > 0)
-                    self._step = COMM_STATE.WAIT_CLIENT_OPT
-                elif self._step == COMM_STATE.WAIT_CLIENT_OPT:
-                    magic, opt_type, opt_datalen = NBD_OPT_HEADER.read(self._netbuf)
-                    assert(opt_type == NBD_OPT_GO)
-                    export_size = handle_opt_go(self._netbuf)
-                    self._swap_file = TemporaryFile(buffering=0)
-                    self._swap_file.truncate(export_size)
-                    self._step = COMM_STATE.WAIT_CLIENT_REQUEST
-                elif self._step == COMM_STATE.WAIT_CLIENT_REQUEST:
-                    if not handle_request(self._netbuf, self._swap_file):
-                        return False  # end
-                if self._netbuf.pending_buflen() == 0:
-                    break
+            chunk = self._netbuf.recv_nowait(RECV_SIZE)
+            if chunk is None:
+                return  # nothing to read yet
+            if len(chunk) == 0:
+                return False  # end
+            self._inbuf += chunk
+            return self._process_input()
         except Exception as e:
             print(f"{e}: closing.")
             return False
 
-    def close(self):
+    def _release(self):
+        with self._refs_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
         if self._swap_file is not None:
             self._swap_file.close()
         self._netbuf.close()
 
+    def close(self):
+        self._closed = True
+        # requests still being processed will call _release() too
+        self._release()
+
 
 def run():
     ev_loop = EventLoop()
+    io_pool = ThreadPoolExecutor(max_workers=NUM_IO_THREADS)
+    notifier = ResumeNotifier()
+    ev_loop.register_listener(notifier)
     for serv_s in get_server_sockets():
-        listener = ServerSocketListener(ev_loop, serv_s)
+        listener = ServerSocketListener(ev_loop, serv_s, io_pool, notifier)
         ev_loop.register_listener(listener)
     ev_loop.loop()
 
@@ -41,6 +41,12 @@ def read_image_spec(image_path):
     return load_conf(Path(image_path + IMAGE_SPEC_PATH), optional=True)
 
 
+def image_has_capability(image_spec, capability):
+    if image_spec is None:
+        return False
+    return capability in image_spec.get("capabilities", [])
+
+
 def do_chroot(mount_path, cmd):
     args = shlex.split(cmd)
     return chroot(mount_path, *args, retcode=None).strip()
@@ -524,6 +524,12 @@ class NetworkBuf:
         while (len(buf) > 0):
             length = self._s.send(buf)
             buf = buf[length:]
+    def recv_nowait(self, length):
+        # return None if no data is available yet
+        try:
+            return self._s.recv(length, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return None
     def sendfile(self, f, offset, length):
         self._s.sendfile(f, offset, length)
     def pending_buflen(self):
@@ -538,6 +544,7 @@ def NetworkMsg(fmt, *static_args):
     import struct
     length = struct.calcsize(fmt)
     class NetworkMsgCls:
+        size = length
         @staticmethod
         def read(netbuf):
             buf = netbuf.read(length)
@@ -36,8 +36,10 @@ def location_info(reader, row):
 def trackexec_analyse(trackexec_log_dir, num_items, file_id, sort_field):
     # retrieve src_index info as an array
     reader = LogsReader(trackexec_log_dir)
-    it = ((tuple(k) + tuple(v[1:]) + (0.,)) for k, v in reader.src_index.items())
-    a = np.fromiter(it, DTYPE).view(np.recarray)
+    stats = reader.src_index.locations_stats()
+    a = np.zeros(len(stats), DTYPE).view(np.recarray)
+    for name in stats.dtype.names:
+        a[name] = stats[name]
     # restrict to a given file_id if specified
     if file_id is not None:
         a = a[a.file_id == file_id]
@@ -3,6 +3,9 @@ import numpy as np
 # MAP_BLOCK_UINT16_SIZE and MAP_BLOCK_ID_SHIFT were selected
 # according to tests giving high compressability of the resulting
 # MAP_FILE_SIZE chunks.
+# Note: MAP_FILE_SIZE chunks (gzip-compressed files in directory
+# "log_map") are only used by traces recorded by older versions;
+# the map blocks are now compressed independently (see below).
 MAP_BLOCK_UINT16_SIZE = 4096
 MAP_BLOCK_SIZE = MAP_BLOCK_UINT16_SIZE << 1
 MAP_BLOCK_ID_SHIFT = 5
@@ -10,6 +13,17 @@ MAP_FILE_SIZE = MAP_BLOCK_SIZE << MAP_BLOCK_ID_SHIFT
 NUM_BLOCKS_PER_MAP_FILE = (1 << MAP_BLOCK_ID_SHIFT)
 MAP_BLOCK_ID_MASK = (NUM_BLOCKS_PER_MAP_FILE - 1)
 
+# Each map block is compressed independently with zlib and appended
+# to file "log_map_blocks"; file "log_map_offsets" gives the end
+# offset of each of them (as uint64 values), so that the reader
+# can decompress any block directly.
+# For better compressability, one block every MAP_KEY_BLOCK_INTERVAL
+# blocks is a "key block" and is used as a compression dictionary for
+# the next blocks. Thus, decompressing a block requires decompressing
+# at most one other block.
+MAP_KEY_BLOCK_INTERVAL = 32
+MAP_BLOCK_COMPRESSION_LEVEL = 9
+
 # Durations as timestamp (1>>20 second granularity)
 SEC_AS_TS = 1048576
 MIN_AS_TS = 60 * SEC_AS_TS
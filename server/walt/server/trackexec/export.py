@@ -0,0 +1,234 @@
+import ast
+import json
+import numpy as np
+import sys
+
+from datetime import datetime
+from plumbum import cli
+from walt.server.trackexec.analyse import TrackExecLogDir
+from walt.server.trackexec.const import SEC_AS_TS
+from walt.server.trackexec.fast import (
+        fast_fold_block, fast_stack_tree_create, fast_stack_tree_nodes
+)
+from walt.server.trackexec.reader import LogsReader
+
+EXPORT_FORMATS = ("collapsed", "speedscope")
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+TS_MAX = np.iinfo(np.uint64).max
+
+
+def _functions(node, prefix=""):
+    # yield (<qualname>, <first-line>, <last-line>) of functions,
+    # enclosing functions first
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, ast.ClassDef):
+            yield from _functions(child, f"{prefix}{child.name}.")
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            qualname = f"{prefix}{child.name}"
+            yield qualname, child.lineno, child.end_lineno
+            yield from _functions(child, f"{qualname}.<locals>.")
+        else:
+            yield from _functions(child, prefix)
+
+
+class FramesTable:
+    """Flamegraph frames of the source locations of a trace.
+
+    A frame is the function enclosing the source location or, when
+    per_line is True, the source location itself. Attribute "lut" maps
+    <file_id>, <lineno> to the frame id.
+    """
+
+    def __init__(self, reader, per_line):
+        self._reader = reader
+        self.frames = []  # (<name>, <file_id>, <lineno>)
+        sources = [reader.read_source_file(file_id).splitlines()
+                   for file_id in range(len(reader.filenames))]
+        max_lineno = max((len(lines) for lines in sources), default=0) + 1
+        self.lut = np.empty((len(sources), max_lineno + 1), np.int32)
+        for file_id, lines in enumerate(sources):
+            # find the innermost function enclosing each line
+            line_functions = [("<module>", 1)] * (max_lineno + 1)
+            try:
+                tree = ast.parse("\n".join(lines))
+            except SyntaxError:
+                tree = None
+            if tree is not None:
+                for qualname, first, last in _functions(tree):
+                    line_functions[first:last+1] = (
+                            [(qualname, first)] * (last + 1 - first))
+            frame_ids = {}
+            for lineno, (qualname, def_lineno) in enumerate(line_functions):
+                if per_line:
+                    key = (qualname, lineno)
+                else:
+                    key = (qualname, def_lineno)
+                frame_id = frame_ids.get(key)
+                if frame_id is None:
+                    frame_id = len(self.frames)
+                    self.frames.append((qualname, file_id, key[1]))
+                    frame_ids[key] = frame_id
+                self.lut[file_id, lineno] = frame_id
+
+    def frame_label(self, frame_id):
+        qualname, file_id, lineno = self.frames[frame_id]
+        location = self._reader.short_file_location(file_id, lineno, 60)
+        return f"{qualname} ({location})"
+
+
+def fold_stacks(reader, frames_table, ts_min, ts_max):
+    """Return the call stacks (as lists of frame ids) and the time spent
+       in each of them (in SEC_AS_TS units) within [ts_min, ts_max]"""
+    lut = frames_table.lut
+    stack_tree = fast_stack_tree_create()
+    node_durations = np.zeros(1, np.uint64)
+    block_ids = reader.block_ids_by_time_range(ts_min, ts_max)
+    for block_id in block_ids:
+        reader.seek(block_id)
+        bdata = reader.block_source_data
+        stack = reader.current_block_startup_stack
+        block_ts_start, block_ts_end = reader.current_block_ts_bounds
+        node_ids, durations = fast_fold_block(
+                stack_tree,
+                lut[stack["file_id"], stack["lineno"]],
+                lut[bdata.file_id, bdata.lineno],
+                bdata.stack_depth, bdata.timestamp,
+                block_ts_start, block_ts_end, ts_min, ts_max)
+        if len(node_durations) <= len(stack_tree):
+            node_durations = np.concatenate((node_durations,
+                np.zeros(len(stack_tree) + 1 - len(node_durations), np.uint64)))
+        np.add.at(node_durations, node_ids, durations)
+    # rebuild the call stack of each node; a node id is always higher
+    # than the id of its parent, so we can iterate in node id order
+    node_parents, node_frames = fast_stack_tree_nodes(stack_tree)
+    node_parents, node_frames = node_parents.tolist(), node_frames.tolist()
+    node_stacks = [()]
+    for node_id in range(1, len(node_parents)):
+        node_stacks.append(node_stacks[node_parents[node_id]] +
+                           (node_frames[node_id],))
+    # node 0 (empty call stack) is not relevant
+    return [(node_stacks[node_id], node_durations[node_id])
+            for node_id in np.flatnonzero(node_durations[1:]) + 1]
+
+
+def _ts_to_us(ts):
+    return int(round(ts * 1000000 / SEC_AS_TS))
+
+
+def export_collapsed(frames_table, stacks, f_w):
+    # "collapsed stacks" format, as expected by flamegraph.pl, with
+    # durations given in microseconds
+    for stack, duration in stacks:
+        duration = _ts_to_us(duration)
+        if duration > 0:
+            labels = (frames_table.frame_label(frame_id) for frame_id in stack)
+            f_w.write(f"{';'.join(labels)} {duration}\n")
+
+
+def export_speedscope(frames_table, stacks, name, f_w):
+    # https://github.com/jlfwong/speedscope/wiki/Importing-from-custom-sources
+    frame_indices = {}
+    frames, samples, weights = [], [], []
+    for stack, duration in stacks:
+        duration = _ts_to_us(duration)
+        if duration == 0:
+            continue
+        sample = []
+        for frame_id in stack:
+            frame_index = frame_indices.get(frame_id)
+            if frame_index is None:
+                qualname, file_id, lineno = frames_table.frames[frame_id]
+                frame_index = len(frames)
+                frames.append(dict(name=qualname,
+                                   file=frames_table._reader.filenames[file_id],
+                                   line=int(lineno)))
+                frame_indices[frame_id] = frame_index
+            sample.append(frame_index)
+        samples.append(sample)
+        weights.append(duration)
+    json.dump({
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "microseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+        "name": name,
+        "activeProfileIndex": 0,
+        "exporter": "walt-server-trackexec-export",
+    }, f_w)
+
+
+def trackexec_export(trackexec_log_dir, export_format, ts_min, ts_max,
+                     per_line, f_w):
+    reader = LogsReader(trackexec_log_dir)
+    frames_table = FramesTable(reader, per_line)
+    stacks = fold_stacks(reader, frames_table, ts_min, ts_max)
+    if export_format == "collapsed":
+        export_collapsed(frames_table, stacks, f_w)
+    else:
+        export_speedscope(frames_table, stacks,
+                          trackexec_log_dir.resolve().name, f_w)
+
+
+def Time(s):
+    return int(datetime.fromisoformat(s).timestamp() * SEC_AS_TS)
+
+
+class TrackExecExportCli(cli.Application):
+
+    export_format = cli.SwitchAttr(
+        "--format",
+        cli.Set(*EXPORT_FORMATS, case_sensitive=False),
+        argname="FORMAT",
+        default="collapsed",
+        help="""collapsed stacks (flamegraph.pl input) or speedscope JSON""",
+    )
+
+    since = cli.SwitchAttr(
+        "--since",
+        Time,
+        argname="TIME",
+        default=0,
+        help="""start of the time window (e.g. "2024-04-16 16:20:41")""",
+    )
+
+    until = cli.SwitchAttr(
+        "--until",
+        Time,
+        argname="TIME",
+        default=TS_MAX,
+        help="""end of the time window (e.g. "2024-04-16 18:00")""",
+    )
+
+    per_line = cli.Flag(
+        "--lines",
+        help="""use source lines instead of functions as frames""",
+    )
+
+    output = cli.SwitchAttr(
+        "--output",
+        str,
+        argname="FILE",
+        default=None,
+        help="""write to FILE instead of the standard output""",
+    )
+
+    def main(self, trackexec_log_dir : TrackExecLogDir):
+        """Export WalT server process execution logs as a flamegraph"""
+        args = (trackexec_log_dir, self.export_format.lower(),
+                self.since, self.until, self.per_line)
+        if self.output is None:
+            trackexec_export(*args, sys.stdout)
+        else:
+            with open(self.output, "w") as f_w:
+                trackexec_export(*args, f_w)
+
+
+def run():
+    TrackExecExportCli.run()
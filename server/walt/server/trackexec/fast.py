@@ -1,5 +1,6 @@
-from numba import njit, i2, u2, u8
-from numba.types import Array
+from numba import njit, i2, i4, i8, u2, u8
+from numba.typed import Dict
+from numba.types import Array, DictType
 import numpy as np
 
 from walt.server.trackexec.const import MAP_BLOCK_UINT16_SIZE
@@ -119,3 +120,88 @@ def fast_compute_durations(locations_stack_depths, locations_timestamps,
                 block_ts_end - locations_timestamps[idx]
         )
     return durations
+
+
+# Call stacks are the nodes of a tree stored in dict "stack_tree":
+# <parent_node_id> << 32 | <frame_id> -> <node_id> (node 0 is the root).
+# Note: for performance, this numba typed dict should only be accessed
+# by numba functions.
+@njit(cache=True)
+def fast_stack_tree_create():
+    return Dict.empty(key_type=i8, value_type=i8)
+
+
+# return the parent node and the frame of each node
+@njit((DictType(i8,i8),), cache=True)
+def fast_stack_tree_nodes(stack_tree):
+    node_parents = np.zeros(len(stack_tree) + 1, np.int64)
+    node_frames = np.zeros(len(stack_tree) + 1, np.int64)
+    for key, node_id in stack_tree.items():
+        node_parents[node_id] = key >> 32
+        node_frames[node_id] = key & 0xffffffff
+    return node_parents, node_frames
+
+
+@njit(i8(DictType(i8,i8),i8,i4), cache=True)
+def _fast_stack_tree_child(stack_tree, parent_node_id, frame_id):
+    key = (parent_node_id << 32) | frame_id
+    node_id = stack_tree.get(key, -1)
+    if node_id == -1:
+        node_id = len(stack_tree) + 1
+        stack_tree[key] = node_id
+    return node_id
+
+
+# Fold the instructions of a block into call stacks, for flamegraph
+# exports. "stack_tree" is updated block after block.
+# Each instruction is attributed the time from its start to the start
+# of the next instruction (whatever its stack depth), restricted to the
+# time window [ts_min, ts_max]. The function returns the node id of the
+# call stack of each instruction and this "self" duration.
+@njit((DictType(i8,i8),i4[:],i4[:],u2[:],u8[:],u8,u8,u8,u8), cache=True)
+def fast_fold_block(stack_tree, startup_frame_ids, frame_ids, stack_depths,
+                    timestamps, block_ts_start, block_ts_end, ts_min, ts_max):
+    num_locations = len(frame_ids)
+    node_ids = np.zeros(num_locations + 1, np.int64)
+    durations = np.zeros(num_locations + 1, np.uint64)
+    node_ids_stack = np.zeros(len(startup_frame_ids) + num_locations + 1,
+                              np.int64)
+    # the instruction at the top of the startup stack runs up to the
+    # first instruction of the block
+    node_id = 0
+    frame_id = -1
+    prev_depth = len(startup_frame_ids)
+    for depth in range(prev_depth):
+        frame_id = startup_frame_ids[depth]
+        node_id = _fast_stack_tree_child(stack_tree, node_id, frame_id)
+        node_ids_stack[depth] = node_id
+    prev_ts = min(max(block_ts_start, ts_min), ts_max)
+    for pos in range(num_locations + 1):
+        if pos < num_locations:
+            ts = min(max(timestamps[pos], ts_min), ts_max)
+        else:
+            ts = min(max(block_ts_end, ts_min), ts_max)
+        # node 0 (the root) means the startup stack was empty
+        node_ids[pos] = node_id
+        durations[pos] = ts - prev_ts
+        if pos == num_locations:
+            break
+        depth = stack_depths[pos]
+        # the recorder strips out the LINE opcode of a function called
+        # from the same location (see recorder.py), so we may skip
+        # stack levels; their frame is the one of the previous location.
+        for level in range(prev_depth, depth - 1):
+            parent_node_id = 0
+            if level > 0:
+                parent_node_id = node_ids_stack[level-1]
+            node_ids_stack[level] = _fast_stack_tree_child(
+                    stack_tree, parent_node_id, frame_id)
+        parent_node_id = 0
+        if depth > 1:
+            parent_node_id = node_ids_stack[depth-2]
+        frame_id = frame_ids[pos]
+        node_id = _fast_stack_tree_child(stack_tree, parent_node_id, frame_id)
+        node_ids_stack[depth-1] = node_id
+        prev_depth = depth
+        prev_ts = ts
+    return node_ids, durations
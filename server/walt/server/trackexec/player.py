@@ -81,12 +81,12 @@ class TrackExecPlayer(Pager):
         if bp in self._breakpoints:
             # remove bp
             self._breakpoints.discard(bp)
-            for block_id in self._src_index[bp][0]:
+            for block_id in self._src_index.block_ids(*bp):
                 self._num_breakpoints_per_block_id[block_id] -= 1
         else:
             # add bp
             valid_line = False
-            for block_id in self._src_index[bp][0]:
+            for block_id in self._src_index.block_ids(*bp):
                 valid_line = True
                 self._num_breakpoints_per_block_id[block_id] += 1
             if valid_line:
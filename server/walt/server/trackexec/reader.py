@@ -1,20 +1,37 @@
 import gzip
+import multiprocessing
 import numpy as np
-import pickle
 import tarfile
+import zlib
 
-from collections import defaultdict
-from functools import cache
+from functools import cache, lru_cache
 
 from walt.server.trackexec.const import (
-        MAP_BLOCK_ID_MASK, MAP_BLOCK_ID_SHIFT, OpCodes
+        MAP_BLOCK_ID_MASK, MAP_BLOCK_ID_SHIFT, NUM_BLOCKS_PER_MAP_FILE,
+        MAP_BLOCK_SIZE, MAP_KEY_BLOCK_INTERVAL, OpCodes
 )
 from walt.server.trackexec.fast import fast_analyse_block
 from walt.server.trackexec.fast import fast_compute_durations
+from walt.server.trackexec.srcindex import SourcesIndex, SOURCES_INDEX_DT
 from walt.server.trackexec.tools import (
         map_block_dt, index_block_dt, LogAbstractManagement
 )
 
+# When updating the source index, blocks are analysed in parallel by
+# chunks of SRC_INDEX_CHUNK_NUM_BLOCKS blocks. Chunks are aligned on
+# key blocks (and map files of the legacy format), so each worker
+# decompresses the key blocks (or map files) it needs once.
+SRC_INDEX_CHUNK_NUM_BLOCKS = 4 * NUM_BLOCKS_PER_MAP_FILE
+
+# Number of decompressed map blocks kept in memory
+MAP_BLOCKS_CACHE_SIZE = 256
+
+
+def _src_index_analyse_chunk(args):
+    dir_path, first_block_id, end_block_id = args
+    reader = LogsReader(dir_path)
+    return reader._src_index_analyse_blocks(first_block_id, end_block_id)
+
 
 class LogsReader(LogAbstractManagement):
 
@@ -24,89 +41,108 @@ class LogsReader(LogAbstractManagement):
         self._index_blocks = np.memmap(self._log_index_path,
                                        dtype=index_block_dt(),
                                        mode='r')
+        # note: we open the offsets file after the index file, and the
+        # blocks file after the offsets file, because the recorder writes
+        # them in the reverse order
+        if self._log_map_offsets_path.exists():
+            self._map_offsets = np.memmap(self._log_map_offsets_path,
+                                          dtype=np.uint64, mode='r')
+            self._map_blocks = np.memmap(self._log_map_blocks_path,
+                                         dtype=np.uint8, mode='r')
+        else:
+            self._map_offsets = None   # legacy format
         self._block_source_data = None
-        self._map_blocks = None
         self._filenames = None
         self._src_index = None
+        self._map_block_bytes = lru_cache(MAP_BLOCKS_CACHE_SIZE)(
+                self._read_map_block_bytes)
+        self._legacy_map_file_bytes = lru_cache(1)(
+                self._read_legacy_map_file_bytes)
 
-    @staticmethod
-    def _src_index_value_init():
-        return [set(), 0, 0]
-
-    def _read_sources_index(self):
-        if self._log_sources_index_gz_path.exists():
-            with gzip.open(str(self._log_sources_index_gz_path), 'rb') as f_r:
-                cache_content = f_r.read()
-            return pickle.loads(cache_content)
-        else:
-            return (0, defaultdict(LogsReader._src_index_value_init))
+    def _src_index_analyse_blocks(self, first_block_id, end_block_id):
+        # for each block, list the <file_id>:<lineno> locations found in
+        # the block or not consumed from the startup stack, with their
+        # duration and a weight of 1 (or 0 for those of the startup stack)
+        block_ids, locations, weights, durations = [], [], [], []
+        for block_id in range(first_block_id, end_block_id):
+            self.seek(block_id)
+            bdurations = self._compute_durations()
+            stack_size = len(self._block["stack"])
+            block_ids.append(np.full(len(bdurations), block_id, np.uint64))
+            locations.append(
+                    (bdurations.file_id.astype(np.uint64) << 16) |
+                    bdurations.lineno)
+            bweights = np.ones(len(bdurations), np.uint32)
+            bweights[:stack_size] = 0
+            weights.append(bweights)
+            durations.append(bdurations.duration)
+        # for each distinct <block_id>:<file_id>:<lineno>, sum the weights
+        # (i.e., compute the number of occurences in the block) and the
+        # durations
+        keys = (np.concatenate(block_ids) << 32) | np.concatenate(locations)
+        if len(keys) == 0:
+            return np.empty(0, SOURCES_INDEX_DT)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.diff(keys, prepend=~keys[:1]))
+        num_occurences = np.add.reduceat(np.concatenate(weights)[order],
+                                         starts)
+        cum_duration = np.add.reduceat(np.concatenate(durations)[order],
+                                       starts)
+        keys = keys[starts]
+        # keep the locations found in the block or having a non-null
+        # duration
+        mask = (num_occurences > 0) | (cum_duration > 0)
+        rows = np.empty(np.count_nonzero(mask), SOURCES_INDEX_DT)
+        rows["block_id"] = keys[mask] >> 32
+        rows["file_id"] = (keys[mask] >> 16) & 0xffff
+        rows["lineno"] = keys[mask] & 0xffff
+        rows["num_occurences"] = num_occurences[mask]
+        rows["cum_duration"] = cum_duration[mask]
+        return rows
 
-    def _write_sources_index(self):
-        cache_content = pickle.dumps((self.max_block_id+1, self._src_index))
-        with gzip.open(str(self._log_sources_index_gz_path), 'wb') as f_w:
-            f_w.write(cache_content)
+    def _src_index_chunks(self, next_block_id):
+        end_block_id = self.max_block_id + 1
+        while next_block_id < end_block_id:
+            chunk_end_block_id = min(
+                    end_block_id,
+                    (next_block_id // SRC_INDEX_CHUNK_NUM_BLOCKS + 1) *
+                        SRC_INDEX_CHUNK_NUM_BLOCKS)
+            yield (self._dir_path, next_block_id, chunk_end_block_id)
+            next_block_id = chunk_end_block_id
 
     @property
     def src_index(self):
-        # Even if the src index file exists, the trace may be longer now.
-        # Let's point self._block_id to the first block not yet indexed.
-        # Note: the src index file encodes a tuple of 2 values:
-        # 1. the number of blocks encoded (= the next block_id to encode)
-        # 2. a dictionary {(<fild_id>,<lineno>) -> [
-        #                                set(<block_ids>),
-        #                                <num-occurences>,
-        #                                <cum-duration>
-        # ]}
+        # Even if the src index exists, the trace may be longer now.
+        # In this case, we analyse the blocks which were added to the
+        # trace, in parallel, and append the results to the index
+        # (see srcindex.py).
         if self._src_index is None:
-            saved_block_id = self._block_id
-            next_block_id, self._src_index = self._read_sources_index()
-            num_added_blocks = self.max_block_id +1 - next_block_id
+            self._log_sources_index_gz_path.unlink(missing_ok=True)  # obsolete
+            src_index = SourcesIndex(self._log_sources_index_dir_path)
+            num_added_blocks = self.max_block_id + 1 - src_index.num_blocks
             if num_added_blocks > 0:
-                # Analyse blocks which were added to the trace.
-                self.seek(next_block_id)
-                while True:
-                    block_id = self._block_id
-                    op_num = block_id + num_added_blocks - self.max_block_id
-                    print(f"Updating source index... {op_num}/{num_added_blocks}\r",
-                          end="")
-                    bdata = self.block_source_data
-                    # count number of each distinct <file-id>:<lineno> in the block
-                    block_source_f_l = bdata[["file_id", "lineno"]]
-                    arr_unq, arr_cnt = np.unique(block_source_f_l, return_counts=True)
-                    # save in the src index:
-                    # * the fact each <file-id>:<lineno> was found at least once
-                    #   in the block
-                    # * add to the total number of occurences of each <file-id>:<lineno>
-                    for location, cnt in zip(arr_unq, arr_cnt):
-                        file_id, lineno = location
-                        src_index_item = self._src_index[(file_id, lineno)]
-                        src_index_item[0].add(block_id)
-                        src_index_item[1] += cnt
-                    # compute duration of each <file-id>:<lineno> instruction
-                    # found in the block or not consumed from the startup stack
-                    durations = self._compute_durations()
-                    durations_f_l = durations[["file_id", "lineno"]]
-                    # for each distinct <file-id>:<lineno>, sum these durations
-                    arr_unq, arr_inv = np.unique(durations_f_l, return_inverse=True)
-                    cum_duration = np.zeros(len(arr_unq), dtype=np.uint64)
-                    np.add.at(cum_duration, arr_inv, durations.duration)
-                    # update the src index:
-                    # * add to the cumulated duration of each <file-id>:<lineno>
-                    for location, duration in zip(arr_unq, cum_duration):
-                        if duration > 0:
-                            file_id, lineno = location
-                            src_index_item = self._src_index[(file_id, lineno)]
-                            src_index_item[2] += duration
-                    # continue with next block if any
-                    if self.at_last_block():
-                        break
-                    else:
-                        self.next()
+                # the end timestamp of the last block indexed is now known,
+                # index it again
+                src_index.rewind_last_block()
+                first_block_id = src_index.num_blocks
+                chunks = list(self._src_index_chunks(first_block_id))
+                # note: forking workers avoids re-importing numba code
+                mp_context = multiprocessing.get_context("fork")
+                with mp_context.Pool() as pool:
+                    results = pool.imap(_src_index_analyse_chunk, chunks)
+                    for chunk, rows in zip(chunks, results):
+                        _, chunk_first_block_id, chunk_end_block_id = chunk
+                        op_num = chunk_end_block_id - first_block_id
+                        num_ops = self.max_block_id + 1 - first_block_id
+                        print("Updating source index... "
+                              f"{op_num}/{num_ops}\r", end="")
+                        # append results in order, so that the index
+                        # remains consistent if this is interrupted
+                        src_index.append(
+                            rows, chunk_end_block_id - chunk_first_block_id)
                 print()
-                # Update the analysis file
-                self._write_sources_index()
-                # restore context
-                self.seek(saved_block_id)
+            self._src_index = src_index
         return self._src_index
 
     @property
@@ -138,10 +174,6 @@ class LogsReader(LogAbstractManagement):
     def seek(self, block_id):
         if self._block_id == block_id:
             return  # nothing to do
-        # check if the log map is a different file
-        if (self._block_id >> MAP_BLOCK_ID_SHIFT !=
-                  block_id >> MAP_BLOCK_ID_SHIFT):
-            self._map_blocks = None  # will need to reload the map file
         self._block_id = block_id
         self._block_source_data = None
 
@@ -162,6 +194,27 @@ class LogsReader(LogAbstractManagement):
     def current_block_id(self):
         return self._block_id
 
+    @property
+    def current_block_ts_bounds(self):
+        block_ts_start = self._index_blocks[self._block_id]['timestamp']
+        if self.at_last_block():
+            block_ts_end = self.block_source_data.timestamp[-1]
+        else:
+            block_ts_end = self._index_blocks[self._block_id+1]['timestamp']
+        return block_ts_start, block_ts_end
+
+    @property
+    def current_block_startup_stack(self):
+        return self._block["stack"]
+
+    def block_ids_by_time_range(self, ts_min, ts_max):
+        # blocks overlapping [ts_min, ts_max]
+        first_block_id = max(0, np.searchsorted(
+                self._index_blocks['timestamp'], ts_min, side='right') - 1)
+        end_block_id = np.searchsorted(
+                self._index_blocks['timestamp'], ts_max, side='right')
+        return range(first_block_id, end_block_id)
+
     @property
     def current_block_min_stack_size(self):
         return self._index_blocks[self._block_id]['min_stack_size']
@@ -175,23 +228,44 @@ class LogsReader(LogAbstractManagement):
     def at_last_block(self):
         return self._block_id == len(self._index_blocks) - 1
 
+    def _read_legacy_map_file_bytes(self, log_map_num):
+        self._log_map_num = log_map_num
+        if self._log_map_path.exists():
+            return self._log_map_path.read_bytes()
+        else:
+            with gzip.open(str(self._log_map_gz_path), 'rb') as f_r:
+                return f_r.read()
+
+    def _read_map_block_bytes(self, block_id):
+        if self._map_offsets is None:
+            # legacy format: gzip-compressed files of NUM_BLOCKS_PER_MAP_FILE
+            # blocks
+            map_bytes = self._legacy_map_file_bytes(
+                    block_id >> MAP_BLOCK_ID_SHIFT)
+            offset = (block_id & MAP_BLOCK_ID_MASK) * MAP_BLOCK_SIZE
+            return map_bytes[offset:offset+MAP_BLOCK_SIZE]
+        if block_id == 0:
+            start = 0
+        else:
+            start = int(self._map_offsets[block_id-1])
+        end = int(self._map_offsets[block_id])
+        compressed = self._map_blocks[start:end]
+        key_block_id = block_id - (block_id % MAP_KEY_BLOCK_INTERVAL)
+        if key_block_id == block_id:
+            return zlib.decompress(compressed)
+        else:
+            # the key block was used as a compression dictionary
+            decompressor = zlib.decompressobj(
+                    zdict=self._map_block_bytes(key_block_id))
+            return decompressor.decompress(compressed)
+
     @property
     def _block(self):
-        map_block_id = self._block_id & MAP_BLOCK_ID_MASK
-        block = self._map_blocks[map_block_id]
-        stack_size = block['stack_size']
-        return self._map_blocks[map_block_id:map_block_id+1].view(
-                        dtype=map_block_dt(stack_size))[0]
+        block_bytes = self._map_block_bytes(self._block_id)
+        stack_size = np.frombuffer(block_bytes, dtype=np.uint16, count=1)[0]
+        return np.frombuffer(block_bytes, dtype=map_block_dt(stack_size))[0]
 
     def _read_block(self):
-        if self._map_blocks is None:
-            self._log_map_num = self._block_id >> MAP_BLOCK_ID_SHIFT
-            if self._log_map_path.exists():
-                map_bytes = self._log_map_path.read_bytes()
-            elif self._log_map_gz_path.exists():
-                with gzip.open(str(self._log_map_gz_path), 'rb') as f_r:
-                    map_bytes = f_r.read()
-            self._map_blocks = np.frombuffer(map_bytes, dtype=map_block_dt(1))
         block_ts_start = self._index_blocks[self._block_id]['timestamp']
         if self.at_last_block():
             block_ts_end = 0  # end timestamp of last block unknown for now
@@ -217,11 +291,7 @@ class LogsReader(LogAbstractManagement):
 
     def _compute_durations(self):
         bdata = self.block_source_data
-        block_ts_start = self._index_blocks[self._block_id]['timestamp']
-        if self.at_last_block():
-            block_ts_end = bdata["timestamp"][-1]
-        else:
-            block_ts_end = self._index_blocks[self._block_id+1]['timestamp']
+        block_ts_start, block_ts_end = self.current_block_ts_bounds
         # we must also compute duration of the instructions of the stack,
         # even if they are not referenced in the block.
         # for this, we prepend these instructions to bdata, considering
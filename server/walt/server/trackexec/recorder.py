@@ -1,7 +1,7 @@
-import gzip
 import numpy as np
 import sys
 import tarfile
+import zlib
 
 from contextlib import nullcontext
 from os import getpid
@@ -9,7 +9,8 @@ from os.path import dirname
 from pathlib import Path
 from time import time
 from walt.server.trackexec.const import (
-        OpCodes, MAP_FILE_SIZE, SEC_AS_TS, MAP_BLOCK_UINT16_SIZE
+        OpCodes, SEC_AS_TS, MAP_BLOCK_UINT16_SIZE, MAP_KEY_BLOCK_INTERVAL,
+        MAP_BLOCK_COMPRESSION_LEVEL
 )
 from walt.server.trackexec.tools import (
         Uint16Stack, map_block_dt, index_block_dt,
@@ -20,7 +21,14 @@ TRACKEXEC_SRC_PREFIX = dirname(__file__) + "/"
 LINENO_UNDEFINED = 0  # undefined (real linenos start at 1)
 
 
-class TrackExecRecorder(LogAbstractManagement):
+class TrackExecRecorderBase(LogAbstractManagement):
+    """Common code of recorder backends.
+
+    Backends are notified by the python interpreter when a function
+    of the monitored code is entered or left, or when a new line
+    is reached; they call _record_call(), _record_return() and
+    _record_line(), which build the bytecode and the map blocks.
+    """
     _instance = None
 
     def __init__(self, mod_or_package, dir_path):
@@ -42,6 +50,9 @@ class TrackExecRecorder(LogAbstractManagement):
         self._bytecode = Uint16Stack()
         self._map_block = np.zeros(1, dtype=map_block_dt(0))
         self._index_block = np.zeros(1, dtype=index_block_dt())
+        self._num_blocks = 0
+        self._map_key_block = None
+        self._map_blocks_offset = 0
         self._last_timestamp = None
         self._timestamp_requested = False
         self._pt_section = False   # precise-timestamping sections
@@ -55,24 +66,32 @@ class TrackExecRecorder(LogAbstractManagement):
             self._recursive_call_stack_init(frame.f_back)
         # unless filtered out, add the frame to the call stack
         # and enable tracing on it
-        file_id = self._get_file_id(frame)
+        file_id = self._get_file_id(frame.f_code)
         if file_id != -1:
             self._stack[self._stack_size] = (file_id, frame.f_lineno)
             self._stack_size += 1
-            frame.f_trace = self._trace_local_function
+            self._track_existing_frame(frame)
             self._current_lineno = frame.f_lineno
 
     def start(self, calling_frame):
         # when the recorder code is started, we analyse which frames of
         # the call stack match our filtering prefix; those frames are
-        # used to initialize our call stack (self._stack) and we manually
-        # enable tracing on them (by setting their 'f_trace' attribute),
-        # in order to capture their execution when this code returns to
+        # used to initialize our call stack (self._stack) and the backend
+        # ensures their execution is captured when this code returns to
         # its caller.
         self._recursive_call_stack_init(calling_frame)
         self._init_block()
-        # enable our trace function for next calls
-        sys.settrace(self._trace_call_function)
+        # let the backend capture next calls
+        self._enable()
+
+    def _track_existing_frame(self, frame):
+        raise NotImplementedError
+
+    def _enable(self):
+        raise NotImplementedError
+
+    def _disable(self):
+        raise NotImplementedError
 
     def _update_log_sources_archive(self):
         with tarfile.open(self._log_sources_archive_path, "w:gz") as t_w:
@@ -95,26 +114,34 @@ class TrackExecRecorder(LogAbstractManagement):
         self._max_bytecode_len = len(bl_content['bytecode'])
         self._bytecode.reset()
 
-    def _write_block(self, force_flush_map_file=False):
+    def _compress_map_block(self):
+        block_bytes = self._map_block.tobytes()
+        if self._num_blocks % MAP_KEY_BLOCK_INTERVAL == 0:
+            # key block, compressed alone
+            self._map_key_block = block_bytes
+            return zlib.compress(block_bytes, MAP_BLOCK_COMPRESSION_LEVEL)
+        else:
+            # use the last key block as a compression dictionary
+            compressor = zlib.compressobj(MAP_BLOCK_COMPRESSION_LEVEL,
+                                          zdict=self._map_key_block)
+            return compressor.compress(block_bytes) + compressor.flush()
+
+    def _write_block(self):
         if self._num_saved_filenames < len(self._filenames):
             self._update_log_sources_archive()
             self._num_saved_filenames = len(self._filenames)
         self._bytecode.pad(OpCodes.END, self._max_bytecode_len)
         self._map_block[0]['bytecode'] = self._bytecode.view()
-        self._log_map_path.parent.mkdir(exist_ok=True)
-        with self._log_map_path.open("ab") as f:
-            f.write(self._map_block.tobytes())
-            if force_flush_map_file:
-                flush_map_file = True
-            else:
-                flush_map_file = (f.tell() == MAP_FILE_SIZE)
-        if flush_map_file:
-            # compress the map file
-            with gzip.open(str(self._log_map_gz_path), 'wb') as f_w:
-                f_w.write(self._log_map_path.read_bytes())
-            self._log_map_path.unlink()
-            # switch to next logmap file
-            self._log_map_num += 1
+        # the map block is written before its offset, and the offset
+        # before the index entry, so readers always find a complete
+        # block for each index entry
+        compressed = self._compress_map_block()
+        with self._log_map_blocks_path.open("ab") as f:
+            f.write(compressed)
+        self._map_blocks_offset += len(compressed)
+        with self._log_map_offsets_path.open("ab") as f:
+            f.write(np.uint64(self._map_blocks_offset).tobytes())
+        self._num_blocks += 1
         self._index_block[0]['min_stack_size'] = self._min_stack_size
         with self._log_index_path.open("ab") as f:
             f.write(self._index_block.tobytes())
@@ -126,8 +153,7 @@ class TrackExecRecorder(LogAbstractManagement):
             self._write_block()
             self._init_block()
 
-    def _get_file_id(self, frame):
-        f_code = frame.f_code
+    def _get_file_id(self, f_code):
         file_id = self._file_id_per_code_id.get(id(f_code))
         if file_id is None:
             # 1st time we see this f_code, check if we should trace it
@@ -153,14 +179,7 @@ class TrackExecRecorder(LogAbstractManagement):
             self._file_id_per_code_id[id(f_code)] = file_id
         return file_id
 
-    def _trace_call_function(self, frame, event, arg):
-        if self._pid != getpid():
-            # this is the code of a forked child, bypass and disable
-            sys.settrace(None)
-            return
-        file_id = self._get_file_id(frame)
-        if file_id == -1:
-            return
+    def _record_call(self, file_id):
         # if moving into the same file, preserve the current lineno as a
         # reference for possibly stripping out next LINE opcode; otherwise,
         # forget it.
@@ -174,53 +193,55 @@ class TrackExecRecorder(LogAbstractManagement):
         self._bytecode.add(file_id)
         self._stack[self._stack_size] = (file_id, self._current_lineno)
         self._stack_size += 1
-        return self._trace_local_function
 
-    def _trace_local_function(self, frame, event, arg):
-        if event == 'return':
-            # optimize:
-            # 1. strip out "CALL <fileid>; RETURN;" sequences
-            # 2. thanks to the management of _current_lineno, the fact we
-            #    strip out repeated LINE opcodes, and optimization 1, we
-            #    can also strip out the following pattern found with list
-            #    comprehensions:
-            #    [at line <F>:<N>]; CALL <F>; <N>; RETURN;
-            bytecode = self._bytecode.view()
-            if len(bytecode) >= 2 and bytecode[-2] == OpCodes.CALL:
-                # strip out CALL RETURN sequence
-                self._bytecode.pop()
-                self._bytecode.pop()
+    def _record_return(self):
+        # optimize:
+        # 1. strip out "CALL <fileid>; RETURN;" sequences
+        # 2. thanks to the management of _current_lineno, the fact we
+        #    strip out repeated LINE opcodes, and optimization 1, we
+        #    can also strip out the following pattern found with list
+        #    comprehensions:
+        #    [at line <F>:<N>]; CALL <F>; <N>; RETURN;
+        bytecode = self._bytecode.view()
+        if len(bytecode) >= 2 and bytecode[-2] == OpCodes.CALL:
+            # strip out CALL RETURN sequence
+            self._bytecode.pop()
+            self._bytecode.pop()
+        else:
+            self._ensure_block_has_room(1)
+            self._bytecode.add(OpCodes.RETURN)
+            # if returning to some location of the same file, the caller
+            # resumes on its own lineno, use it as a reference for possibly
+            # stripping out next LINE opcode (sys.settrace() emits one when
+            # a generator expression or comprehension loops back on the
+            # calling line, sys.monitoring does not); otherwise, forget it.
+            top_of_stack = self._stack[:self._stack_size][-2:]
+            if (
+                    len(top_of_stack) < 2 or
+                    top_of_stack[0]["file_id"] != top_of_stack[1]["file_id"]
+               ):
+                self._current_lineno = LINENO_UNDEFINED
             else:
-                self._ensure_block_has_room(1)
-                self._bytecode.add(OpCodes.RETURN)
-                # if returning to some location of the same file, preserve the
-                # current lineno as a reference for possibly stripping out next
-                # LINE opcode; otherwise, forget it.
-                top_of_stack = self._stack[:self._stack_size][-2:]
-                if (
-                        len(top_of_stack) < 2 or
-                        top_of_stack[0]["file_id"] != top_of_stack[1]["file_id"]
-                   ):
-                    self._current_lineno = LINENO_UNDEFINED
-            self._stack_size -= 1
-            self._min_stack_size = min(
-                self._min_stack_size,
-                self._stack_size
-            )
-        elif event == "line":
-            # if traversing a precise timestamping section,
-            # record the timestamp of each instruction
-            if self._pt_section or self._timestamp_requested:
-                self._record_timestamp()
-                self._timestamp_requested = False
-            # record the line number, unless we remain on the same line,
-            # in which case we strip out this new LINE opcode
-            lineno = frame.f_lineno
-            if lineno != self._current_lineno:
-                self._ensure_block_has_room(1)
-                self._bytecode.add(lineno)
-                self._stack[self._stack_size-1]["lineno"] = lineno
-                self._current_lineno = lineno
+                self._current_lineno = top_of_stack[0]["lineno"]
+        self._stack_size -= 1
+        self._min_stack_size = min(
+            self._min_stack_size,
+            self._stack_size
+        )
+
+    def _record_line(self, lineno):
+        # if traversing a precise timestamping section,
+        # record the timestamp of each instruction
+        if self._pt_section or self._timestamp_requested:
+            self._record_timestamp()
+            self._timestamp_requested = False
+        # record the line number, unless we remain on the same line,
+        # in which case we strip out this new LINE opcode
+        if lineno != self._current_lineno:
+            self._ensure_block_has_room(1)
+            self._bytecode.add(lineno)
+            self._stack[self._stack_size-1]["lineno"] = lineno
+            self._current_lineno = lineno
 
     def _record_timestamp(self):
         self._ensure_block_has_room(5)
@@ -253,26 +274,149 @@ class TrackExecRecorder(LogAbstractManagement):
 
     def _stop(self):
         """Function for stopping and flushing"""
-        sys.settrace(None)                              # stop tracing
+        self._disable()                                 # stop tracing
         self._record_timestamp()                        # record a final timestamp
-        self._write_block(force_flush_map_file=True)    # flush
+        self._write_block()                             # flush
 
     @classmethod
     def record(cls, *args):
-        assert cls._instance is None
-        cls._instance = cls(*args)
+        # note: the running instance is shared by all backend classes
+        assert TrackExecRecorderBase._instance is None
+        TrackExecRecorderBase._instance = cls(*args)
         # initialize the stack considering the calling code
-        cls._instance.start(sys._getframe().f_back)
+        TrackExecRecorderBase._instance.start(sys._getframe().f_back)
 
     @classmethod
     def precise_timestamping(cls):
-        if cls._instance is not None:
-            return cls._instance
+        if TrackExecRecorderBase._instance is not None:
+            return TrackExecRecorderBase._instance
         else:
             return nullcontext()
 
     @classmethod
     def stop(cls):
-        if cls._instance is not None:
-            cls._instance._stop()
-            cls._instance = None
+        if TrackExecRecorderBase._instance is not None:
+            TrackExecRecorderBase._instance._stop()
+            TrackExecRecorderBase._instance = None
+
+
+class SetTraceRecorder(TrackExecRecorderBase):
+    """Recorder backend based on sys.settrace()."""
+
+    def _track_existing_frame(self, frame):
+        # manually enable tracing on this frame
+        frame.f_trace = self._trace_local_function
+
+    def _enable(self):
+        sys.settrace(self._trace_call_function)
+
+    def _disable(self):
+        sys.settrace(None)
+
+    def _trace_call_function(self, frame, event, arg):
+        if self._pid != getpid():
+            # this is the code of a forked child, bypass and disable
+            sys.settrace(None)
+            return
+        file_id = self._get_file_id(frame.f_code)
+        if file_id == -1:
+            return
+        self._record_call(file_id)
+        return self._trace_local_function
+
+    def _trace_local_function(self, frame, event, arg):
+        if event == 'return':
+            self._record_return()
+        elif event == "line":
+            self._record_line(frame.f_lineno)
+
+
+class MonitoringRecorder(TrackExecRecorderBase):
+    """Recorder backend based on sys.monitoring (PEP 669, python >= 3.12).
+
+    Contrary to sys.settrace(), which calls the trace function on every
+    function call and line of a traced frame, sys.monitoring lets us
+    return DISABLE the first time an uninteresting location (i.e.,
+    code filtered out by _get_file_id()) is reached: the interpreter
+    will then no longer call us for this location.
+    Note that unlike sys.settrace(), sys.monitoring events are not
+    specific to the calling thread; walt server processes are
+    single-threaded, so this is not an issue.
+    """
+
+    def _track_existing_frame(self, frame):
+        pass  # sys.monitoring events are not bound to frames
+
+    def _enable(self):
+        mon = sys.monitoring
+        ev = mon.events
+        self._tool_id = mon.PROFILER_ID
+        if mon.get_tool(self._tool_id) is not None:
+            # already taken (e.g. by cProfile), look for a free one
+            # (ids 0 to 5 are available to tools)
+            self._tool_id = next(
+                i for i in range(6) if mon.get_tool(i) is None
+            )
+        mon.use_tool_id(self._tool_id, "trackexec")
+        self._callbacks = {
+            # function entry, including a generator or coroutine
+            # being resumed
+            ev.PY_START: self._on_start,
+            ev.PY_RESUME: self._on_start,
+            ev.PY_THROW: self._on_throw,
+            # function exit, including a generator or coroutine
+            # being suspended
+            ev.PY_RETURN: self._on_return,
+            ev.PY_YIELD: self._on_return,
+            ev.PY_UNWIND: self._on_unwind,
+            ev.LINE: self._on_line,
+        }
+        for event, callback in self._callbacks.items():
+            mon.register_callback(self._tool_id, event, callback)
+        mon.set_events(self._tool_id, sum(self._callbacks))
+
+    def _disable(self):
+        mon = sys.monitoring
+        mon.set_events(self._tool_id, 0)
+        for event in self._callbacks:
+            mon.register_callback(self._tool_id, event, None)
+        mon.free_tool_id(self._tool_id)
+
+    def _on_start(self, code, instruction_offset):
+        if self._pid != getpid():
+            # this is the code of a forked child, bypass and disable
+            sys.monitoring.set_events(self._tool_id, 0)
+            return
+        file_id = self._get_file_id(code)
+        if file_id == -1:
+            return sys.monitoring.DISABLE
+        self._record_call(file_id)
+
+    def _on_throw(self, code, instruction_offset, exception):
+        # PY_THROW cannot be disabled per location, so we do not
+        # return DISABLE here
+        file_id = self._get_file_id(code)
+        if file_id != -1:
+            self._record_call(file_id)
+
+    def _on_return(self, code, instruction_offset, retval):
+        if self._get_file_id(code) == -1:
+            return sys.monitoring.DISABLE
+        self._record_return()
+
+    def _on_unwind(self, code, instruction_offset, exception):
+        # PY_UNWIND cannot be disabled per location either
+        if self._get_file_id(code) != -1:
+            self._record_return()
+
+    def _on_line(self, code, line_number):
+        if self._get_file_id(code) == -1:
+            return sys.monitoring.DISABLE
+        self._record_line(line_number)
+
+
+# sys.monitoring is available since python 3.12
+if sys.version_info >= (3, 12):
+    TrackExecRecorder = MonitoringRecorder
+else:
+    TrackExecRecorder = SetTraceRecorder
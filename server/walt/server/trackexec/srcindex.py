@@ -0,0 +1,111 @@
+import numpy as np
+import os
+
+# The sources index is stored in a columnar manner, one file per column,
+# in directory <log-dir>/log_sources_index. For each block and each
+# distinct source location <file_id>:<lineno> of this block (including
+# the locations of its startup stack), a row indicates how many times
+# this location was reached in the block, and the cumulated duration of
+# the related instructions within the boundaries of the block.
+# When the trace gets longer, rows related to the new blocks are just
+# appended to the column files. The "size" file indicates how many
+# blocks and rows were indexed, and how many rows precede those of the
+# last block; it is updated atomically after the column files, so that
+# rows appended by an interrupted update are just ignored (and
+# overwritten by the next update).
+# Note: when the last block was indexed, its end timestamp was not known
+# yet, so the durations computed for this block are only partial. Thus
+# when the trace gets longer, its rows are discarded and it is indexed
+# again (see rewind_last_block()).
+SOURCES_INDEX_DT = np.dtype([
+        ("block_id", np.uint32),
+        ("file_id", np.uint16),
+        ("lineno", np.uint16),
+        ("num_occurences", np.uint32),
+        ("cum_duration", np.uint64)
+])
+
+LOCATION_STATS_DT = np.dtype([
+        ("file_id", np.uint16),
+        ("lineno", np.uint16),
+        ("num_occurences", np.uint64),
+        ("cum_duration", np.uint64)
+])
+
+
+class SourcesIndex:
+
+    def __init__(self, dir_path):
+        self._dir_path = dir_path
+        self._size_path = dir_path / "size"
+        self._columns = {}
+        if self._size_path.exists():
+            self.num_blocks, self.num_rows, self._last_block_row = map(
+                int, np.fromfile(self._size_path, dtype=np.uint64))
+        else:
+            self.num_blocks, self.num_rows, self._last_block_row = 0, 0, 0
+
+    def _column_path(self, name):
+        return self._dir_path / name
+
+    def column(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            dt = SOURCES_INDEX_DT[name]
+            if self.num_rows == 0:
+                column = np.empty(0, dtype=dt)
+            else:
+                column = np.memmap(self._column_path(name), dtype=dt,
+                                   mode='r', shape=(self.num_rows,))
+            self._columns[name] = column
+        return column
+
+    def append(self, rows, num_blocks):
+        """Append rows (with dtype SOURCES_INDEX_DT) related to new blocks"""
+        self._dir_path.mkdir(exist_ok=True)
+        for name in SOURCES_INDEX_DT.names:
+            dt = SOURCES_INDEX_DT[name]
+            with self._column_path(name).open("ab") as f:
+                # discard rows of a previous interrupted update, if any
+                f.truncate(self.num_rows * dt.itemsize)
+                f.write(np.ascontiguousarray(rows[name]).tobytes())
+        self.num_blocks += num_blocks
+        self._last_block_row = self.num_rows + np.searchsorted(
+                rows["block_id"], self.num_blocks - 1)
+        self.num_rows += len(rows)
+        tmp_size_path = self._size_path.with_name(f"size.{os.getpid()}")
+        np.array([self.num_blocks, self.num_rows, self._last_block_row],
+                 dtype=np.uint64).tofile(tmp_size_path)
+        tmp_size_path.rename(self._size_path)
+        self._columns = {}  # memmaps must be reopened
+
+    def rewind_last_block(self):
+        """Discard the rows of the last block, before indexing it again"""
+        if self.num_blocks > 0:
+            self.num_blocks -= 1
+            self.num_rows = self._last_block_row
+            self._columns = {}
+
+    def block_ids(self, file_id, lineno):
+        """Return the ids of blocks where <file_id>:<lineno> was reached"""
+        mask = ((self.column("file_id") == file_id) &
+                (self.column("lineno") == lineno) &
+                (self.column("num_occurences") > 0))
+        return self.column("block_id")[mask]
+
+    def locations_stats(self):
+        """Return the number of occurences and the cumulated duration
+           of each source location, over all indexed blocks"""
+        locations = ((self.column("file_id").astype(np.uint32) << 16) |
+                     self.column("lineno"))
+        arr_unq, arr_inv = np.unique(locations, return_inverse=True)
+        stats = np.empty(len(arr_unq), LOCATION_STATS_DT)
+        stats["file_id"] = arr_unq >> 16
+        stats["lineno"] = arr_unq & 0xffff
+        stats["num_occurences"] = np.bincount(
+                arr_inv, minlength=len(arr_unq),
+                weights=self.column("num_occurences"))
+        cum_duration = np.zeros(len(arr_unq), dtype=np.uint64)
+        np.add.at(cum_duration, arr_inv, self.column("cum_duration"))
+        stats["cum_duration"] = cum_duration
+        return stats
@@ -75,8 +75,12 @@ class LogAbstractManagement:
         self._log_index_path = dir_path / "log_index"
         self._log_sources_archive_path = dir_path / "log_sources.tar.gz"
         self._log_sources_index_gz_path = dir_path / "log_sources_index.gz"
+        self._log_sources_index_dir_path = dir_path / "log_sources_index"
+        self._log_map_blocks_path = dir_path / "log_map_blocks"
+        self._log_map_offsets_path = dir_path / "log_map_offsets"
         self._log_map_num = 0
 
+    # _log_map_path and _log_map_gz_path are related to the legacy format
     @property
     def _log_map_path(self):
         return self._dir_path / "log_map" / f"{self._log_map_num}"
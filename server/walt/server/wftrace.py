@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+import json
+import sys
+
+from plumbum import cli
+from walt.common.apilink import ServerAPILink
+
+
+class WorkflowTraceCli(cli.Application):
+    """Dump the latest workflow steps of walt-server-daemon.
+
+    The output is a trace file in Chrome trace format: open it
+    with chrome://tracing, https://ui.perfetto.dev or speedscope.
+    Each workflow appears as a separate thread, with its steps and
+    parallel sections.
+    """
+
+    clear = cli.Flag("--clear", help="clear the trace buffer after the dump")
+    enable = cli.Flag("--enable", excludes=["--disable"],
+                      help="enable workflow tracing (the default)")
+    disable = cli.Flag("--disable", excludes=["--enable"],
+                       help="disable workflow tracing")
+
+    def main(self, output_file=None):
+        with ServerAPILink("localhost", "SSAPI") as server:
+            if self.enable or self.disable:
+                server.set_workflow_tracing(self.enable)
+                if output_file is None:
+                    return
+            trace = server.get_workflow_trace(self.clear)
+        if output_file is None:
+            json.dump(trace, sys.stdout)
+            print()
+        else:
+            with open(output_file, "w") as f:
+                json.dump(trace, f)
+            num_events = len(trace["traceEvents"])
+            print(f"{num_events} trace events saved to {output_file}.")
+
+
+def run():
+    WorkflowTraceCli.run()
+
+
+if __name__ == "__main__":
+    run()
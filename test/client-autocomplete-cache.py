@@ -0,0 +1,125 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+from includes.common import define_test
+
+# These tests check the cache of the shell autocompletion helper
+# (client/walt/client/autocomplete/helper.py), with a fake server link.
+
+
+class FakeServer:
+    generation = "g1"
+    result = "rpi-1 rpi-2"
+    # calls made by the helper process itself (the background
+    # revalidation runs in a child process)
+    calls = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def shell_autocomplete(self, username, argv, debug=False, with_generation=False):
+        FakeServer.calls.append("shell_autocomplete")
+        return (FakeServer.result, FakeServer.generation)
+
+    def get_autocomplete_generation(self, argv):
+        FakeServer.calls.append("get_autocomplete_generation")
+        return FakeServer.generation
+
+
+def setup_helper():
+    import walt.client.link
+    from walt.client.autocomplete import helper
+
+    walt.client.link.ClientToServerLink = FakeServer
+    helper.conf = types.SimpleNamespace(
+        walt=types.SimpleNamespace(server="server", username="user"))
+    helper.get_hook = lambda name: None
+    helper.AUTOCOMPLETE_CACHE_PATH = Path(tempfile.mkdtemp()) / "cache.json"
+    return helper
+
+
+def run_helper(helper, *argv):
+    """Run the helper, wait for its background revalidation process (if
+    any), and return what it printed."""
+    orig_argv = sys.argv
+    sys.argv = ["walt-autocomplete-helper"] + list(argv)
+    stdout = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout):
+            helper.ac_helper()
+    finally:
+        sys.argv = orig_argv
+    try:
+        pid, status = os.wait()
+        assert os.waitstatus_to_exitcode(status) == 0
+    except ChildProcessError:
+        pass  # no background process
+    return stdout.getvalue()
+
+
+def cache_file_id(helper):
+    # the cache file is written to a temporary file then renamed
+    return helper.AUTOCOMPLETE_CACHE_PATH.stat().st_ino
+
+
+@define_test("autocomplete cache miss, hit and generation change")
+def test_autocomplete_cache():
+    helper = setup_helper()
+    argv = ("NODE", "rp")
+    # cache miss: the server is requested, the result is cached
+    assert run_helper(helper, *argv) == "rpi-1 rpi-2\n"
+    assert FakeServer.calls == ["shell_autocomplete"]
+    cache = json.loads(helper.AUTOCOMPLETE_CACHE_PATH.read_text())
+    assert [(e["result"], e["generation"]) for e in cache.values()] == [
+        ("rpi-1 rpi-2", "g1")]
+    # cache hit: the cached result is printed without requesting the
+    # server, and the cache file is not rewritten (the generation did
+    # not change)
+    file_id = cache_file_id(helper)
+    FakeServer.calls.clear()
+    assert run_helper(helper, *argv) == "rpi-1 rpi-2\n"
+    assert FakeServer.calls == []
+    assert cache_file_id(helper) == file_id
+    # generation change: the cached result is printed, and the
+    # background process updates the cache for next time
+    FakeServer.generation, FakeServer.result = "g2", "rpi-1 rpi-2 rpi-3"
+    assert run_helper(helper, *argv) == "rpi-1 rpi-2\n"
+    assert cache_file_id(helper) != file_id
+    assert run_helper(helper, *argv) == "rpi-1 rpi-2 rpi-3\n"
+    assert FakeServer.calls == []
+    # other requests have their own cache entry
+    assert run_helper(helper, "IMAGE", "rp") == "rpi-1 rpi-2 rpi-3\n"
+    assert FakeServer.calls == ["shell_autocomplete"]
+    cache = json.loads(helper.AUTOCOMPLETE_CACHE_PATH.read_text())
+    assert len(cache) == 2
+
+
+@define_test("autocomplete cache access times")
+def test_autocomplete_cache_atime():
+    helper = setup_helper()
+    run_helper(helper, "NODE", "rp")
+    # the access time is only updated when older than the precision
+    cache = json.loads(helper.AUTOCOMPLETE_CACHE_PATH.read_text())
+    (key, entry), = cache.items()
+    entry["atime"] -= helper.AUTOCOMPLETE_CACHE_ATIME_PRECISION + 1
+    helper.save_cache(cache)
+    old_atime = entry["atime"]
+    run_helper(helper, "NODE", "rp")
+    cache = json.loads(helper.AUTOCOMPLETE_CACHE_PATH.read_text())
+    assert cache[key]["atime"] > old_atime + helper.AUTOCOMPLETE_CACHE_ATIME_PRECISION
+    # the least recently used entries are discarded
+    for i in range(helper.AUTOCOMPLETE_CACHE_MAX_ENTRIES + 10):
+        helper.update_cache(["NODE", f"n{i}"], "result", "g1")
+    cache = json.loads(helper.AUTOCOMPLETE_CACHE_PATH.read_text())
+    assert len(cache) == helper.AUTOCOMPLETE_CACHE_MAX_ENTRIES
+    assert key not in cache
+    assert helper.get_cache_key(["NODE", "n0"]) not in cache
@@ -0,0 +1,124 @@
+import io
+import os
+
+from includes.common import define_test, skip_test
+
+# These tests check the stream compression of file transfers
+# (client/walt/client/compression.py).
+
+
+class FakeSockFile:
+    def __init__(self, peer_ip):
+        self._peer_ip = peer_ip
+
+    def getpeername(self):
+        return (self._peer_ip, 12345)
+
+
+def get_installed_compressors():
+    from walt.client.compression import COMPRESSION_LEVELS, _import_compressor
+
+    return [name for name in COMPRESSION_LEVELS if _import_compressor(name) is not None]
+
+
+@define_test("compressed tar streams")
+def test_compressed_streams():
+    from walt.client.compression import (
+        COMPRESSION_LEVELS,
+        compressed_writer,
+        decompressed_reader,
+    )
+
+    compressors = get_installed_compressors()
+    if len(compressors) == 0:
+        skip_test("requires python module zstandard or lz4")
+    data = os.urandom(300000) + b"walt " * 200000
+    for name in compressors:
+        for level in COMPRESSION_LEVELS[name]:
+            buf = io.BytesIO()
+            with compressed_writer((name, level), buf) as writer:
+                for offset in range(0, len(data), 65536):
+                    writer.write(data[offset : offset + 65536])
+            # the compressed stream is terminated, but buf is not closed
+            assert not buf.closed
+            assert buf.tell() < len(data) // 2
+            buf.seek(0)
+            reader = decompressed_reader((name, level), buf)
+            result = b""
+            while True:
+                chunk = reader.read(65536)
+                if len(chunk) == 0:
+                    break
+                result += chunk
+            assert result == data
+
+
+@define_test("compression negotiation")
+def test_compression_negotiation():
+    from walt.client import compression
+    from walt.client.compression import (
+        COMPRESSION_LEVELS,
+        get_compression_sample,
+        negotiate_compression,
+    )
+
+    compressors = get_installed_compressors()
+    if len(compressors) == 0:
+        skip_test("requires python module zstandard or lz4")
+    remote = FakeSockFile("192.168.1.2")
+    all_names = " ".join(COMPRESSION_LEVELS)
+    # older server, or no compressor available on the server
+    assert negotiate_compression("READY\n", remote) is None
+    # server on the same machine
+    assert (
+        negotiate_compression(f"READY {all_names}\n", FakeSockFile("127.0.0.1")) is None
+    )
+    # unknown compressors are ignored
+    assert negotiate_compression("READY xz\n", remote) is None
+    # the first compressor supported by both sides is selected, with one
+    # of its levels
+    for server_names in (all_names, " ".join(reversed(COMPRESSION_LEVELS))):
+        name, level = negotiate_compression(f"READY {server_names}\n", remote)
+        assert name == compressors[0]
+        assert level in COMPRESSION_LEVELS[name]
+    for name in compressors:
+        assert negotiate_compression(f"READY {name}\n", remote)[0] == name
+    # random data compressing at least as fast as the minimal speed, the
+    # probe returns the highest level, or None when no level is fast enough
+    sample = get_compression_sample()
+    assert len(sample) == compression.COMPRESSION_SAMPLE_SIZE
+    orig_min_speed = compression.COMPRESSION_MIN_SPEED
+    try:
+        compression.COMPRESSION_MIN_SPEED = 1
+        for name in compressors:
+            level = compression.probe_compression_level(name, sample)
+            assert level == COMPRESSION_LEVELS[name][0]
+        compression.COMPRESSION_MIN_SPEED = 10**15
+        for name in compressors:
+            assert compression.probe_compression_level(name, sample) is None
+        assert negotiate_compression(f"READY {all_names}\n", remote) is None
+    finally:
+        compression.COMPRESSION_MIN_SPEED = orig_min_speed
+
+
+@define_test("compression samples")
+def test_compression_samples():
+    import tempfile
+    from pathlib import Path
+
+    from walt.client.compression import COMPRESSION_SAMPLE_SIZE, get_compression_sample
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    (tmp_dir / "sub").mkdir()
+    (tmp_dir / "small").write_bytes(b"a" * 1000)
+    (tmp_dir / "sub" / "big").write_bytes(b"b" * (2 * COMPRESSION_SAMPLE_SIZE))
+    (tmp_dir / "broken-link").symlink_to("missing")
+    # the sample is taken from the files to be sent, up to
+    # COMPRESSION_SAMPLE_SIZE bytes
+    sample = get_compression_sample(tmp_dir)
+    assert len(sample) == COMPRESSION_SAMPLE_SIZE
+    assert set(sample) == {ord("a"), ord("b")}
+    assert get_compression_sample(tmp_dir / "small") == b"a" * 1000
+    # a directory without regular files gives the synthetic sample
+    (tmp_dir / "empty-dir").mkdir()
+    assert get_compression_sample(tmp_dir / "empty-dir") == get_compression_sample()
@@ -0,0 +1,29 @@
+import datetime
+
+from includes.common import define_test
+
+TEST_RECORD = dict(
+    timestamp=datetime.datetime(2015, 9, 28, 15, 16, 39, 123456),
+    issuer="node1",
+    stream="experiment.trace",
+    line="some log line",
+)
+
+
+@define_test("compiled log formats")
+def test_compile_log_format():
+    from walt.client.log import DEFAULT_FORMAT_STRING, compile_log_format
+
+    for format_string in (
+        DEFAULT_FORMAT_STRING,
+        "{timestamp:%Y-%m-%d} {issuer!r:>10} {{literal}} '\"\\ {line}",
+        "{timestamp.year}/{timestamp.month:02d} {line[0]}{line[1]} {stream!s}",
+    ):
+        render = compile_log_format(format_string)
+        # these formats should not need the slow path
+        assert render.__name__ == "<lambda>"
+        assert render(TEST_RECORD) == format_string.format_map(TEST_RECORD)
+    # formats falling back to str.format_map()
+    for format_string in ("{issuer:{stream}}", "{0}"):
+        render = compile_log_format(format_string)
+        assert render == format_string.format_map
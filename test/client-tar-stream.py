@@ -0,0 +1,83 @@
+import filecmp
+import os
+import socket
+import subprocess
+import tempfile
+from pathlib import Path
+
+from includes.common import define_test
+from walt.common.tcp import RWSocketFile
+
+# These tests stream tar archives with open_tar_stream()
+# (client/walt/client/transfer.py) over a socketpair, with a 'tar'
+# process at the other end, as on the server side of 'walt image cp'
+# and 'walt node cp'.
+
+BIG_FILE_SIZE = 16 * 1024 * 1024
+
+
+class CountingSocketFile(RWSocketFile):
+    def __init__(self, sock):
+        RWSocketFile.__init__(self, sock)
+        self.num_calls = 0
+
+    def read1(self, size=-1):
+        self.num_calls += 1
+        return RWSocketFile.read1(self, size)
+
+    def write(self, msg):
+        self.num_calls += 1
+        return RWSocketFile.write(self, msg)
+
+
+def make_tree():
+    src_dir = Path(tempfile.mkdtemp())
+    (src_dir / "dir" / "sub").mkdir(parents=True)
+    (src_dir / "dir" / "small.txt").write_text("small file\n")
+    (src_dir / "dir" / "sub" / "empty").touch()
+    (src_dir / "dir" / "link").symlink_to("small.txt")
+    with open(src_dir / "dir" / "sub" / "big.bin", "wb") as f:
+        f.write(os.urandom(BIG_FILE_SIZE))
+    return src_dir
+
+
+def check_same_tree(dir1, dir2):
+    cmp = filecmp.dircmp(dir1, dir2)
+    assert cmp.left_only == cmp.right_only == cmp.diff_files == []
+    for sub_dir in cmp.common_dirs:
+        check_same_tree(dir1 / sub_dir, dir2 / sub_dir)
+
+
+@define_test("client tar streams")
+def test_tar_streams():
+    from walt.client.transfer import open_tar_stream
+
+    src_dir = make_tree()
+    # client sending, 'tar x' receiving
+    dst_dir = Path(tempfile.mkdtemp())
+    client_s, server_s = socket.socketpair()
+    tar = subprocess.Popen(["tar", "x", "-C", str(dst_dir)], stdin=server_s.fileno())
+    server_s.close()
+    f = CountingSocketFile(client_s)
+    with open_tar_stream("w|", f) as archive:
+        archive.add(src_dir / "dir", arcname="dir")
+    f.shutdown(socket.SHUT_WR)
+    assert tar.wait() == 0
+    f.close()
+    check_same_tree(src_dir / "dir", dst_dir / "dir")
+    assert (dst_dir / "dir" / "link").readlink() == Path("small.txt")
+    # large buffers: much fewer writes than with tarfile defaults (10KiB)
+    assert f.num_calls < BIG_FILE_SIZE // (128 * 1024)
+    # 'tar c' sending, client receiving
+    dst_dir = Path(tempfile.mkdtemp())
+    client_s, server_s = socket.socketpair()
+    tar = subprocess.Popen(["tar", "c", "-C", str(src_dir), "dir"],
+                           stdout=server_s.fileno())
+    server_s.close()
+    f = CountingSocketFile(client_s)
+    with open_tar_stream("r|", f) as archive:
+        archive.extractall(path=dst_dir)
+    assert tar.wait() == 0
+    f.close()
+    check_same_tree(src_dir / "dir", dst_dir / "dir")
+    assert f.num_calls < BIG_FILE_SIZE // (32 * 1024)
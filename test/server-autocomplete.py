@@ -0,0 +1,189 @@
+import types
+
+import numpy as np
+from includes.common import define_test
+
+# These tests check the completion index of the server
+# (server/walt/server/processes/main/autocomplete.py), with a fake db
+# and a fake image store, and verify that the code renaming, registering
+# and forgetting devices or images keeps it up to date.
+
+NUM_NAMES = 10000
+
+
+class FakeDB:
+    def __init__(self, devices):
+        self.devices = devices
+        self.num_queries = 0
+
+    def execute(self, query, *args):
+        if query.startswith("SELECT name, type FROM devices"):
+            self.num_queries += 1
+            return np.rec.fromrecords(
+                [(d.name, d.type) for d in self.devices.values()],
+                dtype=[("name", "O"), ("type", "O")],
+            )
+
+    def select_unique(self, table, mac):
+        return self.devices.get(mac)
+
+    def insert(self, table, **kwargs):
+        if table == "devices":
+            self.devices[kwargs["mac"]] = types.SimpleNamespace(**kwargs)
+
+    def update(self, table, key, mac, **kwargs):
+        self.devices[mac].__dict__.update(kwargs)
+
+    def forget_device(self, mac):
+        del self.devices[mac]
+
+    def delete(self, table, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+
+class FakeImage:
+    def __init__(self, store, fullname):
+        self.rename(fullname)
+
+    def rename(self, fullname):
+        self.user, self.name = fullname.split("/", 1)
+        if self.name.endswith(":latest"):
+            self.name = self.name[:-len(":latest")]
+
+
+class FakeLogs:
+    def platform_log(self, *args, **kwargs):
+        pass
+
+    def forget_device(self, device):
+        pass
+
+
+def fake_server(num_names):
+    from walt.server.processes.main.autocomplete import CompletionIndex
+
+    devices = {}
+    for i in range(num_names):
+        mac = f"00:00:00:00:{i // 256:02x}:{i % 256:02x}"
+        dev_type = ("node", "switch", "unknown")[i % 3]
+        devices[mac] = types.SimpleNamespace(
+            mac=mac, ip=None, name=f"{dev_type}-{i:05d}", type=dev_type)
+    server = types.SimpleNamespace(db=FakeDB(devices), logs=FakeLogs())
+    server.images = types.SimpleNamespace(store={})
+    for i in range(num_names):
+        fullname = f"user{i % 10}/image{i}:latest"
+        server.images.store[fullname] = FakeImage(None, fullname)
+    server.autocomplete_index = CompletionIndex(server)
+    return server
+
+
+@define_test("completion index with 10k names")
+def test_completion_index():
+    from walt.server.processes.main import autocomplete
+
+    server = fake_server(NUM_NAMES)
+    index = server.autocomplete_index
+    assert len(autocomplete.complete_node(server, "")) == 3334
+    assert autocomplete.complete_device(server, "switch-0001") == tuple(
+        f"switch-0001{i}" for i in (0, 3, 6, 9))
+    assert autocomplete.complete_switch(server, "node-") == ()
+    assert autocomplete.complete_set_of_nodes(server, "node-00000,node-0999") == (
+        "node-00000,node-09990", "node-00000,node-09993",
+        "node-00000,node-09996", "node-00000,node-09999")
+    assert autocomplete.complete_set_of_nodes(server, "x,my-") == (
+        "x,my-nodes", "x,my-nodes,")
+    # user3 owns image13, image133 and image1303 to image1393
+    images = autocomplete.complete_image(server, None, "user3", "image13")
+    assert len(images) == 24 and images[:2] == ("image13", "image1303")
+    assert "image13:latest" in images
+    # the db was queried only once
+    assert server.db.num_queries == 1
+    # generation numbers change on invalidation only
+    gen_node, gen_image = index.get_generation("NODE"), index.get_generation("IMAGE")
+    assert index.get_generation("SET_OF_DEVICES") == gen_node
+    assert index.get_generation("LOG_CHECKPOINT") is None
+    index.invalidate_devices()
+    assert index.get_generation("NODE") != gen_node
+    assert index.get_generation("IMAGE") == gen_image
+    autocomplete.complete_device(server, "n")
+    assert server.db.num_queries == 2
+
+
+@define_test("completion index updates on device changes")
+def test_completion_index_devices():
+    from walt.server.processes.main import autocomplete
+    from walt.server.processes.main.devices.manager import DevicesManager
+    from walt.server.processes.main.server import Server
+
+    server = fake_server(10)
+    index = server.autocomplete_index
+    assert autocomplete.complete_node(server, "") == ("node-00000", "node-00003",
+                                                      "node-00006", "node-00009")
+    # rename
+    devices = DevicesManager.__new__(DevicesManager)
+    devices.server, devices.db, devices.logs = server, server.db, server.logs
+    devices.get_device_info = lambda requester, name: next(
+        (d for d in server.db.devices.values() if d.name == name), None)
+    generation = index.get_generation("NODE")
+    assert devices.rename(None, "node-00003", "renamed")
+    assert index.get_generation("NODE") != generation
+    assert autocomplete.complete_node(server, "") == ("node-00000", "node-00006",
+                                                      "node-00009", "renamed")
+    # register
+    generation = index.get_generation("NODE")
+    assert devices.add_or_update(mac="00:00:00:00:01:00", ip="192.168.152.100",
+                                 name="new-device")
+    assert index.get_generation("NODE") != generation
+    assert "new-device" in autocomplete.complete_device(server, "new")
+    # forget
+    generation = index.get_generation("NODE")
+    device = server.db.devices["00:00:00:00:00:00"]
+    device.conf = {}
+    updated = []
+    fake_server_self = types.SimpleNamespace(
+        logs=server.logs, db=server.db, autocomplete_index=index,
+        dhcpd=types.SimpleNamespace(update=lambda: updated.append("dhcpd")),
+        named=types.SimpleNamespace(update=lambda: updated.append("named")),
+        nodes=types.SimpleNamespace(forget_device=lambda device: None),
+    )
+    wf = types.SimpleNamespace(next=lambda: None)
+    Server.wf_forget_device_other_steps(fake_server_self, wf, None, device)
+    assert index.get_generation("NODE") != generation
+    assert autocomplete.complete_node(server, "") == ("node-00006", "node-00009",
+                                                      "renamed")
+
+
+@define_test("completion index updates on image changes")
+def test_completion_index_images():
+    from walt.server.processes.main import autocomplete
+    from walt.server.processes.main.images import store
+
+    server = fake_server(20)
+    index = server.autocomplete_index
+    image_store = store.NodeImageStore.__new__(store.NodeImageStore)
+    image_store.server, image_store.db = server, server.db
+    image_store.images = server.images.store
+    store.NodeImage = FakeImage
+    assert autocomplete.complete_image(server, None, "user1") == (
+        "image1", "image11", "image1:latest", "image11:latest")
+    # rename
+    generation = index.get_generation("IMAGE")
+    image_store.rename("user1/image11:latest", "user1/other:latest")
+    assert index.get_generation("IMAGE") != generation
+    assert autocomplete.complete_image(server, None, "user1") == (
+        "image1", "other", "image1:latest", "other:latest")
+    # register
+    generation = index.get_generation("IMAGE")
+    image_store.register_image("user1/new:latest")
+    assert index.get_generation("IMAGE") != generation
+    assert autocomplete.complete_image(server, None, "user1", "n") == (
+        "new", "new:latest")
+    # remove
+    generation = index.get_generation("IMAGE")
+    image_store.remove("user1/image1:latest")
+    assert index.get_generation("IMAGE") != generation
+    assert autocomplete.complete_image(server, None, "user1") == (
+        "new", "other", "new:latest", "other:latest")
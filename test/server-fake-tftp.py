@@ -0,0 +1,105 @@
+import os
+import socket
+import tempfile
+import threading
+
+from includes.common import define_test
+from walt.common.evloop import EventLoop
+from walt.common.tcp import RWSocketFile, write_pickle
+
+# These tests run the server side of fake TFTP transfers (NodeFakeTFTPGet
+# in server/walt/server/processes/main/transfer.py) in an event loop,
+# with clients connected through socketpairs.
+
+NODE_MAC = "52:54:00:12:34:56"
+NODE_IP = "192.168.152.2"
+KERNEL_SIZE = 8 * 1024 * 1024
+NUM_CLIENTS = 20
+
+
+def setup_tftp_dirs():
+    from walt.server.processes.main import transfer
+
+    tmp_dir = tempfile.mkdtemp()
+    transfer.NODE_TFTP_ROOT = tmp_dir + "/%(node_id)s/tftp"
+    files = {}
+    for node_id in (NODE_MAC, NODE_IP):
+        tftp_dir = transfer.NODE_TFTP_ROOT % dict(node_id=node_id)
+        os.makedirs(tftp_dir + "/boot-dir")
+        for name, size in (("kernel", KERNEL_SIZE), ("cmdline", 100),
+                           ("empty", 0)):
+            content = os.urandom(size)
+            with open(f"{tftp_dir}/{name}", "wb") as f:
+                f.write(content)
+            files[(node_id, "/" + name)] = content
+    return files
+
+
+def fake_tftp_get(client_sock, **params):
+    f = RWSocketFile(client_sock)
+    try:
+        assert f.readline() == b"READY\n"
+        write_pickle(params, f)
+        status = f.readline().decode().strip()
+        if status != "OK":
+            return status, None
+        size = int(f.readline())
+        content = b""
+        while len(content) < size:
+            chunk = f.read1(size - len(content))
+            assert len(chunk) > 0
+            content += chunk
+        # the server closes the connection after the file content
+        assert f.read1(1) == b""
+        return status, content
+    finally:
+        f.close()
+
+
+def run_clients(requests):
+    from walt.server.processes.main.transfer import NodeFakeTFTPGet
+
+    ev_loop = EventLoop()
+    results = [None] * len(requests)
+    threads = []
+
+    def client(i, client_sock, params):
+        results[i] = fake_tftp_get(client_sock, **params)
+
+    for i, params in enumerate(requests):
+        server_sock, client_sock = socket.socketpair()
+        ev_loop.register_listener(NodeFakeTFTPGet(ev_loop, RWSocketFile(server_sock)))
+        thread = threading.Thread(target=client, args=(i, client_sock, params))
+        thread.start()
+        threads.append(thread)
+    ev_loop.loop(lambda: any(thread.is_alive() for thread in threads))
+    for thread in threads:
+        thread.join()
+    # all listeners were removed and closed
+    assert len(ev_loop.listeners_per_fd) == 0
+    return results
+
+
+@define_test("fake tftp transfers of boot files")
+def test_fake_tftp_get():
+    files = setup_tftp_dirs()
+    requests = [dict(node_mac=NODE_MAC, path="/kernel"),
+                dict(node_ip=NODE_IP, path="/cmdline"),
+                dict(node_mac=NODE_MAC, path="/empty")]
+    requests += [dict(node_mac=NODE_MAC, path="/kernel")] * NUM_CLIENTS
+    results = run_clients(requests)
+    for params, (status, content) in zip(requests, results):
+        node_id = params.get("node_mac", params.get("node_ip"))
+        assert status == "OK"
+        assert content == files[(node_id, params["path"])]
+
+
+@define_test("fake tftp errors")
+def test_fake_tftp_errors():
+    setup_tftp_dirs()
+    results = run_clients([dict(node_mac=NODE_MAC, path="/missing"),
+                           dict(node_mac=NODE_MAC, path="/boot-dir"),
+                           dict(node_mac="unknown-mac", path="/kernel"),
+                           dict(path="/kernel")])
+    assert results == [("NO SUCH FILE", None)] * 3 + [
+        ("NO MAC OR IP SPECIFIED", None)]
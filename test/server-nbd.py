@@ -0,0 +1,181 @@
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from includes.common import define_test
+
+# These tests run the NBD server (server/walt/server/services/nbd.py)
+# in a thread, on a free TCP port, and connect to it with a minimal
+# NBD client.
+
+NBD_CLIENT_FLAGS = 0x3  # NBD_FLAG_C_FIXED_NEWSTYLE | NBD_FLAG_C_NO_ZEROES
+NBD_OPT_GO = 7
+NBD_REP_ACK = 1
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ, NBD_CMD_WRITE, NBD_CMD_DISC, NBD_CMD_FLUSH = 0, 1, 2, 3
+NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES = 4, 6
+NBD_CMD_FLAG_NO_HOLE = 1 << 1
+NBD_EINVAL = 22
+EXPORT_SIZE = 16 * 1024 * 1024 * 1024
+BLOCK_SIZE = 4096
+NUM_BLOCKS = 256
+NUM_CLIENTS = 8
+NUM_ROUNDS = 10
+NUM_OPS_PER_ROUND = 64
+REPLY_TIMEOUT = 30
+
+
+def start_nbd_server():
+    import walt.server.services.nbd as nbd
+
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    nbd.NBD_PORT = s.getsockname()[1]
+    s.close()
+    threading.Thread(target=nbd.run, daemon=True).start()
+    return nbd.NBD_PORT
+
+
+class NBDClient:
+    def __init__(self, port):
+        for _ in range(50):
+            try:
+                self._s = socket.create_connection(("127.0.0.1", port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)  # server not listening yet
+        self._s.settimeout(REPLY_TIMEOUT)
+        self._f = self._s.makefile("rwb")
+        assert self._read(18)[:16] == b"NBDMAGICIHAVEOPT"
+        self._f.write(struct.pack("!I", NBD_CLIENT_FLAGS))
+        name = b"swap-1G"
+        opt_data = struct.pack("!I", len(name)) + name + struct.pack("!H", 0)
+        self._f.write(struct.pack("!8sII", b"IHAVEOPT", NBD_OPT_GO, len(opt_data)))
+        self._f.write(opt_data)
+        self._f.flush()
+        while True:
+            magic, opt, rep, length = struct.unpack("!QIII", self._read(20))
+            self._read(length)
+            if rep == NBD_REP_ACK:
+                break
+        self._last_cookie = 0
+        self._pending = {}
+
+    def _read(self, length):
+        data = self._f.read(length)
+        assert len(data) == length
+        return data
+
+    def send(self, req_type, offset, length, data=b"", flags=0):
+        self._last_cookie += 1
+        cookie = self._last_cookie
+        self._f.write(struct.pack("!IHHQQI", NBD_REQUEST_MAGIC, flags, req_type,
+                                  cookie, offset, length) + data)
+        self._pending[cookie] = (req_type, length)
+        return cookie
+
+    def recv_replies(self):
+        """Read the replies of all pending requests, return a dict
+        {cookie: (error, data)}."""
+        self._f.flush()
+        replies = {}
+        while len(self._pending) > 0:
+            magic, error, cookie = struct.unpack("!IIQ", self._read(16))
+            assert magic == NBD_SIMPLE_REPLY_MAGIC
+            req_type, length = self._pending.pop(cookie)
+            data = None
+            if req_type == NBD_CMD_READ and error == 0:
+                data = self._read(length)
+            replies[cookie] = (error, data)
+        return replies
+
+    def request(self, *args, **kwargs):
+        cookie = self.send(*args, **kwargs)
+        return self.recv_replies()[cookie]
+
+    def disconnect(self):
+        self.send(NBD_CMD_DISC, 0, 0)
+        self._pending.clear()
+        self._f.flush()
+        assert self._f.read(1) == b""  # closed by the server
+        self._s.close()
+
+
+def run_client(port, seed):
+    rnd = random.Random(seed)
+    client = NBDClient(port)
+    zero_block = bytes(BLOCK_SIZE)
+    expected = {}
+    for _ in range(NUM_ROUNDS):
+        # pipeline write, trim and write-zeroes requests on distinct
+        # blocks (the server may handle them in any order)
+        blocks = rnd.sample(range(NUM_BLOCKS), NUM_OPS_PER_ROUND)
+        for block in blocks:
+            offset = block * BLOCK_SIZE
+            op = rnd.randrange(4)
+            if op < 2:
+                data = rnd.randbytes(BLOCK_SIZE)
+                client.send(NBD_CMD_WRITE, offset, BLOCK_SIZE, data)
+                expected[block] = data
+            elif op == 2:
+                client.send(NBD_CMD_TRIM, offset, BLOCK_SIZE)
+                expected[block] = zero_block
+            else:
+                flags = rnd.choice((0, NBD_CMD_FLAG_NO_HOLE))
+                client.send(NBD_CMD_WRITE_ZEROES, offset, BLOCK_SIZE, flags=flags)
+                expected[block] = zero_block
+        replies = client.recv_replies()
+        assert len(replies) == NUM_OPS_PER_ROUND
+        assert all(error == 0 for error, data in replies.values())
+        # pipeline reads of all blocks, and check their content
+        read_cookies = {}
+        for block in range(NUM_BLOCKS):
+            cookie = client.send(NBD_CMD_READ, block * BLOCK_SIZE, BLOCK_SIZE)
+            read_cookies[cookie] = block
+        replies = client.recv_replies()
+        for cookie, block in read_cookies.items():
+            assert replies[cookie] == (0, expected.get(block, zero_block))
+    client.disconnect()
+
+
+@define_test("nbd server with concurrent clients")
+def test_nbd_concurrent_clients():
+    port = start_nbd_server()
+    errors = []
+
+    def client_thread(seed):
+        try:
+            run_client(port, seed)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client_thread, args=(seed,))
+               for seed in range(NUM_CLIENTS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+@define_test("nbd server error replies")
+def test_nbd_error_replies():
+    port = start_nbd_server()
+    client = NBDClient(port)
+    # NBD_CMD_FLUSH was not negotiated
+    assert client.request(NBD_CMD_FLUSH, 0, 0) == (NBD_EINVAL, None)
+    # out of the export
+    offset = EXPORT_SIZE - BLOCK_SIZE
+    assert client.request(NBD_CMD_READ, offset, 2 * BLOCK_SIZE) == (NBD_EINVAL, None)
+    data = os.urandom(2 * BLOCK_SIZE)
+    assert client.request(NBD_CMD_WRITE, offset, len(data), data) == (NBD_EINVAL, None)
+    # the connection is still usable
+    data = data[:BLOCK_SIZE]
+    assert client.request(NBD_CMD_WRITE, offset, BLOCK_SIZE, data) == (0, None)
+    assert client.request(NBD_CMD_READ, offset, BLOCK_SIZE) == (0, data)
+    client.disconnect()
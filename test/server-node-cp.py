@@ -0,0 +1,180 @@
+import contextlib
+import io
+import os
+import socket
+import tarfile
+import tempfile
+import threading
+from pathlib import Path
+
+from includes.common import define_test
+from walt.common.evloop import EventLoop
+from walt.common.tcp import RWSocketFile, read_pickle, write_pickle
+
+# These tests run the server side of 'walt node cp <path> <node-set>:<dir>'
+# (NodeSetTarFanOut) against fake node ssh endpoints: the ssh command is
+# replaced by a script running the remote command locally, in directory
+# <fake-nodes-dir>/<node-ip>.
+
+FAKE_SSH = """\
+#!/bin/sh
+eval node_cmd=\\"\\${$#}\\"
+eval node_host=\\"\\${$(($# - 1))}\\"
+cd "%(fake_nodes_dir)s/${node_host#root@}" && exec sh -c "$node_cmd"
+"""
+NUM_FAKE_NODES = 24
+
+
+def setup_fake_nodes(dst_dir, missing=()):
+    from walt.server.processes.main import transfer
+
+    fake_nodes_dir = Path(tempfile.mkdtemp())
+    fake_ssh = fake_nodes_dir / "fake-ssh"
+    fake_ssh.write_text(FAKE_SSH % dict(fake_nodes_dir=fake_nodes_dir))
+    fake_ssh.chmod(0o755)
+    transfer.SSH_NODE_COMMAND = str(fake_ssh)
+    nodes = []
+    for i in range(NUM_FAKE_NODES):
+        node_ip = f"fake-{i}"
+        if i in missing:
+            (fake_nodes_dir / node_ip).mkdir()
+        else:
+            (fake_nodes_dir / node_ip / dst_dir).mkdir(parents=True)
+        nodes.append((f"node-{i}", node_ip))
+    return fake_nodes_dir, nodes
+
+
+def make_archive():
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w") as archive:
+        for name, content in (("test-dir/a.txt", b"a" * 1000),
+                              ("test-dir/sub/b.bin", os.urandom(300000))):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+    return f.getvalue()
+
+
+def run_fanout(pending_copies, copy_id, archive):
+    from walt.server.processes.main.transfer import NodeSetTarFanOut
+
+    server_s, client_s = socket.socketpair()
+    ev_loop = EventLoop()
+
+    def serve():
+        listener = NodeSetTarFanOut(ev_loop=ev_loop,
+                                    sock_file=RWSocketFile(server_s),
+                                    pending_copies=pending_copies)
+        ev_loop.register_listener(listener)
+        ev_loop.loop()
+
+    server_thread = threading.Thread(target=serve)
+    server_thread.start()
+    f = RWSocketFile(client_s)
+    assert f.readline().startswith(b"READY")
+    write_pickle(dict(copy_id=copy_id), f)
+    f.write(archive)
+    f.shutdown(socket.SHUT_WR)
+    results = read_pickle(f)
+    f.close()
+    server_thread.join()
+    return results
+
+
+@define_test("node cp fan-out with fake node ssh endpoints")
+def test_node_cp_fanout():
+    from walt.server.processes.main.transfer import PendingNodeSetCopies
+
+    fake_nodes_dir, nodes = setup_fake_nodes("dst", missing=(3,))
+    pending_copies = PendingNodeSetCopies()
+    copy_id = pending_copies.add(nodes, "./dst")
+    archive = make_archive()
+    results = run_fanout(pending_copies, copy_id, archive)
+    assert len(results) == NUM_FAKE_NODES
+    for i, (node_name, node_ip) in enumerate(nodes):
+        if i == 3:
+            assert results[node_name] != "OK"
+        else:
+            assert results[node_name] == "OK"
+            with tarfile.open(fileobj=io.BytesIO(archive)) as ref:
+                for member in ref.getmembers():
+                    path = fake_nodes_dir / node_ip / "dst" / member.name
+                    assert path.read_bytes() == ref.extractfile(member).read()
+    # the copy id cannot be used twice
+    assert pending_copies.pop(copy_id) is None
+
+
+@define_test("node cp fan-out with shell chars in destination")
+def test_node_cp_fanout_shell_chars():
+    from walt.server.processes.main.transfer import PendingNodeSetCopies
+
+    dst_dir = "dst '$(touch pwned)'`touch pwned`;touch pwned"
+    fake_nodes_dir, nodes = setup_fake_nodes(dst_dir)
+    pending_copies = PendingNodeSetCopies()
+    copy_id = pending_copies.add(nodes, "./" + dst_dir)
+    cwd = os.getcwd()
+    os.chdir(fake_nodes_dir)
+    try:
+        results = run_fanout(pending_copies, copy_id, make_archive())
+    finally:
+        os.chdir(cwd)
+    assert set(results.values()) == {"OK"}
+    assert len(list(fake_nodes_dir.glob("**/pwned"))) == 0
+    for _, node_ip in nodes:
+        assert (fake_nodes_dir / node_ip / dst_dir / "test-dir/a.txt").exists()
+
+
+def run_rejected_fanout(pending_copies, **params):
+    from walt.client.transfer import PickleMessageReader
+    from walt.server.processes.main.transfer import NodeSetTarFanOut
+
+    server_s, client_s = socket.socketpair()
+    ev_loop = EventLoop()
+    listener = NodeSetTarFanOut(ev_loop=ev_loop,
+                                sock_file=RWSocketFile(server_s),
+                                pending_copies=pending_copies)
+    ev_loop.register_listener(listener)
+    f = RWSocketFile(client_s)
+    assert f.readline().startswith(b"READY")
+    write_pickle(params, f)
+    ev_loop.loop()  # ends when the listener rejects the request
+    msg = PickleMessageReader.read_message(f)
+    assert PickleMessageReader.read_message(f) is None  # closed
+    f.close()
+    return msg
+
+
+@define_test("node cp fan-out error messages")
+def test_node_cp_fanout_errors():
+    import walt.client.transfer as client_transfer
+    from walt.server.processes.main.transfer import PendingNodeSetCopies
+
+    _, nodes = setup_fake_nodes("dst")
+    node_names = [node_name for node_name, _ in nodes]
+    pending_copies = PendingNodeSetCopies()
+    # messages are pickled, as the client expects
+    msg = run_rejected_fanout(pending_copies, copy_id="unknown")
+    assert msg == "INVALID OR EXPIRED COPY ID"
+    copy_id = pending_copies.add(nodes, "./dst")
+    msg = run_rejected_fanout(pending_copies, copy_id=copy_id,
+                              compression=("unknown", 1))
+    assert msg == dict.fromkeys(node_names, "INVALID COMPRESSION PARAMETERS")
+    # the client reports these errors for all nodes
+    def fake_run_transfer(on_message, **kwargs):
+        on_message(None, "INVALID OR EXPIRED COPY ID")
+        return False
+
+    orig_run_transfer = client_transfer.run_transfer
+    client_transfer.run_transfer = fake_run_transfer
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(stderr):
+            ok = client_transfer.run_transfer_with_node_set(
+                node_names, {"node-x": "Not owned."}, "src", "dst")
+    finally:
+        client_transfer.run_transfer = orig_run_transfer
+    assert not ok
+    assert stderr.getvalue().splitlines() == [
+        "Node node-x: not owned.",
+        f"{NUM_FAKE_NODES} nodes: invalid or expired copy id",
+    ]
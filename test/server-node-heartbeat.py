@@ -0,0 +1,152 @@
+import socket
+
+from includes.common import define_test
+
+# These tests simulate a fleet of nodes sending UDP heartbeats to the
+# server-side NodeHeartbeatListener. Each simulated node uses its own
+# loopback address (127.<x>.<y>.1) as source address, and the clock
+# of the listener is simulated too, so the tests run fast.
+
+NUM_FAKE_NODES = 5000
+SOCKETS_BATCH = 500
+
+
+class FakeBootupStatusManager:
+    cleaning_up = False
+
+    def __init__(self):
+        self.events = []
+
+    def add_booted_event(self, node_ip, booted, details):
+        self.events.append((node_ip, booted, details.get("note")))
+
+
+class FakeFleet:
+    def __init__(self):
+        from walt.server.processes.main.nodes import status
+
+        self.status = status
+        self.now = 1000000.0
+        status.time = lambda: self.now
+        self.manager = FakeBootupStatusManager()
+        self.listener = status.NodeHeartbeatListener(self.manager, 0)
+        self.server_addr = ("127.0.0.1", self.listener.s.getsockname()[1])
+        self.ips = [f"127.{1 + i // 250}.{1 + i % 250}.1"
+                    for i in range(NUM_FAKE_NODES)]
+        self.seqs = [0] * NUM_FAKE_NODES
+
+    def heartbeats(self, node_ids, restart=False):
+        """Let the given nodes send a heartbeat; return the number of acks"""
+        node_ids = list(node_ids)
+        num_acks = 0
+        for i in range(0, len(node_ids), SOCKETS_BATCH):
+            batch = node_ids[i:i + SOCKETS_BATCH]
+            socks = []
+            for node_id in batch:
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                s.bind((self.ips[node_id], 0))
+                if restart:
+                    self.seqs[node_id] = 0
+                self.seqs[node_id] += 1
+                s.sendto(b"HB %d\n" % self.seqs[node_id], self.server_addr)
+                socks.append((node_id, s))
+            self.listener.handle_event(self.now)
+            for node_id, s in socks:
+                s.settimeout(1)
+                if s.recv(64) == b"ACK %d\n" % self.seqs[node_id]:
+                    num_acks += 1
+                s.close()
+        return num_acks
+
+    def advance(self, delay):
+        self.now += delay
+        self.listener.sweep()
+
+    def pop_events(self):
+        events, self.manager.events = self.manager.events, []
+        return events
+
+    def close(self):
+        self.listener.close()
+
+
+@define_test("heartbeats of 5,000 simulated nodes")
+def test_heartbeats_fleet():
+    fleet = FakeFleet()
+    max_interval = fleet.status.NODE_HEARTBEAT_MAX_INTERVAL
+    all_nodes = range(NUM_FAKE_NODES)
+    try:
+        # all nodes boot
+        assert fleet.heartbeats(all_nodes) == NUM_FAKE_NODES
+        events = fleet.pop_events()
+        assert len(events) == NUM_FAKE_NODES
+        assert all(booted for _, booted, _ in events)
+        # nodes 0-99 stop sending heartbeats, nodes 100-199 lose
+        # 2 heartbeats in a row, the others keep on sending them
+        # at the slowest possible rate.
+        for _ in range(2):
+            fleet.advance(max_interval)
+            fleet.heartbeats(range(200, NUM_FAKE_NODES))
+            assert fleet.pop_events() == []
+        fleet.advance(max_interval)
+        fleet.heartbeats(range(100, NUM_FAKE_NODES))
+        assert fleet.pop_events() == []
+        # 3 heartbeats were missed by nodes 0-99
+        fleet.advance(max_interval)
+        fleet.heartbeats(range(100, NUM_FAKE_NODES))
+        events = fleet.pop_events()
+        assert sorted(ip for ip, _, _ in events) == sorted(fleet.ips[:100])
+        assert all(not booted for _, booted, _ in events)
+        # node 200 reboots, this is detected by the sequence restart
+        assert fleet.heartbeats([200], restart=True) == 1
+        assert fleet.pop_events() == [
+            (fleet.ips[200], False, "heartbeat restarted"),
+            (fleet.ips[200], True, None),
+        ]
+        # node 0 boots again
+        assert fleet.heartbeats([0], restart=True) == 1
+        assert fleet.pop_events() == [(fleet.ips[0], True, None)]
+    finally:
+        fleet.close()
+
+
+@define_test("heartbeats of nodes restarting quickly")
+def test_heartbeats_restart():
+    fleet = FakeFleet()
+    try:
+        assert fleet.heartbeats(range(3)) == 3
+        fleet.pop_events()
+        for _ in range(4):
+            fleet.advance(1)
+            fleet.heartbeats([2])
+        # node 0 is rebooted by the server (e.g., 'walt node reboot'),
+        # which marks it down, and it restarts right away: its first
+        # heartbeat has the same sequence number as before.
+        fleet.listener.forget([fleet.ips[0]])
+        fleet.advance(1)
+        assert fleet.heartbeats([0], restart=True) == 1
+        assert fleet.pop_events() == [(fleet.ips[0], True, None)]
+        # node 1 is forgotten, then registered again
+        fleet.listener.forget([fleet.ips[1]])
+        assert fleet.heartbeats([1]) == 1
+        assert fleet.pop_events() == [(fleet.ips[1], True, None)]
+        # node 2 reboots and the first heartbeat it sends is lost
+        fleet.seqs[2] = 1
+        assert fleet.heartbeats([2]) == 1
+        assert fleet.pop_events() == [
+            (fleet.ips[2], False, "heartbeat restarted"),
+            (fleet.ips[2], True, None),
+        ]
+        # in all cases the deadline was refreshed
+        fleet.advance(fleet.status.NODE_HEARTBEAT_TIMEOUT - 2)
+        assert fleet.pop_events() == []
+        # a duplicate datagram is acknowledged, but it does not refresh
+        # the deadline
+        fleet.seqs[2] -= 1
+        assert fleet.heartbeats([2]) == 1
+        fleet.advance(3)
+        events = fleet.pop_events()
+        assert sorted(ip for ip, _, _ in events) == sorted(fleet.ips[:3])
+        assert all(not booted for _, booted, _ in events)
+    finally:
+        fleet.close()
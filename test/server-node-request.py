@@ -0,0 +1,188 @@
+import errno
+import socket
+import sys
+import threading
+import time
+
+from includes.common import define_test
+
+# These tests run server-to-node requests (NodeRequestBatch) against a fake
+# node netservice endpoint listening on the loopback interface. Each
+# simulated node uses its own loopback address (127.0.<x>.<y>).
+
+NUM_FAKE_NODES = 300
+FAILING_NODE_SUFFIX = ".7"
+
+
+class FakeNode:
+    def __init__(self, ip):
+        self.ip = ip
+        self.name = f"node-{ip}"
+
+
+class FakeNetService:
+    """Fake node netservice endpoint; nodes with an IP ending with
+    FAILING_NODE_SUFFIX reply with an error, the others reply OK after
+    a short delay (in two parts)."""
+
+    def __init__(self, reply=True):
+        from walt.server.processes.main.nodes import netservice
+
+        self.reply = reply
+        self.requests = []
+        self.s = socket.socket()
+        self.s.bind(("0.0.0.0", 0))
+        self.s.listen(1024)
+        netservice.WALT_NODE_NET_SERVICE_PORT = self.s.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.s.accept()
+            except OSError:
+                return  # closed
+            # the node IP is the destination address of the connection
+            node_ip = conn.getsockname()[0]
+            threading.Thread(
+                target=self.handle, args=(conn, node_ip), daemon=True
+            ).start()
+
+    def handle(self, conn, node_ip):
+        with conn:
+            f = conn.makefile("rb")
+            self.requests.append((node_ip, f.readline(), f.readline()))
+            if not self.reply:
+                time.sleep(2)
+                return
+            time.sleep(0.02)
+            if node_ip.endswith(FAILING_NODE_SUFFIX):
+                conn.sendall(b"FAILED some error\n")
+            else:
+                conn.sendall(b"O")
+                time.sleep(0.01)
+                conn.sendall(b"K\n")
+
+    def close(self):
+        self.s.close()
+
+
+def fake_nodes(num_nodes):
+    return [FakeNode(f"127.0.{1 + i // 250}.{1 + i % 250}") for i in range(num_nodes)]
+
+
+def run_requests(nodes, req="REBOOT"):
+    from walt.common.evloop import EventLoop
+    from walt.server.processes.main.nodes import netservice
+
+    ev_loop = EventLoop()
+    done = []
+
+    def cb(results):
+        done.append({msg: set(n.ip for n in nodes) for msg, nodes in results.items()})
+
+    netservice.node_request(ev_loop, nodes, req, cb, {})
+    if len(done) == 0:
+        ev_loop.loop(lambda: len(done) == 0)
+    return done[0]
+
+
+def count_concurrent_requests():
+    from walt.server.processes.main.nodes import netservice
+
+    cls = netservice.ServerToNodeRequest
+    orig_run, orig_report = cls.run, cls.report
+    counters = dict(current=0, max=0)
+
+    def run(self):
+        counters["current"] += 1
+        counters["max"] = max(counters["max"], counters["current"])
+        orig_run(self)
+
+    def report(self, result_msg):
+        if not self.done:
+            counters["current"] -= 1
+        orig_report(self, result_msg)
+
+    cls.run, cls.report = run, report
+    return counters
+
+
+@define_test("node requests with a concurrency limit")
+def test_node_request_concurrency():
+    from walt.server.processes.main.nodes import netservice
+
+    counters = count_concurrent_requests()
+    service = FakeNetService()
+    nodes = fake_nodes(NUM_FAKE_NODES)
+    try:
+        results = run_requests(nodes)
+    finally:
+        service.close()
+    failing = set(n.ip for n in nodes if n.ip.endswith(FAILING_NODE_SUFFIX))
+    assert results == {
+        "OK": set(n.ip for n in nodes) - failing,
+        "some error": failing,
+    }
+    assert len(service.requests) == NUM_FAKE_NODES
+    assert all(lines == [b"MODE single\n", b"REBOOT\n"]
+               for _, *lines in service.requests)
+    assert counters["max"] == netservice.NODE_REQUEST_MAX_CONCURRENCY
+    assert counters["current"] == 0
+    # requests to an empty set of nodes should complete immediately
+    assert run_requests([]) == {}
+
+
+@define_test("node requests with refused connections")
+def test_node_request_refused():
+    service = FakeNetService()
+    service.close()  # no endpoint listening anymore
+    nodes = fake_nodes(100)
+    assert run_requests(nodes) == {"Connection refused": set(n.ip for n in nodes)}
+
+
+@define_test("node requests timing out")
+def test_node_request_timeout():
+    from walt.server.processes.main.nodes import netservice
+
+    netservice.NODE_REQUEST_DELAY_SECS = 0.5
+    service = FakeNetService(reply=False)
+    nodes = fake_nodes(100)
+    try:
+        results = run_requests(nodes)
+    finally:
+        service.close()
+    assert results == {"Timed out waiting for reply": set(n.ip for n in nodes)}
+
+
+@define_test("node requests with synchronous connect failures")
+def test_node_request_sync_failures():
+    import walt.server.tools
+
+    def failing_connect(sock, ip, port):
+        if ip.endswith(FAILING_NODE_SUFFIX):
+            raise OSError(errno.ENETUNREACH, "Network is unreachable")
+        # the others are refused asynchronously
+        orig_connect(sock, ip, port)
+
+    orig_connect = walt.server.tools.non_blocking_connect
+    walt.server.tools.non_blocking_connect = failing_connect
+    service = FakeNetService()
+    service.close()
+    nodes = fake_nodes(300)
+    failing = set(n.ip for n in nodes if n.ip.endswith(FAILING_NODE_SUFFIX))
+    assert run_requests(nodes) == {
+        "Network is unreachable": failing,
+        "Connection refused": set(n.ip for n in nodes) - failing,
+    }
+    # when all nodes fail synchronously, the batch should not recurse
+    # for each failure
+    walt.server.tools.non_blocking_connect = failing_connect
+    nodes = [FakeNode(f"10.{i // 250}.{i % 250}.7") for i in range(2000)]
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(300)
+    try:
+        results = run_requests(nodes)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    assert results == {"Network is unreachable": set(n.ip for n in nodes)}
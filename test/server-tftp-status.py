@@ -0,0 +1,45 @@
+import tempfile
+from pathlib import Path
+
+from includes.common import define_test
+
+# These tests use the functions saving and loading the TFTP status
+# (server/walt/server/processes/main/network/tftp.py) in a temporary
+# directory.
+
+
+def setup_tftp_status_dir():
+    from walt.server.processes.main.network import tftp
+
+    status_dir = Path(tempfile.mkdtemp())
+    tftp.TFTP_STATUS_PATH = status_dir / "status.snapshot"
+    tftp.TFTP_JOURNAL_PATH = status_dir / "status.journal"
+    tftp.OBSOLETE_TFTP_STATUS_PATH = status_dir / "status.pickle"
+    return tftp
+
+
+@define_test("tftp status snapshot and journal")
+def test_tftp_status_journal():
+    tftp = setup_tftp_status_dir()
+    tftp.TFTP_STATUS = {"DIR aa:bb", "SYMLINK n1 aa:bb"}
+    tftp.save_tftp_status()
+    tftp.TFTP_STATUS = {"DIR aa:bb", "SYMLINK n2 aa:bb"}
+    tftp.journal_tftp_status_changes({"SYMLINK n1 aa:bb"}, {"SYMLINK n2 aa:bb"})
+    assert tftp.TFTP_JOURNAL_PATH.exists()
+    assert tftp.load_tftp_status() == {"DIR aa:bb", "SYMLINK n2 aa:bb"}
+    assert tftp.TFTP_JOURNAL_SIZE == 2
+
+
+@define_test("tftp status journal with a truncated line")
+def test_tftp_status_truncated_journal():
+    tftp = setup_tftp_status_dir()
+    tftp.TFTP_STATUS = {"DIR aa:bb"}
+    tftp.save_tftp_status()
+    # simulate a crash while appending to the journal
+    tftp.TFTP_JOURNAL_PATH.write_text("+SYMLINK n1 aa:bb\n+SYMLINK n2 a")
+    tftp.TFTP_STATUS = tftp.load_tftp_status()
+    assert tftp.TFTP_STATUS == {"DIR aa:bb", "SYMLINK n1 aa:bb"}
+    # the next change should be recorded properly
+    tftp.TFTP_STATUS = {"DIR aa:bb", "SYMLINK n1 aa:bb", "SYMLINK n3 aa:bb"}
+    tftp.journal_tftp_status_changes(set(), {"SYMLINK n3 aa:bb"})
+    assert tftp.load_tftp_status() == tftp.TFTP_STATUS
@@ -0,0 +1,122 @@
+import importlib.util
+import sys
+import tempfile
+from pathlib import Path
+
+from includes.common import define_test, skip_test
+
+# These tests record the execution of a small workload module with the
+# trackexec recorder backends (server/walt/server/trackexec/recorder.py),
+# and replay the recorded traces with the trackexec reader.
+
+WORKLOAD = """\
+import json
+from walt.server.trackexec import precise_timestamping
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def gen_items(n):
+    for i in range(n):
+        yield dict(name=f"n{i}", value=i * 2)
+
+
+def may_fail(i):
+    if i % 7 == 0:
+        raise ValueError(i)
+    return i
+
+
+def default(obj):
+    return sorted(obj)
+
+
+def step(i):
+    items = [item for item in gen_items(10)]
+    total = sum(item["value"] for item in items)
+    text = json.dumps(dict(items=items, keys={"a", "b"}), default=default)
+    try:
+        may_fail(i)
+    except ValueError:
+        total += 1
+    n = 0
+    while n < 3: n += 1
+    total += fib(8)
+    if i % 10 == 0:
+        with precise_timestamping():
+            total += len(text)
+            total += fib(3)
+    return total
+
+
+def run(n):
+    total = 0
+    for i in range(n):
+        total += step(i)
+    return total
+"""
+
+
+def load_workload(tmp_dir):
+    path = tmp_dir / "trackexec_workload.py"
+    path.write_text(WORKLOAD)
+    spec = importlib.util.spec_from_file_location("trackexec_workload", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def record(recorder_cls, workload, log_dir):
+    recorder_cls.record(workload, log_dir)
+    try:
+        result = workload.run(300)
+    finally:
+        recorder_cls.stop()
+    return result
+
+
+def replay(log_dir):
+    """Return the sequence of (stack_depth, file_id, lineno) positions
+    found when replaying the trace, without consecutive duplicates."""
+    from walt.server.trackexec.reader import LogsReader
+
+    reader = LogsReader(log_dir)
+    positions = []
+    for block_id in range(reader.max_block_id + 1):
+        reader.seek(block_id)
+        data = reader.block_source_data
+        for position in zip(data.stack_depth.tolist(), data.file_id.tolist(),
+                            data.lineno.tolist()):
+            if len(positions) == 0 or positions[-1] != position:
+                positions.append(position)
+    return reader.filenames, positions
+
+
+@define_test("trackexec monitoring and settrace recorders are equivalent")
+def test_trackexec_recorders_equivalence():
+    if sys.version_info < (3, 12):
+        skip_test("sys.monitoring requires python >= 3.12")
+    from walt.server.trackexec.recorder import MonitoringRecorder, SetTraceRecorder
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    workload = load_workload(tmp_dir)
+    expected = workload.run(300)
+    assert record(SetTraceRecorder, workload, tmp_dir / "settrace") == expected
+    assert record(MonitoringRecorder, workload, tmp_dir / "monitoring") == expected
+    settrace_files, settrace_positions = replay(tmp_dir / "settrace")
+    monitoring_files, monitoring_positions = replay(tmp_dir / "monitoring")
+    assert settrace_files == monitoring_files == [workload.__file__]
+    assert len(settrace_positions) > 10000
+    assert settrace_positions == monitoring_positions
+    # the recorder could be started again, and another tool may use
+    # sys.monitoring at the same time
+    sys.monitoring.use_tool_id(sys.monitoring.PROFILER_ID, "other-profiler")
+    try:
+        record(MonitoringRecorder, workload, tmp_dir / "monitoring2")
+    finally:
+        sys.monitoring.free_tool_id(sys.monitoring.PROFILER_ID)
+    assert replay(tmp_dir / "monitoring2")[1] == monitoring_positions
@@ -0,0 +1,148 @@
+from includes.common import define_test
+
+# These tests check the semantics of server workflows
+# (server/walt/server/processes/main/workflow.py).
+
+
+@define_test("workflow env updates and step lists")
+def test_workflow_env_and_steps():
+    from walt.server.processes.main.workflow import Workflow
+
+    log = []
+
+    def step_a(wf, x, **env):
+        log.append(("a", x, env.get("y")))
+        wf.update_env(x=x + 1)  # persistent
+        wf.next(y=5)  # for the next step only
+
+    def step_b(wf, x, y=None, **env):
+        log.append(("b", x, y))
+        wf.insert_steps([step_c, step_c])
+        wf.next()
+
+    def step_c(wf, x, y=None, **env):
+        log.append(("c", x, y))
+        env["x"] = -1  # the env of the workflow is not affected
+        wf.next()
+
+    def step_d(wf, x, **env):
+        log.append(("d", x))
+        wf.interrupt()
+
+    ended = []
+    wf = Workflow([step_a, step_b, step_a], x=0)
+    wf.append_steps([step_c, step_d, step_a])
+    wf._end_callbacks.append(lambda: ended.append(True))
+    wf.run()
+    assert log == [
+        ("a", 0, None), ("b", 1, 5), ("c", 1, None), ("c", 1, None),
+        ("a", 1, None), ("c", 2, 5), ("d", 2),
+    ]
+    assert wf.done and ended == [True]
+    assert wf.get_env() == dict(x=2)
+
+
+@define_test("workflow parallel steps and waits")
+def test_workflow_parallel_steps():
+    from walt.server.processes.main.workflow import Workflow
+
+    pending, log = [], []
+
+    def step_wait(wf, **env):
+        pending.append(wf.next)
+
+    def step_branch(wf, i, **env):
+        log.append(("branch", i))
+        pending.append(wf.next)
+
+    def step_map(wf, **env):
+        wf.map_as_parallel_steps(step_branch, [1, 2, 3])
+        wf.next()
+
+    def step_end(wf, name, **env):
+        log.append(("end", name))
+        wf.next()
+
+    wf = Workflow([step_wait, step_map, step_end], name="wf")
+    wf.run()
+    other_wf = Workflow([step_end], name="other_wf")
+    other_wf.continue_after_other_workflow(wf)
+    while len(pending) > 0:
+        pending.pop(0)()
+    assert log == [("branch", 1), ("branch", 2), ("branch", 3),
+                   ("end", "wf"), ("end", "other_wf")]
+    assert wf.done and other_wf.done
+    assert Workflow.can_end_evloop()
+
+
+@define_test("workflow chrome trace export")
+def test_workflow_chrome_trace():
+    import functools
+    import gc
+    import json
+    import weakref
+
+    from walt.server.processes.main.workflow import Workflow
+
+    class Payload:
+        def step(self, wf, **env):
+            wf.next()
+
+    def step_with_arg(wf, payload, **env):
+        wf.next()
+
+    def step_branch(wf, i, **env):
+        wf.next()
+
+    def step_map(wf, **env):
+        wf.map_as_parallel_steps(step_branch, [1, 2])
+        wf.next()
+
+    Workflow.trace.clear()
+    payload = Payload()
+    payload_ref = weakref.ref(payload)
+    wf = Workflow([functools.partial(step_with_arg, payload=payload),
+                   payload.step, step_map])
+    wf.run()
+    other_wf = Workflow([step_branch], i=0)
+    waited_wf = Workflow([step_map])
+    other_wf.continue_after_other_workflow(waited_wf)
+    waited_wf.run()
+    assert other_wf.done
+    del payload
+    gc.collect()
+    # the trace keeps the step functions only, not their arguments
+    # or the object of bound methods
+    assert payload_ref() is None
+    trace = json.loads(json.dumps(Workflow.trace.export_chrome_trace()))
+    assert set(trace) == {"traceEvents", "displayTimeUnit"}
+    events = trace["traceEvents"]
+    for event in events:
+        assert isinstance(event["name"], str)
+        assert isinstance(event["pid"], int) and isinstance(event["tid"], int)
+        assert event["ph"] in ("X", "i", "M")
+        if event["ph"] == "X":
+            assert event["ts"] >= 0 and event["dur"] >= 0
+        elif event["ph"] == "i":
+            assert event["ts"] >= 0 and event["s"] == "t"
+        else:
+            assert event["name"] == "thread_name"
+            assert isinstance(event["args"]["name"], str)
+    wf_events = [(e["ph"], e["name"]) for e in events if e["tid"] == wf._id]
+    prefix = "test_workflow_chrome_trace.<locals>."
+    assert wf_events == [
+        ("X", prefix + "step_with_arg"),
+        ("X", prefix + "Payload.step"),
+        ("X", prefix + "step_map"),
+        ("i", "branch-end"),
+        ("i", "branch-end"),
+        ("X", "parallel(2)"),
+        ("X", "workflow"),
+        ("M", "thread_name"),
+    ]
+    parallel = next(e for e in events
+                    if e["tid"] == wf._id and e["name"] == "parallel(2)")
+    assert parallel["args"]["branches"] == [prefix + "step_branch"] * 2
+    waits = [e for e in events if e["name"].startswith("wait ")]
+    assert [e["tid"] for e in waits] == [other_wf._id]
+    assert Workflow.can_end_evloop()
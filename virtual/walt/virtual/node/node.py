@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import atexit
+import fcntl
 import json
 import os
 import platform
@@ -33,6 +34,9 @@ VNODE_DEFAULT_SCREEN_SESSION_PATH = "/var/lib/walt/nodes/%(mac)s/screen_session"
 VNODE_DEFAULT_DISKS_PATH = "/var/lib/walt/nodes/%(mac)s/disks"
 VNODE_DEFAULT_NETWORKS_PATH = "/var/lib/walt/nodes/%(mac)s/networks"
 VNODE_FS_PATH = "/var/lib/walt/nodes/%(mac)s/fs"
+VNODE_DISK_TEMPLATES_PATH = Path("/var/lib/walt/vnode-disk-templates")
+VNODE_STARTUP_SLOTS_PATH = Path("/run/walt/vnode-startup-slots")
+VNODE_STARTUP_MAX_CONCURRENCY = 8
 VNODE_IFUP_SCRIPT_TEMPLATE = "walt-vnode-ifup"
 VNODE_IFDOWN_SCRIPT_TEMPLATE = "walt-vnode-ifdown"
 
@@ -76,7 +80,7 @@ QEMU_ARGS = (
     "             -name %(name)s -nographic -serial mon:stdio -no-reboot"
     "             -kernel %(boot_kernel)s"
 )
-STATE = dict(QEMU_PID=None, STOPPING=False)
+STATE = dict(QEMU_PID=None, STOPPING=False, STARTUP_PHASES={})
 STDOUT_BUFFERING_TIME = 0.05
 
 
@@ -180,6 +184,86 @@ def apply_disk_template(disk_path, disk_template):
         init_content.cleanup()
 
 
+@contextmanager
+def file_lock(lock_path):
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+@contextmanager
+def startup_phase(name):
+    t0 = time.time()
+    yield
+    STATE["STARTUP_PHASES"][name] = time.time() - t0
+
+
+def print_startup_phases():
+    phases = STATE["STARTUP_PHASES"]
+    print("Startup phases: " +
+          " ".join(f"{name}={duration:.2f}s" for name, duration in phases.items()))
+    phases.clear()
+
+
+# When many virtual nodes are started at once (e.g. when walt-server-daemon
+# starts), we limit the number of vnodes preparing their disks and starting
+# qemu concurrently, host-wide. Each vnode must lock one of the slot files
+# during this phase.
+@contextmanager
+def startup_slot():
+    VNODE_STARTUP_SLOTS_PATH.mkdir(parents=True, exist_ok=True)
+    t0 = time.time()
+    while True:
+        for slot_index in range(VNODE_STARTUP_MAX_CONCURRENCY):
+            slot_path = VNODE_STARTUP_SLOTS_PATH / f"slot-{slot_index}"
+            with open(slot_path, "w") as slot_file:
+                try:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue    # slot busy, try next one
+                STATE["STARTUP_PHASES"]["slot-wait"] = time.time() - t0
+                yield
+                return
+        # all slots are busy, retry later
+        time.sleep(0.1 + random.random() * 0.2)
+
+
+def get_disk_base_image(disk_cap_bytes, disk_template):
+    # All vnode disks with the same capacity and template share a read-only
+    # base image, prepared once, and each vnode disk is a thin qcow2 overlay
+    # over it.
+    VNODE_DISK_TEMPLATES_PATH.mkdir(parents=True, exist_ok=True)
+    base_name = f"{disk_template}-{disk_cap_bytes}.qcow2"
+    base_path = VNODE_DISK_TEMPLATES_PATH / base_name
+    if base_path.exists():
+        return base_path
+    with file_lock(VNODE_DISK_TEMPLATES_PATH / f".{base_name}.lock"):
+        if base_path.exists():
+            return base_path    # another vnode just created it
+        with tempfile.TemporaryDirectory(dir=VNODE_DISK_TEMPLATES_PATH) as tmp_dir:
+            raw_path = Path(tmp_dir) / "disk.dd"
+            raw_path.touch()
+            truncate(str(raw_path), disk_cap_bytes)
+            apply_disk_template(raw_path, disk_template)
+            tmp_path = Path(tmp_dir) / "disk.qcow2"
+            subprocess.run(shlex.split(
+                f"qemu-img convert -f raw -O qcow2 {raw_path} {tmp_path}"),
+                check=True)
+            tmp_path.rename(base_path)
+    return base_path
+
+
+def create_disk_overlay(disk_path, disk_cap_bytes, disk_template):
+    if disk_template == "none":
+        backing_opts = ""
+    else:
+        base_path = get_disk_base_image(disk_cap_bytes, disk_template)
+        backing_opts = f"-b {base_path} -F qcow2"
+    subprocess.run(shlex.split(
+        f"qemu-img create -q -f qcow2 {backing_opts} {disk_path} {disk_cap_bytes}"),
+        check=True)
+
+
 def get_qemu_disks_args(disks_path, disks_info):
     if len(disks_info) == 0:
         return ""
@@ -188,27 +272,35 @@ def get_qemu_disks_args(disks_path, disks_info):
     for disk_index, disk_info in enumerate(disks_info):
         disk_cap, disk_template = disk_info
         disk_cap_bytes = disk_cap * 1000000000
-        disk_path = Path(f"{disks_path}/disk_{disk_index}.dd")
+        raw_disk_path = Path(f"{disks_path}/disk_{disk_index}.dd")
+        disk_path = Path(f"{disks_path}/disk_{disk_index}.qcow2")
         disk_params_file = Path(f"{disks_path}/disk_{disk_index}.info")
         if disk_params_file.exists():
             disk_params = json.loads(disk_params_file.read_text())
-            old_disk_template = disk_params['template']
         else:   # backward compatibility
-            old_disk_template = 'none'
-        if disk_path.exists():
-            # if not expected size or template, remove it
-            if disk_path.stat().st_size != disk_cap_bytes or \
-                    old_disk_template != disk_template:
-                disk_path.unlink()
-                if disk_params_file.exists():
-                    disk_params_file.unlink()
-        if not disk_path.exists():
-            disk_path.touch()
-            truncate(str(disk_path), disk_cap_bytes)
-            apply_disk_template(disk_path, disk_template)
-            disk_params_file.write_text(json.dumps({"template": disk_template}))
+            disk_params = {"template": "none"}
+        disk_params.setdefault("format", "raw")
+        if disk_params["format"] == "raw":
+            # disk created by an older walt version
+            disk_params["capacity"] = (raw_disk_path.stat().st_size
+                                       if raw_disk_path.exists() else None)
+        expected_params = {"template": disk_template, "capacity": disk_cap_bytes}
+        if any(disk_params.get(k) != v for k, v in expected_params.items()):
+            # not expected size or template, remove it
+            raw_disk_path.unlink(missing_ok=True)
+            disk_path.unlink(missing_ok=True)
+            disk_params_file.unlink(missing_ok=True)
+        if raw_disk_path.exists():
+            disk_format, disk_file = "raw", raw_disk_path
+        else:
+            if not disk_path.exists():
+                create_disk_overlay(disk_path, disk_cap_bytes, disk_template)
+                disk_params_file.write_text(json.dumps(
+                    dict(format="qcow2", **expected_params)))
+            disk_format, disk_file = "qcow2", disk_path
         qemu_disk_opts += (
-            f" -drive file={disk_path},format=raw,id=disk{disk_index},if=none" +
+            f" -drive file={disk_file},format={disk_format}," +
+            f"id=disk{disk_index},if=none" +
             " -device virtio-scsi-pci" +
             f" -device scsi-hd,drive=disk{disk_index},product=QEMU-DISK")
     return qemu_disk_opts
@@ -318,8 +410,9 @@ class VMParameters:
 
     @property
     def qemu_disks_args(self):
-        return get_qemu_disks_args(
-            self.disks_path, self._disks_info)
+        with startup_phase("disks"):
+            return get_qemu_disks_args(
+                self.disks_path, self._disks_info)
 
     @property
     def networks(self):
@@ -335,8 +428,9 @@ class VMParameters:
 
     @property
     def qemu_networks_args(self):
-        return get_qemu_networks_args(
-            self.mac, self.hostid, self.networks_path, self._networks_info)
+        with startup_phase("networks"):
+            return get_qemu_networks_args(
+                self.mac, self.hostid, self.networks_path, self._networks_info)
 
     @property
     def boot_delay(self):
@@ -410,6 +504,7 @@ def get_env_start(info):
 
 
 def boot_kvm(env):
+    STATE["STARTUP_PHASES"]["netboot"] = time.time() - env.netboot_start
     if env.managed:
         boot_kvm_managed(env)
     else:
@@ -438,10 +533,11 @@ def get_vm_args(env):
 def boot_kvm_managed(env):
     qemu_pid_fd = None
     # start the VM
-    args = get_vm_args(env)
-    qemu_stdin_r, qemu_stdin_w = os.pipe()
-    qemu_stdout_r, qemu_stdout_w = os.pipe()
-    pid = os.fork()
+    with startup_slot(), startup_phase("vm-setup"):
+        args = get_vm_args(env)
+        qemu_stdin_r, qemu_stdin_w = os.pipe()
+        qemu_stdout_r, qemu_stdout_w = os.pipe()
+        pid = os.fork()
     if pid == 0:
         # child
         os.dup2(qemu_stdin_r, 0)  # set stdin
@@ -457,6 +553,7 @@ def boot_kvm_managed(env):
         os.execlp(args[0], *args)
     # parent
     STATE["QEMU_PID"] = pid
+    print_startup_phases()
     # cleanup unused file descriptors
     for fd in qemu_stdin_r, qemu_stdout_w:
         os.close(fd)
@@ -518,8 +615,9 @@ def boot_kvm_managed(env):
 
 def boot_kvm_unmanaged(env):
     """Unmanaged mode: start the VM with static conf parameters"""
-    args = get_vm_args(env)
-    pid = os.fork()
+    with startup_slot(), startup_phase("vm-setup"):
+        args = get_vm_args(env)
+        pid = os.fork()
     if pid == 0:
         # child
         os.dup2(STATE["SAVED_STDIN"], 0)  # restore stdin
@@ -532,6 +630,7 @@ def boot_kvm_unmanaged(env):
     else:
         # parent
         STATE["QEMU_PID"] = pid
+        print_startup_phases()
         # wait until the child ends
         pid, exit_status = os.waitpid(STATE["QEMU_PID"], 0)
         STATE["QEMU_PID"] = None
@@ -603,13 +702,15 @@ def node_loop(info):
     env = get_env_start(info)
     while not STATE["STOPPING"]:
         try:
-            if env.boot_delay == "random":
-                # default is to wait randomly to mitigate
-                # simultaneous load of various virtual nodes
-                random_wait()
-            elif env.boot_delay > 0:
-                time.sleep(env.boot_delay)
+            with startup_phase("delay"):
+                if env.boot_delay == "random":
+                    # default is to wait randomly to mitigate
+                    # simultaneous load of various virtual nodes
+                    random_wait()
+                elif env.boot_delay > 0:
+                    time.sleep(env.boot_delay)
             print("Starting...")
+            env.netboot_start = time.time()
             ipxe_boot(env)
         except Exception:
             print("Exception in node_loop()")